@@ -9,79 +9,121 @@ Version 2, added support for multiple/all countries
 
 import matplotlib.pyplot as plt
 
-from json import load
-from random import randint
+import sys
 from os import mkdir, path
 
+# The shared modules live in the folder above the assignments.
+sys.path.append(path.abspath(path.join(path.dirname(__file__), "..")))
+import owid_stream
+import owid_matrix
+import owid_cache
+import owid_render
+
 
 def main():
     # https://github.com/owid/covid-19-data/tree/master/public/data
+    # Plots are only saved, not shown.
+    owid_render.use_agg()
     script_cwd = path.dirname(__file__)
     filepath = path.abspath(path.join(script_cwd, "..", "owid-covid-data.json"))
     
-    covid_data = get_data(filepath)
-    
-    countries_list = list(covid_data.keys())
-    # print(countries_list)
+    # The memory-mapped cache of the json file (see owid_cache), only parsed again after a download.
+    # For one or a few countries without the cache only those have to be loaded:
+    # dataset = owid_dataset.OwidDataset(get_data(filepath, countries=["FRA"]))
+    dataset = owid_cache.load_dataset(filepath)
+    # print(dataset.iso_codes)
     
     comparisons = ["total_cases", "new_cases", "total_deaths", "new_deaths"]
     
-    # one_country(comparisons, countries_list, covid_data, "FRA")
+    # one_country(comparisons, dataset, "FRA")
+    
+    # One plot per country for every country, pdf=True for one PDF per comparison.
+    # all_country_plots(comparisons, dataset)
     
     # selected = ["FRA", "NLD"]
     
-    multiple_countries(comparisons, countries_list, covid_data, all_countries=True)
+    multiple_countries(comparisons, dataset, all_countries=True)
 
 
 """
 For a single country, leave 'country' as an empty string for a random country
 """
-def one_country(comparisons, countries_list, covid_data, country=""):
-    try:
-        country_index = countries_list.index(country)
-    except ValueError:
-        country_index = randint(0, len(countries_list)-1)
+def one_country(comparisons, dataset, country=""):
+    if country in dataset:
+        selected_country = country
+    else:
+        selected_country = dataset.random()
 
-    selected_country = countries_list[country_index]
-    print(selected_country, covid_data[selected_country]["location"])
+    print(selected_country, dataset[selected_country]["location"])
     
-    specific_country = covid_data[selected_country]
+    location = dataset[selected_country]["location"]
+    matrix = dataset.matrix(comparisons, [selected_country])
     
+    plots = []
     for comparison in comparisons:
-        dates, compare_data = date_compared_to(specific_country, comparison)
-        plot_data_single(dates, compare_data, comparison, specific_country["location"])
+        dates, compare_data = matrix.row_dates(selected_country), matrix.row(comparison, selected_country)
+        plots.append((dates, compare_data, comparison, location))
+
+    # Every comparison is rendered in its own process.
+    owid_render.render_many(plot_data_single, plots, comparisons)
+
+
+"""
+Atlas mode, one plot per country for every comparison, all countries by default.
+Every comparison is one figure that is reused for all countries, saved as one PNG per
+country in 'Atlas <comparison>' or with pdf=True as one PDF, 'Atlas <comparison>.pdf'.
+"""
+def all_country_plots(comparisons, dataset, selected_countries=None, pdf=False):
+    selected_countries = dataset.select(selected_countries)
+    
+    # Fills all comparisons for all selected countries at once.
+    matrix = dataset.matrix(comparisons, selected_countries)
+    
+    plots = []
+    for comparison in comparisons:
+        series = []
+        for country in matrix.iso_codes:
+            if matrix.mask(country).any():
+                series.append((dataset[country]["location"], matrix.row_dates(country), matrix.row(comparison, country)))
+        plots.append((series, comparison, pdf))
+    
+    # Every comparison is rendered in its own process.
+    owid_render.render_many(plot_atlas, plots, comparisons)
 
 
 """
 For multiple or all countries
 """
-def multiple_countries(comparisons, countries_list, covid_data, selected_countries=None, all_countries=False):
+def multiple_countries(comparisons, dataset, selected_countries=None, all_countries=False):
     if all_countries:
-        selected_countries = countries_list
+        selected_countries = dataset.select()
+    else:
+        # Iso codes or location names, unknown ones are left out.
+        selected_countries = dataset.select(selected_countries)
     
+    # Fills all comparisons for all selected countries at once.
+    matrix = dataset.matrix(comparisons, selected_countries)
+
+    plots = []
     for comparison in comparisons:
         data_points = {}
-        for country in selected_countries:
-            country_index = countries_list.index(country)
-        
-            selected_country = countries_list[country_index]
-            # print(selected_country, covid_data[selected_country]["location"])
-        
-            specific_country = covid_data[selected_country]
-            dates, compare_data = date_compared_to(specific_country, comparison)
-            
-            data_points[country] = (dates, compare_data)
+        for country in matrix.iso_codes:
+            data_points[country] = (matrix.row_dates(country), matrix.row(comparison, country))
         if all_countries:
-            plot_data_multiple(data_points, comparison, 20, 10, True)
+            plots.append((data_points, comparison, 20, 10, True))
         else:
-            plot_data_multiple(data_points, comparison, 12, 8)
+            plots.append((data_points, comparison, 12, 8))
+
+    # Every comparison is rendered in its own process.
+    owid_render.render_many(plot_data_multiple, plots, comparisons)
                          
 
 """
-Loads the data from the json file
+Loads the data from the json file.
+'countries' (iso codes) and 'fields' are optional, only those get loaded.
 """
-def get_data(filename):
-    covid_data = load(open(filename))
+def get_data(filename, countries=None, fields=None):
+    covid_data = owid_stream.get_data(filename, countries, fields)
     return covid_data
 
 
@@ -91,25 +133,7 @@ Some entries are 'None', if the entry is 'None' for total_, it copies the data
 from the day before. If the entry is of type new_, it sets it to 0.0.
 """
 def date_compared_to(country_data, to_compare_to):
-    data = country_data["data"]
-    data_type = to_compare_to.split("_")[0]
-    
-    dates = [list_item.get("date") for list_item in data]
-    compare_data = []
-    for list_item in data:
-        temp = list_item.get(to_compare_to)
-        if not temp == None:
-            compare_data.append(temp)
-        else:
-            if data_type == "total":
-                # First value can also be 'None', sets it to 0.0
-                try:
-                    compare_data.append(compare_data[-1])
-                except IndexError:
-                    compare_data.append(0.0)
-            else:
-                compare_data.append(0.0)
-    
+    dates, compare_data = owid_matrix.country_series(country_data, to_compare_to)
     return dates, compare_data
   
   
@@ -123,6 +147,8 @@ def plot_data_single(x, y, comparison, country, f_x = 6, f_y = 4):
     
     fig, ax = plt.subplots(figsize=(f_x,f_y))
     
+    # Not more points than the plot is wide in pixels.
+    x, y = owid_render.decimate_series(ax, x, y)
     plt.plot(x, y)
     plt.xticks(rotation=90)
     plt.title(plot_title)
@@ -141,13 +167,41 @@ def plot_data_single(x, y, comparison, country, f_x = 6, f_y = 4):
     except Exception:
         pass
     
-    plt.savefig("{}/{}.png".format(country, plot_title), bbox_inches="tight", dpi=100)
+    owid_render.save_figure(fig, "{}/{}.png".format(country, plot_title))
+    
+    
+"""
+Plots all (location, dates, values) series of one comparison on one reused figure,
+see all_country_plots().
+"""
+def plot_atlas(series, comparison, pdf=False, f_x = 6, f_y = 4):
+    comparison_e = comparison.replace("_", " ")
+    dir_name = "Atlas {}".format(comparison_e)
+    
+    if pdf:
+        pdf_filename = "{}.pdf".format(dir_name)
+    else:
+        pdf_filename = None
+        try:
+            mkdir(dir_name)
+        except Exception:
+            pass
+    
+    with owid_render.Atlas("Dates", "Amount of {}".format(comparison_e), f_x, f_y, pdf_filename) as atlas:
+        for location, x, y in series:
+            plot_title = "Date versus {} in {}".format(comparison_e, location)
+            atlas.plot(x, y, plot_title, "{}/{}.png".format(dir_name, plot_title))
     
+    print(atlas.summary())
     
+
 """
 Plots the data for multiple countries at once
+
+With many countries (see owid_render.FAST_MIN_SERIES) or fast=True all lines are
+drawn as one collection and the legend is saved as a separate image.
 """
-def plot_data_multiple(data_points, comparison, f_x = 6, f_y = 4, all_countries=False):
+def plot_data_multiple(data_points, comparison, f_x = 6, f_y = 4, all_countries=False, fast=None, rasterized=False):
     comparison_e = comparison.replace("_", " ")
           
     plot_title = "Date versus {}".format(comparison_e)
@@ -157,13 +211,39 @@ def plot_data_multiple(data_points, comparison, f_x = 6, f_y = 4, all_countries=
     countries = list(data_points.keys())
     num_colors = len(countries)
     
+    if fast is None:
+        fast = num_colors >= owid_render.FAST_MIN_SERIES
+    
+    if all_countries:
+        dir_name = "All_countries"
+    else:
+        if len(countries) > 5:
+            dir_name = "{}_etc".format("_".join(countries[0:5]))
+        else:
+            dir_name = "_".join(countries)       
+
+    try:        
+        mkdir(dir_name)
+    except Exception:
+        pass
+    
+    if fast:
+        plot_multiple_fast(fig, ax, data_points, comparison_e, plot_title, dir_name, rasterized)
+        return
+    
     # Selects a color
     cm = plt.get_cmap('tab20')
     ax.set_prop_cycle('color', [cm(1.*i/num_colors) for i in range(num_colors)])
     
+    # Not more points per country than the plot is wide in pixels.
+    shown = [owid_render.decimate_series(ax, *data_points.get(country)) for country in countries]
+    # The dates are categories, registered in date order first because
+    # decimated countries don't all keep the same dates.
+    dates = sorted(set().union(*[x for x, y in shown]))
+    ax.xaxis.update_units(dates)
+    
     # Plots all the data
-    for country in countries:
-        x, y = data_points.get(country)
+    for country, (x, y) in zip(countries, shown):
         plt.plot(x, y, label=country)
         
     plt.xticks(rotation=90)
@@ -182,25 +262,33 @@ def plot_data_multiple(data_points, comparison, f_x = 6, f_y = 4, all_countries=
     # To limit the amount of dates shown,
     # otherwise the plot becomes unreadable.
     ratio = f_x // 6
-    every_nth = len(x) // (17*ratio)
+    every_nth = len(dates) // (17*ratio)
     for n, label in enumerate(ax.xaxis.get_ticklabels()):
         if n % every_nth != 0:
             label.set_visible(False)
     
-    if all_countries:
-        dir_name = "All_countries"
-    else:
-        if len(countries) > 5:
-            dir_name = "{}_etc".format("_".join(countries[0:5]))
-        else:
-            dir_name = "_".join(countries)       
+    owid_render.save_figure(fig, "{}/{}.png".format(dir_name, plot_title))
 
-    try:        
-        mkdir(dir_name)
-    except Exception:
-        pass
+
+"""
+Fast path of plot_data_multiple(), one LineCollection for all countries on a date axis.
+The legend is saved next to the plot as '<title> legend.png'.
+"""
+def plot_multiple_fast(fig, ax, data_points, comparison_e, plot_title, dir_name, rasterized=False):
+    countries = list(data_points.keys())
+    colors = owid_render.series_colors(len(countries))
+    
+    shown = [owid_render.decimate_series(ax, *data_points.get(country)) for country in countries]
+    owid_render.draw_lines(ax, shown, colors, rasterized)
+    
+    ax.set_title(plot_title)
+    ax.set_ylabel("Amount of {}".format(comparison_e))
+    ax.set_xlabel("Dates")
+    # Rotates the dates and makes room for them, without the tight bounding box.
+    fig.autofmt_xdate(rotation=90, ha="center")
     
-    plt.savefig("{}/{}.png".format(dir_name, plot_title), bbox_inches="tight", dpi=100)
+    owid_render.save_legend(countries, colors, "{}/{} legend.png".format(dir_name, plot_title))
+    owid_render.save_figure(fig, "{}/{}.png".format(dir_name, plot_title), tight=False)
 
 
 
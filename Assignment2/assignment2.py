@@ -9,33 +9,44 @@ or all countries. With the sigmoid fitted line added.
 To also plot the growth rates as a barplot, enable it in multiple_countries(). This function
 is not relevant for single_country().
 
-There is currently no check for a 'second wave', so if a country has one, the fitted line/growth rate
-for that country isn't 100% reliable.
+The single sigmoid doesn't account for a 'second wave', so if a country has one, the fitted line/growth rate
+for that country isn't 100% reliable. waves() finds the waves of every country and fits one sigmoid
+per wave instead, with a growth rate per wave (see owid_waves).
 """
 import matplotlib.pyplot as plt
 
-from json import load
-from random import randint
+import sys
 from os import mkdir, path
-from scipy.optimize import curve_fit
-from numpy import median, exp, asarray, linspace
+from numpy import array, asarray, isfinite, linspace, nan, searchsorted
+
+# The shared modules live in the folder above the assignments.
+sys.path.append(path.abspath(path.join(path.dirname(__file__), "..")))
+import owid_stream
+import owid_matrix
+import owid_cache
+import owid_fit
+import owid_waves
+from owid_model import sigmoid, sigmoid_jacobian, sigmoid_bounds
+import owid_render
 
-from datetime import datetime
 
 def main():
     # https://github.com/owid/covid-19-data/tree/master/public/data
+    # Plots are only saved, not shown.
+    owid_render.use_agg()
     script_cwd = path.dirname(__file__)
     filepath = path.abspath(path.join(script_cwd, "..", "owid-covid-data.json"))
 
-    covid_data = get_data(filepath)
-    start_date = get_start_date(covid_data)
+    # The memory-mapped cache of the json file (see owid_cache), only parsed again after a download.
+    dataset = owid_cache.load_dataset(filepath)
+    start_date = dataset.start_date()
 
     # Select a country based on country code, only used for single country plotting,
     # leave as an empty string to plot a random country from the list.
     country_code = "" #"GIB" #"EST"
     comparison = "total_cases"
 
-    countries_list = list(covid_data.keys())
+    countries_list = dataset.select()
 
     # This country had a growth rate of around 40, making the entire barplot unreadable.
     # countries_list.remove("AIA") # = Anguilla
@@ -44,12 +55,11 @@ def main():
 
 
     # Check if the selected country code exists, otherwise plot a random one.
-    if country_code in countries_list:
-        country_data = covid_data.get(country_code)
-    else:
-        country_index = randint(0, len(countries_list)-1)
-        country_data = covid_data.get(countries_list[country_index])
-        print(countries_list[country_index])
+    if country_code not in dataset:
+        country_code = dataset.random()
+        print(country_code)
+    # The records of just this country, the cache only has the static fields.
+    country_data = get_data(filepath, countries=[country_code])[country_code]
 
 
     name = country_data.get("location")
@@ -61,28 +71,30 @@ def main():
 
     # # selected_countries = countries_list # if you want to do all countries.
     # # Not recommended. Remember to also add ', True' to the function call.
-    # multiple_countries(covid_data, comparison, start_date, selected_countries)
+    # multiple_countries(dataset, comparison, start_date, selected_countries)
+
+    # Growth rate per wave, for all countries:
+    # waves(dataset, comparison)
 
     return country_data, name
 
 
 """
-Loads the data from the json file
+Loads the data from the json file.
+'countries' (iso codes) and 'fields' are optional, only those get loaded.
 """
-def get_data(filename):
-    covid_data = load(open(filename))
+def get_data(filename, countries=None, fields=None):
+    covid_data = owid_stream.get_data(filename, countries, fields)
     return covid_data
 
 
 """
-Gets the earliest date from the data, datetime object
+Gets the earliest date from the data, numpy datetime64 object
 """
 def get_start_date(covid_data):
-    min_date = []
-    for key, value in covid_data.items():
-        min_date.append(datetime.strptime(value.get("data")[0].get("date"), "%Y-%m-%d"))
+    first_dates = [value.get("data")[0].get("date") for value in covid_data.values()]
 
-    return min(min_date)
+    return array(first_dates, dtype="datetime64[D]").min()
 
 
 """
@@ -110,20 +122,22 @@ Main function calls for a multiple or all countries
 
 Add 'True' to the plot_data() call to plot growth rates per country as a barplot.
 """
-def multiple_countries(covid_data, comparison, start_date, selected_countries=None, all_countries=False):
+def multiple_countries(dataset, comparison, start_date, selected_countries=None, all_countries=False):
+    # Iso codes or location names, unknown ones are left out.
+    selected_countries = dataset.select(selected_countries)
     # print(selected_countries)
 
+    # Fills the comparison for all the selected countries at once.
+    matrix = dataset.matrix([comparison], selected_countries)
+
     # Dictionary to store the data in per country, used to make the plot.
     data_points = {}
     # For-loop to get all the data from the selected data or all countries if selected.
     for country in selected_countries:
-        country_data = covid_data.get(country)
+        population = dataset[country].get("population")
 
-        full_name = country_data.get("location")
-        population = country_data.get("population")
-        data = country_data.get("data")
-
-        days, compared = date_compared_to(data, comparison, start_date)
+        days = matrix.row_days(country, start_date)
+        compared = matrix.row(comparison, country)
 
         compared = (compared / population)*10000
 
@@ -133,6 +147,47 @@ def multiple_countries(covid_data, comparison, start_date, selected_countries=No
     plot_data(data_points, comparison, 20, 15, all_countries)
 
 
+"""
+Finds the waves of the selected countries (all if None) in their new_cases and fits a sigmoid to
+'comparison' per wave. Prints and returns the growth rate of every wave per country:
+{country: [(first date, last date, growth rate or None), ...]}
+"""
+def waves(dataset, comparison="total_cases", selected_countries=None, new_metric="new_cases"):
+    selected_countries = dataset.select(selected_countries)
+    matrix = dataset.matrix([new_metric, comparison], selected_countries)
+
+    # The waves of all countries at once, on the days of the matrix.
+    boundaries = owid_waves.detect_waves(matrix.values[new_metric])
+
+    series = []
+    positions = []
+    for country, country_boundaries in zip(selected_countries, boundaries):
+        days = matrix.row_days(country)
+        series.append((days, matrix.row(comparison, country)))
+        # From days of the matrix to positions in the records of the country.
+        positions.append([int(position) for position in searchsorted(days, country_boundaries)])
+
+    fit_cache = owid_fit.FitCache()
+    fits = owid_waves.fit_waves(series, positions, maxfev=500, cache=fit_cache)
+    fit_cache.close()
+
+    growth_rates = {}
+    for country, (days, _), country_waves in zip(selected_countries, series, fits):
+        growth_rates[country] = []
+        for start, end, popt, status in country_waves:
+            if end <= start:
+                continue
+            rate = None if popt is None else popt[2]
+            growth_rates[country].append((matrix.dates[days[start]], matrix.dates[days[end-1]], rate))
+
+        print("{}: {} wave(s)".format(country, len(growth_rates[country])))
+        for number, (first, last, rate) in enumerate(growth_rates[country], 1):
+            print("  wave {}: {} - {}, growth rate {}".format(number, first, last,
+                                                             "-" if rate is None else "{:.4f}".format(rate)))
+
+    return growth_rates
+
+
 """
 Compares the data on date versus whatever is specified
 Some entries are 'None', if the entry is 'None' for total_, it copies the data
@@ -142,24 +197,11 @@ This is global, meaning some countries start at x=0 and others at x=75, etc.
 Makes plotting much easier.
 """
 def date_compared_to(country_data, to_compare_to, start_date):
-    data_type = to_compare_to.split("_")[0]
-
-    # Converting of dates to days since start.
-    days = [(datetime.strptime(list_item.get("date"), "%Y-%m-%d")-start_date).days for list_item in country_data]
-    compare_data = []
-    for list_item in country_data:
-        temp = list_item.get(to_compare_to)
-        if not temp == None:
-            compare_data.append(temp)
-        else:
-            if data_type == "total":
-                # First value can also be 'None', sets it to 0.0
-                try:
-                    compare_data.append(compare_data[-1])
-                except IndexError:
-                    compare_data.append(0.0)
-            else:
-                compare_data.append(0.0)
+    matrix = owid_matrix.build_matrix({"": {"data": country_data}}, [to_compare_to])
+
+    # Converting of dates to days since start, one subtraction on the date axis.
+    days = matrix.row_days("", start_date)
+    compare_data = matrix.row(to_compare_to, "")
 
     # Return as np arrays
     return asarray(days), asarray(compare_data)
@@ -170,16 +212,17 @@ def date_compared_to(country_data, to_compare_to, start_date):
 #     y_cases = L / (1 + (L-1)*np.exp(-r*x_time))
 #     return y_cases
 
-# https://stackoverflow.com/questions/55725139/fit-sigmoid-function-s-shape-curve-to-data-using-python
-# k = growth rate
-def sigmoid(x, L, x0, k, b):
-    y = L / (1 + exp(-k*(x-x0)))+b
-    return (y)
-
 """
 Plots the data
+
+With many countries (see owid_render.FAST_MIN_SERIES) or fast=True all points and
+fitted lines are drawn as two collections and the legend is saved as a separate image.
+
+The error bars of the growth rates are the standard errors of the fits, with bootstrap=True
+they come from refitting every country (see owid_fit.bootstrap_fits, within its time budget).
 """
-def plot_data(data, comparison, f_x=6, f_y=4, all_countries=False, plot_growth_rate=False):
+def plot_data(data, comparison, f_x=6, f_y=4, all_countries=False, plot_growth_rate=False, fast=None, rasterized=False,
+              bootstrap=False):
     comparison_e = comparison.replace("_", " ")
 
     fig, ax = plt.subplots(figsize=(f_x,f_y)) # *72 = pixels
@@ -188,54 +231,14 @@ def plot_data(data, comparison, f_x=6, f_y=4, all_countries=False, plot_growth_r
     num_colors = len(countries)*2
     max_fev = 500
 
+    if fast is None:
+        fast = len(countries) >= owid_render.FAST_MIN_SERIES
+
     if all_countries:
         plot_title = "{}{} in all countries".format(comparison_e[0].upper(), comparison_e[1::])
     else:
         plot_title = "{}{} in {}".format(comparison_e[0].upper(), comparison_e[1::], ", ".join(countries))
 
-    # Selects a colormap
-    cm = plt.get_cmap('tab20')
-    ax.set_prop_cycle('color', [cm(1.*i/num_colors) for i in range(num_colors)])
-
-    # Extra, to store the growth rates per country
-    growth_rate_per_country = {}
-
-    # Plots all the data and the fitting lines
-    for country in countries:
-        found_sigmoid = True
-
-        days, compared = data.get(country)
-        try:
-            p0 = [max(compared), median(days),1,min(compared)]
-
-            popt, pcov = curve_fit(sigmoid, days, compared, p0, maxfev=max_fev)
-
-            # Saves the growth rate per country to the dictionary
-            growth_rate_per_country[country] = popt[2]
-            # print("L: {}, x0: {}, k: {}, b: {}".format(*popt))
-
-            fitted = sigmoid(days, *popt)
-        except Exception as exc:
-            found_sigmoid = False
-
-        plt.plot(days, compared, ".", label="{}_raw".format(country))
-        if found_sigmoid:
-            plt.plot(days, fitted, label="{}_fitted".format(country))
-
-    # 'Opmaak'
-    plt.xticks(rotation=90)
-    plt.title(plot_title)
-    plt.ylabel("Amount of {} per 10000".format(comparison_e))
-    plt.xlabel("Days")
-
-    # Determines the amount of columns in the legend
-    if num_colors >= (f_y*3):
-        columns = num_colors//(f_y*3)
-    else:
-        columns = 1
-
-    plt.legend(bbox_to_anchor=(1.05, 1), loc=2, ncol=columns)
-
     # Determines the name of the folder to store the plots in.
     if all_countries:
         dir_name = "All_countries"
@@ -251,19 +254,81 @@ def plot_data(data, comparison, f_x=6, f_y=4, all_countries=False, plot_growth_r
     except Exception:
         pass
 
-    # Save the plot in the specific folder.
-    plt.savefig("{}/{}.png".format(dir_name, plot_title), bbox_inches="tight", dpi=100)
+    # Fits all the countries at once, spread over multiple processes.
+    # Countries with the same data as a previous run are taken from the fit cache,
+    # countries with new data start from their previous fit.
+    fit_cache = owid_fit.FitCache()
+    fit_history = owid_fit.FitHistory()
+    names = ["{}:{}:per_10000".format(country, comparison) for country in countries]
+    fits, counts = owid_fit.fit_incremental(names, [data.get(country) for country in countries], sigmoid,
+                                            fit_history, maxfev=max_fev, cache=fit_cache,
+                                            jac=sigmoid_jacobian, bounds=sigmoid_bounds)
+    print("Fits: {skipped} skipped, {warm} warm started, {cold} cold started".format(**counts))
+    print(fit_cache.summary())
+    fit_history.close()
+    fit_cache.close()
+
+    # Extra, to store the growth rates and their errors per country
+    growth_rate_per_country = {}
+    growth_error_per_country = {}
+    if plot_growth_rate and bootstrap:
+        errors = [error for error, count in owid_fit.bootstrap_fits(
+            [data.get(country) for country in countries], sigmoid, fits, maxfev=max_fev,
+            jac=sigmoid_jacobian, bounds=sigmoid_bounds)]
+    else:
+        errors = [owid_fit.standard_errors(pcov) for popt, pcov, status in fits]
+    for country, (popt, pcov, status), error in zip(countries, fits, errors):
+        if popt is not None:
+            growth_rate_per_country[country] = popt[2]
+            # No error bar if the error couldn't be estimated.
+            growth_error_per_country[country] = error[2] if error is not None and isfinite(error[2]) else nan
+            # print("L: {}, x0: {}, k: {}, b: {}".format(*popt))
+
+    # Not more points per country than the plot is wide in pixels, the fits used all of them.
+    shown = {country: owid_render.decimate_series(ax, *data.get(country)) for country in countries}
+
+    if fast:
+        plot_data_fast(fig, ax, shown, fits, comparison_e, plot_title, dir_name, rasterized)
+    else:
+        # Selects a colormap
+        cm = plt.get_cmap('tab20')
+        ax.set_prop_cycle('color', [cm(1.*i/num_colors) for i in range(num_colors)])
+
+        # Plots all the data and the fitting lines
+        for country, (popt, pcov, status) in zip(countries, fits):
+            days, compared = shown.get(country)
+
+            plt.plot(days, compared, ".", label="{}_raw".format(country))
+            if popt is not None:
+                fitted = sigmoid(days, *popt)
+                plt.plot(days, fitted, label="{}_fitted".format(country))
+
+        # 'Opmaak'
+        plt.xticks(rotation=90)
+        plt.title(plot_title)
+        plt.ylabel("Amount of {} per 10000".format(comparison_e))
+        plt.xlabel("Days")
+
+        # Determines the amount of columns in the legend
+        if num_colors >= (f_y*3):
+            columns = num_colors//(f_y*3)
+        else:
+            columns = 1
+
+        plt.legend(bbox_to_anchor=(1.05, 1), loc=2, ncol=columns)
+
+        # Save the plot in the specific folder, this also closes it.
+        owid_render.save_figure(fig, "{}/{}.png".format(dir_name, plot_title))
 
     # Entirely manual, for showing growth rates as a bar plot.
     if plot_growth_rate:
-        plt.close()
-
         fig, ax = plt.subplots(figsize=(30,8)) # *72 = pixels
 
         x_values = growth_rate_per_country.keys()
         num_colors = len(x_values)
 
-        bar_plot = plt.bar(x_values, growth_rate_per_country.values())
+        bar_plot = plt.bar(x_values, growth_rate_per_country.values(),
+                           yerr=list(growth_error_per_country.values()), ecolor="black", capsize=2)
         plt.xticks(fontsize=8, rotation=90)
         plt.title("Growth rate per country")
         plt.xlabel("Country code")
@@ -274,7 +339,38 @@ def plot_data(data, comparison, f_x=6, f_y=4, all_countries=False, plot_growth_r
         for i, bar in enumerate(bar_plot):
             bar.set_color(next(colors))
 
-        plt.savefig("{}/{}.png".format(dir_name, "Growth rate per country"), bbox_inches="tight", dpi=100)
+        owid_render.save_figure(fig, "{}/{}.png".format(dir_name, "Growth rate per country"))
+
+
+"""
+Fast path of plot_data(), the raw data of all countries as one scatter and the
+fitted lines as one LineCollection. The legend is saved as '<title> legend.png'.
+"""
+def plot_data_fast(fig, ax, data, fits, comparison_e, plot_title, dir_name, rasterized=False):
+    countries = list(data.keys())
+    # Same colours as the normal path, raw and fitted alternate.
+    colors = owid_render.series_colors(len(countries)*2)
+    raw_colors = colors[0::2]
+    fitted_colors = colors[1::2]
+
+    owid_render.draw_points(ax, [data.get(country) for country in countries], raw_colors, rasterized=rasterized)
+
+    fitted = []
+    for country, (popt, pcov, status) in zip(countries, fits):
+        if popt is not None:
+            days, compared = data.get(country)
+            fitted.append((days, sigmoid(days, *popt)))
+
+    has_fit = [popt is not None for popt, pcov, status in fits]
+    owid_render.draw_lines(ax, fitted, fitted_colors[has_fit], rasterized)
+
+    ax.set_title(plot_title)
+    ax.set_ylabel("Amount of {} per 10000".format(comparison_e))
+    ax.set_xlabel("Days")
+
+    # One entry per country, the fitted line has the next colour of the colormap.
+    owid_render.save_legend(countries, raw_colors, "{}/{} legend.png".format(dir_name, plot_title))
+    owid_render.save_figure(fig, "{}/{}.png".format(dir_name, plot_title), tight=False)
 
 
 
@@ -8,33 +8,80 @@ Assignment3: Making scatterplots and regression lines.
 """
 import matplotlib.pyplot as plt
 
+import sys
 from json import load
 from os import mkdir, path
-from scipy.optimize import curve_fit
 from scipy.stats import linregress
-from numpy import median, exp, linspace
-from pandas import DataFrame
+from numpy import arange, array, isfinite, isnan, linspace
+from time import perf_counter
+
+# The shared modules live in the folder above the assignments.
+sys.path.append(path.abspath(path.join(path.dirname(__file__), "..")))
+import owid_matrix
+import owid_table
+import owid_stats
+import owid_fit
+from owid_model import sigmoid, sigmoid_jacobian, sigmoid_bounds
+import owid_rate
+from owid_dataset import as_dataset
+import owid_cache
+import owid_render
+import owid_pipeline
 
 
 def main():
+    # Plots are only saved, not shown.
+    owid_render.use_agg()
     max_days = 150
     script_cwd = path.dirname(__file__)
     filepath = path.abspath(path.join(script_cwd, "..", "owid-covid-data.json"))
-
-    covid_data = get_data(filepath)
     
     metadata_columns =  ["population_density",
                          "median_age", "aged_65_older", "aged_70_older","gdp_per_capita","life_expectancy",
                          "human_development_index", "growth_rate", "death_rate"
                         ]
     
-    metadata, names = get_metadata(covid_data, metadata_columns, max_days)
+    # Every stage is checkpointed, only the countries and plots whose input changed are done again.
+    pipeline = owid_pipeline.Pipeline("assignment3")
+    
+    # load: the memory-mapped cache of the json file (see owid_cache), only built again after a download.
+    start = perf_counter()
+    rebuilt = owid_cache.is_stale(filepath)
+    dataset = owid_cache.load_dataset(filepath)
+    pipeline.ran("load", int(rebuilt), perf_counter() - start, int(not rebuilt))
+    
+    # extract, only when the data it reads changed.
+    table, series = pipeline.step("extract", extract_hash(dataset, metadata_columns, max_days),
+                                  lambda: extract_all(dataset, metadata_columns, max_days))
     
-    df = create_dataframe(metadata, names, metadata_columns)
+    # fit, only the countries whose data changed.
+    fit_inputs = {key: owid_pipeline.content_hash(cases, deaths, max_days) for key, (cases, deaths) in series.items()}
+    rates = pipeline.per_key("fit", fit_inputs, lambda keys: fit_countries(keys, series, max_days))
     
-    # Plot every item in 'metadata_columns' to the growth_rate and the death_rate
-    for item in metadata_columns:
-        plot_both(df, item, True)
+    metadata = table.copy()
+    for number, column in enumerate(["growth_rate", "growth_rate_se", "death_rate", "death_rate_se"]):
+        metadata[column] = array([rates[key][number] for key in metadata.index], dtype=float)
+    metadata = metadata[metadata["growth_rate"] != -1.0]
+    df = create_dataframe(metadata, list(metadata["location"]), metadata_columns)
+    
+    # analyse: regression lines and correlations of every pair of columns, calculated at once,
+    # with permutation p-values and bootstrap intervals of the correlations.
+    def analyse():
+        results = owid_stats.regressions(df, metadata_columns)
+        return owid_stats.resample(results, df, seed=0)
+    results = pipeline.step("analyse", owid_pipeline.content_hash(df), analyse)
+    results.to_csv("regressions.csv", index=False)
+    
+    # render: plot every item in 'metadata_columns' to the growth_rate and the death_rate,
+    # every plot is rendered in its own process. Only plots whose data changed or whose file is gone.
+    plot_inputs = {item: owid_pipeline.content_hash(df[plot_columns(df, item)], results[(results["x"] == item)])
+                   for item in metadata_columns}
+    def render(items):
+        owid_render.render_many(plot_both, [(df, item, True, results) for item in items], items)
+        return [path.abspath(plot_filename(item)) for item in items]
+    pipeline.per_key("render", plot_inputs, render, lambda item, filename: path.isfile(filename))
+    
+    print(pipeline.summary())
       
     # Calculates the correlation coefficient with Pandas
     # t = df.corr("human_development_index", "death_rate")
@@ -49,15 +96,72 @@ def main():
     #         plot_data_sc(df, item, "death_rate", "death_rate vs {}".format(item), "Death_Rate")
     
     
+"""
+The extract stage: the static metadata of every country (a DataFrame indexed by iso code)
+and a dict of iso code -> (total_cases, total_deaths) of the first 'max_days' days.
+"""
+def extract_all(dataset, metadata_columns, max_days):
+    keys = dataset.select()
+    static_columns = metadata_columns[0:len(metadata_columns)-2]
+    matrix, table = owid_table.extract(dataset, ["total_cases", "total_deaths"], static_columns, keys)
+    series = {key: (array(matrix.row("total_cases", key, max_days)), array(matrix.row("total_deaths", key, max_days)))
+              for key in keys}
+    return table, series
+
+
+"""
+Content hash of what extract_all() reads: the raw arrays of the cache and the static fields.
+Without a cache (the json file was parsed) it is None, then the extract stage always runs.
+"""
+def extract_hash(dataset, metadata_columns, max_days):
+    if dataset.cache is None:
+        return None
+    cache = dataset.cache
+    static_columns = metadata_columns[0:len(metadata_columns)-2]
+    static = [[cache.metadata[iso].get(column) for column in static_columns] for iso in cache.iso_codes]
+    return owid_pipeline.content_hash(str(cache.start_date), cache.iso_codes, cache.present,
+                                      [cache.values(metric) for metric in ("total_cases", "total_deaths")],
+                                      static, metadata_columns, max_days)
+
+
+"""
+The fit stage: fits the countries 'keys' of 'series' (see extract_all()).
+Returns per country (growth_rate, its standard error, death_rate, its standard error), NaN when unknown.
+"""
+def fit_countries(keys, series, max_days):
+    growth_rates, growth_errors, death_rates, death_errors = fit_rates(
+        keys, [series[key][0] for key in keys], [series[key][1] for key in keys], max_days)
+    return [tuple(float("nan") if value is None else value for value in rates)
+            for rates in zip(growth_rates, growth_errors, death_rates, death_errors)]
+
+
+"""
+The columns plot_both() uses for 'compare_col'.
+"""
+def plot_columns(df, compare_col):
+    columns = [compare_col, "growth_rate", "death_rate", "growth_rate_se", "death_rate_se"]
+    return [column for column in dict.fromkeys(columns) if column in df]
+
+
+"""
+File plot_both() saves the plot of 'compare_col' to.
+"""
+def plot_filename(compare_col):
+    return "GRDR/Growth and Death rate vs {}.png".format(compare_col)
+
+
 """ 
-Create the dataframe
+Create the dataframe, with the location names as index and the columns in the order of 'columns'.
+'metadata' is the table from get_metadata().
 """
 def create_dataframe(metadata, names, columns):
-    df = DataFrame(metadata)
-    df.columns = columns
-    df.index = names    
+    # The standard errors of the columns that have them, '<column>_se', are kept as well.
+    errors = [column + "_se" for column in columns if column + "_se" in metadata]
+    df = metadata[columns + errors].copy()
+    df.index = names
     return df
     
+
 """
 Loads the data from the json file
 """
@@ -67,36 +171,63 @@ def get_data(filename):
 
 
 """
-Get the total_cases data, the total_deaths data and the metadata
+Get the total_cases data, the total_deaths data and the metadata.
+Returns a DataFrame (one row per iso code, a column per metadata column) and the location names.
+With curve_fit the standard errors of the rates are added as '<rate column>_se', from the
+fits or with bootstrap=True from refitting every country (owid_fit.bootstrap_fits).
+
+method="curve_fit" fits a sigmoid per country, method="fast" uses the
+vectorized estimator from owid_rate, meant for screening many countries.
+'countries' limits it to a selection of countries.
+'covid_data' is the loaded json data or an OwidDataset on the cache (owid_cache.load_dataset).
 """
-def get_metadata(covid_data, metadata_columns, max_days):
-    metadata = []
-    names = []
+def get_metadata(covid_data, metadata_columns, max_days, method="curve_fit", countries=None, bootstrap=False):
+    # Iso codes or location names, None for all of them.
+    dataset = as_dataset(covid_data)
+    keys = dataset.select(countries)
 
-    for key, value in covid_data.items():
-        total_cases = extract_data(value, max_days, "total_cases")
-        total_deaths = extract_data(value, max_days, "total_deaths")
-    
-        growth_rate = get_rate(total_cases)
-        
-        if growth_rate != -1.0 and not None:
-            death_rate = get_rate(total_deaths)
-            names.append(value.get("location"))
+    # Both time series and the static metadata of all countries in one go.
+    static_columns = metadata_columns[0:len(metadata_columns)-2]
+    matrix, table = owid_table.extract(dataset, ["total_cases", "total_deaths"], static_columns, keys)
+
+    total_cases = [matrix.row("total_cases", key, max_days) for key in keys]
+    total_deaths = [matrix.row("total_deaths", key, max_days) for key in keys]
 
-            metadata_entries = [value.get(item) for item in metadata_columns[0:len(metadata_columns)-2]]
-            metadata_entries.append(growth_rate)
-            metadata_entries.append(death_rate)
+    if method == "fast":
+        growth_rates = get_fast_rates(total_cases)
+        death_rates = get_fast_rates(total_deaths)
+    else:
+        growth_rates, growth_errors, death_rates, death_errors = fit_rates(keys, total_cases, total_deaths, max_days, bootstrap)
 
-            metadata.append(metadata_entries)
+    # None (failed fit) becomes NaN.
+    table[metadata_columns[-2]] = array(growth_rates, dtype=float)
+    table[metadata_columns[-1]] = array(death_rates, dtype=float)
+    if method != "fast":
+        table[metadata_columns[-2] + "_se"] = array(growth_errors, dtype=float)
+        table[metadata_columns[-1] + "_se"] = array(death_errors, dtype=float)
+    table = table[table[metadata_columns[-2]] != -1.0]
 
-    return (metadata, names)
+    return (table, list(table["location"]))
 
 
-# https://stackoverflow.com/questions/55725139/fit-sigmoid-function-s-shape-curve-to-data-using-python
-# k = growth rate
-def sigmoid(x, L, x0, k, b):
-    y = L / (1 + exp(-k*(x-x0)))+b
-    return (y)
+"""
+Fits the total_cases and total_deaths of the countries 'keys'.
+Returns the growth rates, their standard errors, the death rates and their standard errors.
+"""
+def fit_rates(keys, total_cases, total_deaths, max_days, bootstrap=False):
+    # All the fits are done at once, spread over multiple processes.
+    # Countries with the same data as a previous run are taken from the fit cache.
+    # Countries with new data start from their previous fit.
+    fit_cache = owid_fit.FitCache()
+    fit_history = owid_fit.FitHistory()
+    case_names = ["{}:total_cases:{}".format(key, max_days) for key in keys]
+    death_names = ["{}:total_deaths:{}".format(key, max_days) for key in keys]
+    growth_rates, growth_errors = get_rates(total_cases, fit_cache, fit_history, case_names, True, bootstrap)
+    death_rates, death_errors = get_rates(total_deaths, fit_cache, fit_history, death_names, True, bootstrap)
+    print(fit_cache.summary())
+    fit_history.close()
+    fit_cache.close()
+    return growth_rates, growth_errors, death_rates, death_errors
 
 
 """
@@ -107,15 +238,55 @@ Used for the 'growth_rate' and 'death_rate' in this script.
 Returns None if there is any error when trying to calculate the curve.
 """
 def get_rate(data):
-    days = len(data)
-    try:
-        p0 = [max(data), median(days),1,min(data)]
-        popt, pcov = curve_fit(sigmoid, days, data, p0)
-        
-        return popt[2]
-    except Exception as exc:
-        print(exc.with_traceback(exc.__traceback__))
-        return None
+    return get_rates([data])[0]
+
+
+"""
+Calculates the growth rates of multiple datasets at once, see get_rate().
+The x values are the days, 0 up to the length of the dataset.
+An owid_fit.FitCache can be given to skip the datasets that have been fitted before.
+With an owid_fit.FitHistory and a name per dataset, changed datasets start from their previous fit.
+With errors=True the standard errors of the rates are returned as well, (rates, errors),
+from the covariance of the fits or with bootstrap=True from a residual bootstrap.
+"""
+def get_rates(datasets, cache=None, history=None, names=None, errors=False, bootstrap=False):
+    series = [(arange(len(data)), data) for data in datasets]
+    if history is None:
+        fits = owid_fit.fit_many(series, sigmoid, cache=cache, jac=sigmoid_jacobian, bounds=sigmoid_bounds)
+    else:
+        fits, counts = owid_fit.fit_incremental(names, series, sigmoid, history, cache=cache,
+                                                jac=sigmoid_jacobian, bounds=sigmoid_bounds)
+        print("Fits: {skipped} skipped, {warm} warm started, {cold} cold started".format(**counts))
+
+    rates = []
+    for popt, pcov, status in fits:
+        if popt is None:
+            print(status)
+            rates.append(None)
+        else:
+            rates.append(popt[2])
+
+    if not errors:
+        return rates
+
+    if bootstrap:
+        parameter_errors = [error for error, count in owid_fit.bootstrap_fits(
+            series, sigmoid, fits, jac=sigmoid_jacobian, bounds=sigmoid_bounds)]
+    else:
+        parameter_errors = [owid_fit.standard_errors(pcov) for popt, pcov, status in fits]
+    # No error if it couldn't be estimated.
+    rate_errors = [None if error is None or not isfinite(error[2]) else error[2] for error in parameter_errors]
+
+    return rates, rate_errors
+
+
+"""
+Estimates the growth rates of multiple datasets at once without curve fitting, see owid_rate.
+None if there is not enough data for a dataset.
+"""
+def get_fast_rates(datasets):
+    rates = owid_rate.growth_rates(owid_rate.pad_rows(datasets))
+    return [None if isnan(rate) else rate for rate in rates]
 
 
 """
@@ -123,23 +294,9 @@ Gets the 'total_cases' or 'total_deaths' data based on the specific datatype.
 None values are changed to the previous non-None value.
 """
 def extract_data(value, max_days, datatype):
-    cases = []
-        
-    for i, data in enumerate(value.get("data")):
-        if i >= max_days:
-            break
-        
-        tcd = data.get(datatype)
-        if not tcd == None:
-            cases.append(tcd)
-        else:
-            # First value can also be 'None', sets it to 0.0
-            try:
-                cases.append(cases[-1])
-            except IndexError:
-                cases.append(0.0)
+    _, cases = owid_matrix.country_series(value, datatype, max_days)
     
-    return cases
+    return list(cases)
 
 
 """
@@ -169,16 +326,37 @@ def plot_data_sc(df, col1, col2, plot_title, location=None):
             pass
         
         fig = plt.gcf() # Gets the current figure, needed to save.
-        fig.savefig("{}/{}.png".format(location, plot_title), bbox_inches="tight", dpi=100)
+        owid_render.save_figure(fig, "{}/{}.png".format(location, plot_title))
+
+
+"""
+Error bars of the 'y_col' points, if the DataFrame has its standard errors ('<y_col>_se').
+"""
+def plot_errors(ax, df, x_col, y_col, color):
+    if y_col + "_se" in df:
+        ax.errorbar(df[x_col], df[y_col], yerr=df[y_col + "_se"], fmt="none", ecolor=color, alpha=0.5)
+
+
+"""
+Legend label of a regression line, a row of the owid_stats tables.
+"""
+def regression_label(name, regression):
+    label = "{} Regression line\nCor. Coef: {:.4}, P-value: {:.4}".format(name, regression.r, regression.p_value)
+    if "p_permutation" in regression:
+        label += "\nPerm. p-value: {:.4}, 95% CI: [{:.3}, {:.3}]".format(regression.p_permutation, regression.r_low, regression.r_high)
+    return label
 
 
 """
 Plots the death_rate and growth_rates in the same plot, on different axis. Allows for easier comparisons.
 
-Uses scipy's linregress function to calculate the linear regression and the correlation coefficient (r_value).
+The linear regressions and correlation coefficients (r) are read from 'results', the table of
+owid_stats.regressions() and owid_stats.resample(), they are calculated for just this plot if it isn't given.
 """
-def plot_both(df, compare_col, save=False):
-    without_nan_df = df.dropna()  
+def plot_both(df, compare_col, save=False, results=None):
+    if results is None:
+        results = owid_stats.regressions(df, [compare_col, "growth_rate", "death_rate"])
+        results = owid_stats.resample(results, df, [(compare_col, "growth_rate"), (compare_col, "death_rate")])
     plot_title = "Growth and Death rate vs {}".format(compare_col)
     
     fig, (ax1, ax2) = plt.subplots(2,1, figsize=(8,8))
@@ -187,39 +365,41 @@ def plot_both(df, compare_col, save=False):
     
     ### Growth Rate ###
     ax1.scatter(df[compare_col], df["growth_rate"], color="tab:blue", label="Data points growth rate")
+    plot_errors(ax1, df, compare_col, "growth_rate", "tab:blue")
     
-    # Calculation of regression line and correlation coefficient
-    slope, intercept, r_value, p_value, std_err = linregress(without_nan_df[compare_col], without_nan_df["growth_rate"])
+    # Regression line and correlation coefficient
+    regression = owid_stats.pair(results, compare_col, "growth_rate")
     min_x, max_x = ax1.get_xlim()
     x = linspace(min_x, max_x)
     
     # Plotting
-    ax1.plot(x, intercept + slope*x, color="tab:orange", label='GR Regression line\nCor. Coef: {:.4}, P-value: {:.4}'.format(r_value, p_value))
+    ax1.plot(x, regression.intercept + regression.slope*x, color="tab:orange", label=regression_label("GR", regression))
     ax1.legend(bbox_to_anchor=(1.05, 1), loc=2)
     ax1.set(xlabel=compare_col, ylabel="growth_rate")
     
     ### Death Rate ###
     ax2.scatter(df[compare_col], df["death_rate"], color="tab:gray", label="Data points death rate")
+    plot_errors(ax2, df, compare_col, "death_rate", "tab:gray")
     
-    # Calculation of regression line and correlation coefficient
-    slope, intercept, r_value, p_value, std_err = linregress(without_nan_df[compare_col], without_nan_df["death_rate"])
+    # Regression line and correlation coefficient
+    regression = owid_stats.pair(results, compare_col, "death_rate")
     min_x, max_x = ax1.get_xlim()
     x = linspace(min_x, max_x)
     
     # Plotting
-    ax2.plot(x, intercept + slope*x, color="tab:red", label='DR Regression line\nCor. Coef: {:.4}, P-value: {:.4}'.format(r_value, p_value))
+    ax2.plot(x, regression.intercept + regression.slope*x, color="tab:red", label=regression_label("DR", regression))
     ax2.legend(bbox_to_anchor=(1.05, 1), loc=2)
     ax2.set(xlabel=compare_col, ylabel="death_rate")
     
     # Save the plot if needed
     if save:
-        save_location = "GRDR"
+        save_location = path.dirname(plot_filename(compare_col))
         try:
             mkdir(save_location)
         except Exception:
             pass
         
-        fig.savefig("{}/{}.png".format(save_location, plot_title), bbox_inches="tight", dpi=100)
+        owid_render.save_figure(fig, plot_filename(compare_col))
 
 
 
@@ -8,24 +8,41 @@ Assignment4: Clustering of scatterplot data
 """
 import matplotlib.pyplot as plt
 
+import sys
 from json import load
 from os import mkdir, path
-from scipy.optimize import curve_fit
-from scipy.stats import linregress
+from numpy import arange, array, convolve, isfinite, isnan, nan_to_num, ones, where
 from scipy.cluster import hierarchy
-from numpy import median, exp
-from pandas import DataFrame
+from scipy.spatial.distance import squareform
+from time import perf_counter
+
+# The shared modules live in the folder above the assignments.
+sys.path.append(path.abspath(path.join(path.dirname(__file__), "..")))
+import owid_matrix
+import owid_table
+import owid_stats
+import owid_cluster
+import owid_dtw
+import owid_fit
+from owid_model import sigmoid, sigmoid_jacobian, sigmoid_bounds
+import owid_rate
+from owid_dataset import as_dataset
+import owid_cache
+import owid_render
 
 
 """
 Main function
 """
 def main():
+    # Plots are only saved, not shown.
+    owid_render.use_agg()
     max_days = 150
     script_cwd = path.dirname(__file__)
     filepath = path.abspath(path.join(script_cwd, "..", "owid-covid-data.json"))
 
-    covid_data = get_data(filepath)
+    # The memory-mapped cache of the json file (see owid_cache), only parsed again after a download.
+    covid_data = owid_cache.load_dataset(filepath)
     
     metadata_columns =  ["population_density",
                          "median_age", "aged_65_older", "aged_70_older","gdp_per_capita","life_expectancy",
@@ -40,14 +57,22 @@ def main():
     # Change 'False' to 'True' if the plot needs to be saved.
     # A list of countries to be ignored can de added.
     dn = cluster(df, "population_density", "growth_rate", False)
+    
+    # Clustering on all columns, standardized:
+    # dn = cluster(df, "population_density", "growth_rate", False, columns=metadata_columns)
+    
+    # Clustering on the shape of the new_cases curves:
+    # dn = shape_cluster(covid_data, "new_cases", False)
 
 
 """ 
-Create the dataframe
+Create the dataframe, with the location names as index and the columns in the order of 'columns'.
+'metadata' is the table from get_metadata().
 """
 def create_dataframe(metadata, names, columns):
-    df = DataFrame(metadata)
-    df.columns = columns
+    # The standard errors of the columns that have them, '<column>_se', are kept as well.
+    errors = [column + "_se" for column in columns if column + "_se" in metadata]
+    df = metadata[columns + errors].copy()
     df.index = names
     return df
     
@@ -61,36 +86,54 @@ def get_data(filename):
 
 
 """
-Get the total_cases data, the total_deaths data and the metadata
-"""
-def get_metadata(covid_data, metadata_columns, max_days):
-    metadata = []
-    names = []
+Get the total_cases data, the total_deaths data and the metadata.
+Returns a DataFrame (one row per iso code, a column per metadata column) and the location names.
+With curve_fit the standard errors of the rates are added as '<rate column>_se', from the
+fits or with bootstrap=True from refitting every country (owid_fit.bootstrap_fits).
 
-    for key, value in covid_data.items():
-        total_cases = extract_data(value, max_days, "total_cases")
-        total_deaths = extract_data(value, max_days, "total_deaths")
-    
-        growth_rate = get_rate(total_cases)
-        
-        if growth_rate != -1.0 and not None:
-            death_rate = get_rate(total_deaths)
-            names.append(value.get("location"))
+method="curve_fit" fits a sigmoid per country, method="fast" uses the
+vectorized estimator from owid_rate, meant for screening many countries.
+'countries' limits it to a selection of countries.
+'covid_data' is the loaded json data or an OwidDataset on the cache (owid_cache.load_dataset).
+"""
+def get_metadata(covid_data, metadata_columns, max_days, method="curve_fit", countries=None, bootstrap=False):
+    # Iso codes or location names, None for all of them.
+    dataset = as_dataset(covid_data)
+    keys = dataset.select(countries)
 
-            metadata_entries = [value.get(item) for item in metadata_columns[0:len(metadata_columns)-2]]
-            metadata_entries.append(growth_rate)
-            metadata_entries.append(death_rate)
+    # Both time series and the static metadata of all countries in one go.
+    static_columns = metadata_columns[0:len(metadata_columns)-2]
+    matrix, table = owid_table.extract(dataset, ["total_cases", "total_deaths"], static_columns, keys)
 
-            metadata.append(metadata_entries)
+    total_cases = [matrix.row("total_cases", key, max_days) for key in keys]
+    total_deaths = [matrix.row("total_deaths", key, max_days) for key in keys]
 
-    return (metadata, names)
+    if method == "fast":
+        growth_rates = get_fast_rates(total_cases)
+        death_rates = get_fast_rates(total_deaths)
+    else:
+        # All the fits are done at once, spread over multiple processes.
+        # Countries with the same data as a previous run are taken from the fit cache.
+        # Countries with new data start from their previous fit.
+        fit_cache = owid_fit.FitCache()
+        fit_history = owid_fit.FitHistory()
+        case_names = ["{}:total_cases:{}".format(key, max_days) for key in keys]
+        death_names = ["{}:total_deaths:{}".format(key, max_days) for key in keys]
+        growth_rates, growth_errors = get_rates(total_cases, fit_cache, fit_history, case_names, True, bootstrap)
+        death_rates, death_errors = get_rates(total_deaths, fit_cache, fit_history, death_names, True, bootstrap)
+        print(fit_cache.summary())
+        fit_history.close()
+        fit_cache.close()
 
+    # None (failed fit) becomes NaN.
+    table[metadata_columns[-2]] = array(growth_rates, dtype=float)
+    table[metadata_columns[-1]] = array(death_rates, dtype=float)
+    if method != "fast":
+        table[metadata_columns[-2] + "_se"] = array(growth_errors, dtype=float)
+        table[metadata_columns[-1] + "_se"] = array(death_errors, dtype=float)
+    table = table[table[metadata_columns[-2]] != -1.0]
 
-# https://stackoverflow.com/questions/55725139/fit-sigmoid-function-s-shape-curve-to-data-using-python
-# k = growth rate
-def sigmoid(x, L, x0, k, b):
-    y = L / (1 + exp(-k*(x-x0)))+b
-    return (y)
+    return (table, list(table["location"]))
 
 
 """
@@ -101,15 +144,55 @@ Used for the 'growth_rate' and 'death_rate' in this script.
 Returns None if there is any error when trying to calculate the curve.
 """
 def get_rate(data):
-    days = len(data)
-    try:
-        p0 = [max(data), median(days),1,min(data)]
-        popt, pcov = curve_fit(sigmoid, days, data, p0)
-        
-        return popt[2]
-    except Exception as exc:
-        print(exc.with_traceback(exc.__traceback__))
-        return None
+    return get_rates([data])[0]
+
+
+"""
+Calculates the growth rates of multiple datasets at once, see get_rate().
+The x values are the days, 0 up to the length of the dataset.
+An owid_fit.FitCache can be given to skip the datasets that have been fitted before.
+With an owid_fit.FitHistory and a name per dataset, changed datasets start from their previous fit.
+With errors=True the standard errors of the rates are returned as well, (rates, errors),
+from the covariance of the fits or with bootstrap=True from a residual bootstrap.
+"""
+def get_rates(datasets, cache=None, history=None, names=None, errors=False, bootstrap=False):
+    series = [(arange(len(data)), data) for data in datasets]
+    if history is None:
+        fits = owid_fit.fit_many(series, sigmoid, cache=cache, jac=sigmoid_jacobian, bounds=sigmoid_bounds)
+    else:
+        fits, counts = owid_fit.fit_incremental(names, series, sigmoid, history, cache=cache,
+                                                jac=sigmoid_jacobian, bounds=sigmoid_bounds)
+        print("Fits: {skipped} skipped, {warm} warm started, {cold} cold started".format(**counts))
+
+    rates = []
+    for popt, pcov, status in fits:
+        if popt is None:
+            print(status)
+            rates.append(None)
+        else:
+            rates.append(popt[2])
+
+    if not errors:
+        return rates
+
+    if bootstrap:
+        parameter_errors = [error for error, count in owid_fit.bootstrap_fits(
+            series, sigmoid, fits, jac=sigmoid_jacobian, bounds=sigmoid_bounds)]
+    else:
+        parameter_errors = [owid_fit.standard_errors(pcov) for popt, pcov, status in fits]
+    # No error if it couldn't be estimated.
+    rate_errors = [None if error is None or not isfinite(error[2]) else error[2] for error in parameter_errors]
+
+    return rates, rate_errors
+
+
+"""
+Estimates the growth rates of multiple datasets at once without curve fitting, see owid_rate.
+None if there is not enough data for a dataset.
+"""
+def get_fast_rates(datasets):
+    rates = owid_rate.growth_rates(owid_rate.pad_rows(datasets))
+    return [None if isnan(rate) else rate for rate in rates]
 
 
 """
@@ -117,37 +200,32 @@ Gets the 'total_cases' or 'total_deaths' data based on the specific datatype.
 None values are changed to the previous non-None value.
 """
 def extract_data(value, max_days, datatype):
-    cases = []
-        
-    for i, data in enumerate(value.get("data")):
-        if i >= max_days:
-            break
-        
-        tcd = data.get(datatype)
-        if not tcd == None:
-            cases.append(tcd)
-        else:
-            # First value can also be 'None', sets it to 0.0
-            try:
-                cases.append(cases[-1])
-            except IndexError:
-                cases.append(0.0)
+    _, cases = owid_matrix.country_series(value, datatype, max_days)
     
-    return cases
+    return list(cases)
 
 
 """
 Clustering of the data, based on which columns are specified.
 Allows for removal of datapoints in the form of a list, specific by the country name.
 'remove = ["Monaco", "Singapore"]'
+
+The scatter plot shows col1 vs col2. The clustering uses col1 and col2 as they are, or
+with 'columns' (e.g. all metadata_columns) those columns standardized, see owid_cluster.
+Large dendrograms are truncated to the top 'leaves' clusters (owid_cluster.DENDROGRAM_LEAVES).
 """
-def cluster(df, col1, col2, save=False, remove=None):
-    df = df.fillna(0.0)
-    
+def cluster(df, col1, col2, save=False, remove=None, columns=None, leaves=None):
     # Removes specified countries from the dataframe.
     if remove:
         df = df.drop(remove)
     
+    if columns is None:
+        features = df[[col1, col2]].fillna(0.0).to_numpy()
+    else:
+        features = owid_cluster.standardize(df[columns])
+    
+    df = df.fillna(0.0)
+    
     # Selection of data
     x = df[col1]
     y = df[col2]
@@ -159,9 +237,11 @@ def cluster(df, col1, col2, save=False, remove=None):
     fig, (ax1, ax2) = plt.subplots(1,2, figsize=(36,24), gridspec_kw={'width_ratios': [3, 1]}) # Width, Height
     
     # Making of the dendrogram and calculation of the correlation coefficient.
-    link = hierarchy.linkage(xy, "ward")
-    dn = hierarchy.dendrogram(link, labels=xy.index, orientation="left")
-    slope, intercept, r_value, p_value, std_err = linregress(x,y)
+    link, leaf_labels, _ = owid_cluster.cluster(features, list(xy.index))
+    dn = owid_cluster.dendrogram(link, leaf_labels, leaves, orientation="left")
+    # Correlation with a permutation p-value and a bootstrap interval, see owid_stats.
+    results = owid_stats.resample(owid_stats.regressions(df, [col1, col2]), df, [(col1, col2)])
+    regression = owid_stats.pair(results, col1, col2)
     
     # Plotting
     fig.suptitle(plot_title)
@@ -169,7 +249,11 @@ def cluster(df, col1, col2, save=False, remove=None):
     ax2.set(xlabel="Location", ylabel="distances", title="Dendrogram")
 
     ax1.scatter(x, y)
-    ax1.set(xlabel=col1, ylabel=col2, title="Scatter plot, Corr: {:.4}, p-value: {:.4}".format(r_value, p_value))
+    # Error bars if the standard errors of col2 are known ('<col2>_se').
+    if col2 + "_se" in df:
+        ax1.errorbar(x, y, yerr=df[col2 + "_se"], fmt="none", alpha=0.5)
+    ax1.set(xlabel=col1, ylabel=col2, title="Scatter plot, Corr: {:.4}, p-value: {:.4}\nPerm. p-value: {:.4}, 95% CI: [{:.3}, {:.3}]".format(
+        regression.r, regression.p_value, regression.p_permutation, regression.r_low, regression.r_high))
     for i, txt in enumerate(xy.index):
         ax1.annotate(txt, (x.iloc[i], y.iloc[i]))
      
@@ -181,11 +265,69 @@ def cluster(df, col1, col2, save=False, remove=None):
         except Exception:
             pass
         
-        fig.savefig("{}/{}.png".format(save_location, plot_title), bbox_inches="tight", dpi=200)
+        owid_render.save_figure(fig, "{}/{}.png".format(save_location, plot_title), dpi=200)
+    else:
+        plt.close(fig)
     
     return dn
     
        
+"""
+Clustering of the countries on the shape of their 'metric' curves (new_cases by default).
+The curves are smoothed over 'smooth' days and scaled to a maximum of 1, so only their shape counts.
+The distances are DTW distances with a band of 'window' days (see owid_dtw), linked with average linkage.
+"""
+def shape_cluster(covid_data, metric="new_cases", save=False, countries=None, window=14, smooth=7, leaves=None):
+    dataset = as_dataset(covid_data)
+    keys = dataset.select(countries, exclude_aggregates=True)
+    matrix = dataset.matrix([metric], keys)
+    
+    # Country x day matrix, days without a record count as 0.
+    curves = nan_to_num(matrix.values[metric])
+    curves = convolve_rows(curves, smooth)
+    peaks = curves.max(axis=1, keepdims=True)
+    curves = curves / where(peaks > 0, peaks, 1.0)
     
+    # The linkage needs the exact distance of every pair, pruning (owid_dtw) is only
+    # exact for the nearest neighbours.
+    start = perf_counter()
+    distances, n_exact = owid_dtw.dtw_matrix(curves, window, prune=False)
+    if n_exact is None:
+        print("DTW distances from the cache, {:.2f} s".format(perf_counter() - start))
+    else:
+        print("DTW distances: {} pairs, {:.2f} s".format(n_exact, perf_counter() - start))
+    
+    link = hierarchy.linkage(squareform(distances, checks=False), "average")
+    labels = [dataset[key]["location"] for key in keys]
+    
+    plot_title = "Dendrogram of the shape of {}".format(metric)
+    fig, ax = plt.subplots(figsize=(12, max(6, len(keys)*0.15)))
+    dn = owid_cluster.dendrogram(link, labels, leaves, orientation="left", ax=ax)
+    ax.set(xlabel="DTW distance", title=plot_title)
+    
+    if save:
+        save_location = "Clustering"
+        try:
+            mkdir(save_location)
+        except Exception:
+            pass
+        
+        owid_render.save_figure(fig, "{}/{}.png".format(save_location, plot_title))
+    else:
+        plt.close(fig)
+    
+    return dn
+
+
+"""
+Moving average of every row over 'days' days, the same length as the rows.
+"""
+def convolve_rows(values, days):
+    if days <= 1:
+        return values
+    kernel = ones(days) / days
+    return array([convolve(row, kernel, mode="same") for row in values])
+
+
 if __name__ == "__main__":
     main()   
\ No newline at end of file
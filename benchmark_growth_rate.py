@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the speed and the results of the two growth rate methods of Assignment 3/4:
+the sigmoid fit per country (curve_fit) and the vectorized estimator (owid_rate).
+
+The fit cache is not used, so every run fits everything.
+Usage: python benchmark_growth_rate.py [path/to/owid-covid-data.json] [max_days]
+"""
+import sys
+
+from os import path
+from time import perf_counter
+from numpy import array, isfinite, nan, median, abs as np_abs, corrcoef
+from scipy.stats import spearmanr
+
+sys.path.append(path.join(path.dirname(path.abspath(__file__)), "Assignment3"))
+import assignment3
+import owid_fit
+import owid_matrix
+import owid_stream
+
+
+def main():
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    else:
+        filename = path.join(path.dirname(path.abspath(__file__)), "owid-covid-data.json")
+    max_days = int(sys.argv[2]) if len(sys.argv) > 2 else 150
+
+    covid_data = owid_stream.get_data(filename, fields=["location", "total_cases", "total_deaths"])
+    matrix = owid_matrix.build_matrix(covid_data, ["total_cases"])
+    datasets = [matrix.row("total_cases", key, max_days) for key in matrix.iso_codes]
+    print("{} countries, first {} days".format(len(datasets), max_days))
+
+    # Sigmoid fits, in one process and in the process pool.
+    serial_rates, serial_time = timed(lambda: fitted_rates(datasets, 1))
+    pool_rates, pool_time = timed(lambda: fitted_rates(datasets, None))
+    fast_rates, fast_time = timed(lambda: assignment3.get_fast_rates(datasets))
+
+    print("curve_fit, 1 process:   {:.3f} s".format(serial_time))
+    print("curve_fit, pool:        {:.3f} s".format(pool_time))
+    print("fast estimator:         {:.4f} s ({:.0f}x faster than 1 process)".format(
+        fast_time, serial_time / max(fast_time, 1e-9)))
+
+    compare(to_array(serial_rates), to_array(fast_rates))
+
+
+"""
+Runs 'function', returns its result and the time it took in seconds.
+"""
+def timed(function):
+    start = perf_counter()
+    result = function()
+    return result, perf_counter() - start
+
+
+"""
+get_rates() of Assignment 3 with a specific amount of workers and without cache.
+"""
+def fitted_rates(datasets, workers):
+    owid_fit.WORKERS = workers
+    try:
+        return assignment3.get_rates(datasets)
+    finally:
+        owid_fit.WORKERS = None
+
+
+def to_array(rates):
+    return array([nan if rate is None else rate for rate in rates], dtype=float)
+
+
+"""
+Prints how well the fast rates agree with the fitted ones, on the countries both methods have a rate for.
+"""
+def compare(fitted, fast):
+    both = isfinite(fitted) & isfinite(fast)
+    print("Rates from both methods: {} of {}".format(both.sum(), len(fitted)))
+    if both.sum() < 3:
+        return
+
+    pearson = corrcoef(fitted[both], fast[both])[0, 1]
+    spearman = spearmanr(fitted[both], fast[both]).correlation
+    relative = median(np_abs(fast[both] - fitted[both]) / np_abs(fitted[both]))
+
+    print("Pearson r: {:.3f}, Spearman rho: {:.3f}, median relative difference: {:.1%}".format(
+        pearson, spearman, relative))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar on-disk cache of owid-covid-data.json.
+
+The JSON file is parsed once (after a download) and written next to it as a
+folder of numpy arrays:
+    index.json      - date axis, iso codes, metric names, static country fields and
+                      the other tables that were merged in (see owid_fetch)
+    present.npy     - bool, countries x days, True where the country has a record
+    <metric>.npy    - float64, countries x days, NaN where the value is missing
+
+Later runs memory-map these arrays instead of parsing the JSON again.
+The cache is rebuilt automatically when the JSON file is newer.
+load_dataset() is what the assignments use, an OwidDataset on the cache.
+"""
+import numpy as np
+
+from json import load, dump
+from os import path, replace, mkdir, stat
+from shutil import rmtree
+
+from owid_dataset import OwidDataset
+from owid_matrix import dense_arrays
+
+CACHE_SUFFIX = ".cache"
+CACHE_VERSION = 1
+
+
+"""
+Folder the cache of 'filename' is stored in.
+"""
+def cache_dir(filename):
+    base, _ = path.splitext(path.abspath(filename))
+    return base + CACHE_SUFFIX
+
+
+"""
+Size and modification time of the source file, stored in the index to detect changes.
+"""
+def _source_stamp(filename):
+    info = stat(filename)
+    return {"size": info.st_size, "mtime": info.st_mtime}
+
+
+"""
+True if the cache is missing, of an older version or was built from another
+version of the JSON file.
+"""
+def is_stale(filename):
+    index_file = path.join(cache_dir(filename), "index.json")
+    if not path.isfile(index_file):
+        return True
+
+    with open(index_file) as index_handle:
+        index = load(index_handle)
+
+    if index.get("version") != CACHE_VERSION:
+        return True
+
+    return index.get("source") != _source_stamp(filename)
+
+
+"""
+Metric names are all the record fields that hold numbers somewhere in the data.
+"""
+def _find_metrics(covid_data):
+    metrics = {}
+    for value in covid_data.values():
+        for record in value.get("data", []):
+            for key, item in record.items():
+                if isinstance(item, (int, float)) and not isinstance(item, bool):
+                    metrics[key] = None
+    return list(metrics)
+
+
+"""
+Parses the JSON file (unless 'covid_data' is already loaded) and writes the cache.
+The cache is written to a temporary folder first and then swapped in, so a
+crash halfway never leaves a half written cache behind.
+'extras' are the names of the other tables merged into 'covid_data' (see owid_fetch).
+"""
+def build_cache(filename, covid_data=None, extras=()):
+    if covid_data is None:
+        with open(filename) as json_file:
+            covid_data = load(json_file)
+
+    metrics = _find_metrics(covid_data)
+    countries = [iso for iso, value in covid_data.items() if value.get("data")]
+    iso_codes, start_date, present, values = dense_arrays(covid_data, metrics, countries)
+    n_days = present.shape[1]
+    metadata = {iso: {key: item for key, item in covid_data[iso].items() if key != "data"} for iso in iso_codes}
+
+    target = cache_dir(filename)
+    temp_target = target + ".tmp"
+    if path.isdir(temp_target):
+        rmtree(temp_target)
+    mkdir(temp_target)
+
+    np.save(path.join(temp_target, "present.npy"), present)
+    for metric in metrics:
+        np.save(path.join(temp_target, "{}.npy".format(metric)), values[metric])
+
+    index = {"version": CACHE_VERSION,
+             "source": _source_stamp(filename),
+             "start_date": str(start_date),
+             "n_days": n_days,
+             "iso_codes": iso_codes,
+             "metrics": metrics,
+             "metadata": metadata,
+             "extras": list(extras)}
+
+    # The index is written last, it marks the cache as complete.
+    with open(path.join(temp_target, "index.json"), "w") as index_handle:
+        dump(index, index_handle)
+
+    if path.isdir(target):
+        rmtree(target)
+    replace(temp_target, target)
+
+    return target
+
+
+"""
+Builds the cache if it is stale. Returns True if it was (re)built.
+"""
+def ensure_cache(filename):
+    if is_stale(filename):
+        build_cache(filename)
+        return True
+    return False
+
+
+"""
+Read only view on the cache. The arrays are memory-mapped, only the
+parts that are actually used get read from disk.
+"""
+class OwidCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+        with open(path.join(directory, "index.json")) as index_handle:
+            index = load(index_handle)
+
+        self.iso_codes = index["iso_codes"]
+        self.metrics = index["metrics"]
+        self.metadata = index["metadata"]
+        self.extras = index.get("extras", [])
+        self.start_date = np.datetime64(index["start_date"], "D")
+        self.dates = self.start_date + np.arange(index["n_days"])
+        self.present = np.load(path.join(directory, "present.npy"), mmap_mode="r")
+
+        self.rows = {iso: row for row, iso in enumerate(self.iso_codes)}
+        self._values = {}
+
+    """
+    The countries x days array of a metric, NaN where missing.
+    """
+    def values(self, metric):
+        if metric not in self._values:
+            if metric not in self.metrics:
+                raise KeyError(metric)
+            self._values[metric] = np.load(path.join(self.directory, "{}.npy".format(metric)), mmap_mode="r")
+        return self._values[metric]
+
+    """
+    The dates and values of a metric for one country, only the days the country has a record for.
+    """
+    def row(self, metric, iso_code):
+        row = self.rows[iso_code]
+        mask = np.asarray(self.present[row])
+        return self.dates[mask], np.asarray(self.values(metric)[row])[mask]
+
+
+"""
+Opens the cache of 'filename', (re)building it first if it is stale.
+"""
+def load_cache(filename, rebuild=True):
+    if rebuild:
+        ensure_cache(filename)
+    return OwidCache(cache_dir(filename))
+
+
+"""
+OwidDataset of 'filename' on the memory-mapped cache, (re)built first if it is stale.
+Only when the cache can't be built or read (e.g. a read-only folder) the JSON file is parsed instead.
+"""
+def load_dataset(filename):
+    try:
+        cache = load_cache(filename)
+    except OSError as exc:
+        print("No cache ({}), parsing {}".format(exc, filename))
+        with open(filename) as json_file:
+            return OwidDataset(load(json_file))
+    return OwidDataset(cache.metadata, cache)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Hierarchical clustering of many rows on many columns.
+
+    standardize()       - every column to mean 0 and standard deviation 1, missing values become 0 (the mean)
+    ward_linkage()      - Ward linkage with the nearest-neighbour-chain algorithm on the cluster
+                          centroids, memory grows with n instead of n*n like a distance matrix.
+                          Gives the same linkage matrix as scipy.cluster.hierarchy.linkage(X, "ward").
+    minibatch_kmeans()  - k-means on random batches of rows, for when n is too large for a linkage
+    cluster()           - linkage for up to LINKAGE_MAX_ROWS rows, above that k-means to KMEANS_CLUSTERS
+                          clusters first and the linkage of their centroids (weighted by their size)
+    dendrogram()        - scipy's dendrogram, truncated to the top DENDROGRAM_LEAVES clusters
+
+cluster() also reports the runtime and the peak memory that was allocated (tracemalloc).
+"""
+import numpy as np
+import tracemalloc
+
+from scipy.cluster import hierarchy
+from time import perf_counter
+
+# Defaults, can be changed by the scripts using this module.
+LINKAGE_MAX_ROWS = 5000
+KMEANS_CLUSTERS = 256
+KMEANS_BATCH_SIZE = 1024
+KMEANS_ITERATIONS = 100
+DENDROGRAM_LEAVES = 250
+
+
+"""
+Standardizes every column of 'values' (rows x columns), NaN becomes 0.0.
+Columns without any variation become 0.0 as well.
+"""
+def standardize(values):
+    values = np.asarray(values, dtype=float)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.nanmean(values, axis=0)
+        deviations = np.nanstd(values, axis=0)
+        standardized = (values - means) / deviations
+    standardized[~np.isfinite(standardized)] = 0.0
+    return standardized
+
+
+"""
+Ward linkage of the rows of 'values' with the nearest-neighbour-chain algorithm.
+'sizes' are the amount of points every row stands for (1 each if None), for rows that are centroids.
+Returns a scipy linkage matrix.
+"""
+def ward_linkage(values, sizes=None):
+    centroids = np.array(values, dtype=float)
+    n = len(centroids)
+    sizes = np.ones(n) if sizes is None else np.array(sizes, dtype=float)
+    if n < 2:
+        return np.empty((0, 4))
+
+    active = np.ones(n, dtype=bool)
+    merges = []
+    chain = []
+    while len(merges) < n - 1:
+        if not chain:
+            chain.append(int(np.argmax(active)))
+        a = chain[-1]
+
+        # Ward distance from cluster 'a' to all active clusters at once.
+        distances = np.sqrt(2 * sizes[a] * sizes / (sizes[a] + sizes)) * np.linalg.norm(centroids - centroids[a], axis=1)
+        distances[~active] = np.inf
+        distances[a] = np.inf
+        b = int(np.argmin(distances))
+        # On a tie the previous cluster of the chain is preferred, otherwise the chain can cycle.
+        if len(chain) > 1 and distances[chain[-2]] <= distances[b]:
+            b = chain[-2]
+
+        if len(chain) > 1 and b == chain[-2]:
+            # 'a' and 'b' are each other's nearest neighbours, the merged cluster takes the place of 'a'.
+            chain = chain[:-2]
+            merges.append((a, b, distances[b]))
+            total = sizes[a] + sizes[b]
+            centroids[a] = (sizes[a]*centroids[a] + sizes[b]*centroids[b]) / total
+            sizes[a] = total
+            active[b] = False
+        else:
+            chain.append(b)
+
+    return _linkage_matrix(merges, n)
+
+
+"""
+Puts the merges of ward_linkage() in order of distance and numbers the clusters like scipy does:
+the rows are 0..n-1, the cluster made by merge i is n+i. The last column is the amount of rows in it.
+"""
+def _linkage_matrix(merges, n):
+    order = sorted(range(len(merges)), key=lambda i: merges[i][2])
+    # Union-find of the rows, 'label' of a root is the current cluster number of its set.
+    parent = np.arange(n)
+    label = np.arange(n)
+    count = np.ones(n)
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    link = np.empty((len(merges), 4))
+    for number, i in enumerate(order):
+        a, b, distance = merges[i]
+        root_a, root_b = root(a), root(b)
+        first, second = sorted((label[root_a], label[root_b]))
+        parent[root_b] = root_a
+        label[root_a] = n + number
+        count[root_a] += count[root_b]
+        link[number] = (first, second, distance, count[root_a])
+    return link
+
+
+"""
+Index of the nearest center of every row, in chunks so the distances never take much memory.
+"""
+def nearest_centers(values, centers, chunk_size=10000):
+    nearest = np.empty(len(values), dtype=int)
+    center_norms = (centers**2).sum(axis=1)
+    for start in range(0, len(values), chunk_size):
+        chunk = values[start:start+chunk_size]
+        # |x - c|^2 without the |x|^2 term, it's the same for every center.
+        nearest[start:start+chunk_size] = np.argmin(center_norms - 2 * chunk @ centers.T, axis=1)
+    return nearest
+
+
+"""
+k-means++ starting centers, from a sample of the rows.
+"""
+def _initial_centers(values, k, rng):
+    sample = values[rng.choice(len(values), size=min(len(values), 20*k), replace=False)]
+    centers = [sample[rng.integers(len(sample))]]
+    distances = ((sample - centers[0])**2).sum(axis=1)
+    for _ in range(1, k):
+        total = distances.sum()
+        index = rng.choice(len(sample), p=distances/total) if total > 0 else rng.integers(len(sample))
+        centers.append(sample[index])
+        distances = np.minimum(distances, ((sample - centers[-1])**2).sum(axis=1))
+    return np.array(centers)
+
+
+"""
+Mini-batch k-means: every iteration moves the centers towards a random batch of rows, with
+a step that gets smaller the more rows a center has seen. 'seed' makes it reproducible.
+Returns the centers and the index of the center of every row; centers without rows are left out.
+"""
+def minibatch_kmeans(values, k, batch_size=None, iterations=None, seed=0):
+    if batch_size is None:
+        batch_size = KMEANS_BATCH_SIZE
+    if iterations is None:
+        iterations = KMEANS_ITERATIONS
+    values = np.asarray(values, dtype=float)
+    rng = np.random.default_rng(seed)
+
+    centers = _initial_centers(values, min(k, len(values)), rng)
+    seen = np.zeros(len(centers))
+    for _ in range(iterations):
+        batch = values[rng.integers(0, len(values), size=min(batch_size, len(values)))]
+        nearest = nearest_centers(batch, centers)
+
+        counts = np.bincount(nearest, minlength=len(centers))
+        sums = np.zeros_like(centers)
+        np.add.at(sums, nearest, batch)
+        seen += counts
+        moved = counts > 0
+        centers[moved] += (sums[moved] - counts[moved, None]*centers[moved]) / seen[moved, None]
+
+    nearest = nearest_centers(values, centers)
+    used = np.unique(nearest)
+    renumber = np.full(len(centers), -1)
+    renumber[used] = np.arange(len(used))
+    return centers[used], renumber[nearest]
+
+
+"""
+Clusters the rows of 'values' (already standardized if needed), see the module docstring.
+Returns the linkage matrix, the labels of its leaves and per row the leaf it belongs to.
+With the linkage on all rows the leaves are the rows themselves, after k-means they are
+the k-means clusters, labelled with their first label and their size.
+"""
+def cluster(values, labels=None, method="auto", seed=0):
+    values = np.asarray(values, dtype=float)
+    if labels is None:
+        labels = [str(i) for i in range(len(values))]
+    labels = list(labels)
+    if method == "auto":
+        method = "linkage" if len(values) <= LINKAGE_MAX_ROWS else "kmeans"
+
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = perf_counter()
+
+    if method == "linkage":
+        link = ward_linkage(values)
+        leaf_labels = labels
+        leaves = np.arange(len(values))
+    elif method == "kmeans":
+        centers, leaves = minibatch_kmeans(values, KMEANS_CLUSTERS, seed=seed)
+        sizes = np.bincount(leaves, minlength=len(centers))
+        link = ward_linkage(centers, sizes)
+        first = np.full(len(centers), -1)
+        first[leaves[::-1]] = np.arange(len(leaves))[::-1]
+        leaf_labels = ["{} ({})".format(labels[row], size) for row, size in zip(first, sizes)]
+    else:
+        raise ValueError("Unknown clustering method {!r}, use 'auto', 'linkage' or 'kmeans'".format(method))
+
+    seconds = perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    if not tracing:
+        tracemalloc.stop()
+    print("Clustering: {} rows, {} columns, {}: {:.2f} s, peak memory {:.1f} MB".format(
+        len(values), values.shape[1] if values.ndim == 2 else 1, method, seconds, peak / (1 << 20)))
+
+    return link, leaf_labels, leaves
+
+
+"""
+scipy's dendrogram of a linkage, with more than 'leaves' leaves only the top 'leaves' clusters are drawn.
+"""
+def dendrogram(link, labels, leaves=None, **options):
+    if leaves is None:
+        leaves = DENDROGRAM_LEAVES
+    if len(labels) > leaves:
+        return hierarchy.dendrogram(link, truncate_mode="lastp", p=leaves, labels=labels, **options)
+    return hierarchy.dendrogram(link, labels=labels, **options)
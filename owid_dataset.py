@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Country lookups on the loaded OWID data.
+
+OwidDataset keeps three indexes next to the data, so selecting countries takes
+constant time per lookup instead of searching through a list:
+    iso code  -> row (position in the file)
+    location  -> iso code
+    continent -> rows
+
+With the columnar cache (see owid_cache.load_dataset) the data is only the static fields
+of every country, without the records, and matrix() reads the memory-mapped arrays
+instead of walking the records.
+
+OWID also has aggregate entries (World, continents, income groups), their iso
+codes start with 'OWID_' and they have no continent. They can be left out with
+exclude_aggregates=True.
+"""
+import numpy as np
+
+from random import choice
+
+import owid_matrix
+
+AGGREGATE_PREFIX = "OWID_"
+
+
+"""
+'data' as an OwidDataset, the loaded json data gets wrapped, an OwidDataset is returned as it is.
+"""
+def as_dataset(data):
+    if isinstance(data, OwidDataset):
+        return data
+    return OwidDataset(data)
+
+
+class OwidDataset:
+    def __init__(self, covid_data, cache=None):
+        self.data = covid_data
+        self.cache = cache
+        self.iso_codes = list(covid_data.keys())
+
+        self.rows = {}
+        self.by_location = {}
+        self.by_continent = {}
+        for row, iso_code in enumerate(self.iso_codes):
+            country = covid_data[iso_code]
+            self.rows[iso_code] = row
+            self.by_location[country.get("location")] = iso_code
+            self.by_continent.setdefault(country.get("continent"), []).append(row)
+
+    def __len__(self):
+        return len(self.iso_codes)
+
+    def __contains__(self, iso_code):
+        return iso_code in self.rows
+
+    def __getitem__(self, iso_code):
+        return self.data[iso_code]
+
+    """
+    The data of a country, None if the iso code doesn't exist.
+    """
+    def get(self, iso_code):
+        return self.data.get(iso_code)
+
+    def row(self, iso_code):
+        return self.rows[iso_code]
+
+    """
+    The filled countries x days matrices of 'metrics' (see owid_matrix) of the 'countries' (iso codes, all if None),
+    from the cache if there is one.
+    """
+    def matrix(self, metrics, countries=None):
+        if self.cache is not None:
+            return owid_matrix.from_cache(self.cache, metrics, countries)
+        return owid_matrix.build_matrix(self.data, metrics, countries)
+
+    """
+    The earliest date of any country, numpy datetime64.
+    """
+    def start_date(self):
+        if self.cache is not None:
+            return self.cache.start_date
+        first_dates = [value["data"][0]["date"] for value in self.data.values() if value.get("data")]
+        return np.array(first_dates, dtype="datetime64[D]").min()
+
+    """
+    Iso code of a location name, e.g. "Netherlands" -> "NLD".
+    """
+    def iso(self, location):
+        return self.by_location[location]
+
+    def is_aggregate(self, iso_code):
+        return iso_code.startswith(AGGREGATE_PREFIX)
+
+    """
+    Iso codes of all the countries in a continent, in file order.
+    """
+    def continent(self, name):
+        return [self.iso_codes[row] for row in self.by_continent.get(name, [])]
+
+    """
+    A random iso code.
+    """
+    def random(self, exclude_aggregates=False):
+        return choice(self.select(exclude_aggregates=exclude_aggregates))
+
+    """
+    Iso codes of a selection, in the order of 'countries' (file order if None):
+    'countries' - iso codes or location names, None for everything
+    'continent' - only the countries in this continent
+    Unknown countries are left out.
+    """
+    def select(self, countries=None, continent=None, exclude_aggregates=False):
+        if countries is None:
+            rows = range(len(self.iso_codes))
+        else:
+            rows = []
+            seen = set()
+            for country in countries:
+                row = self.rows.get(country, self.rows.get(self.by_location.get(country)))
+                if row is not None and row not in seen:
+                    seen.add(row)
+                    rows.append(row)
+
+        if continent is not None:
+            in_continent = set(self.by_continent.get(continent, []))
+            rows = [row for row in rows if row in in_continent]
+
+        selected = [self.iso_codes[row] for row in rows]
+        if exclude_aggregates:
+            selected = [iso_code for iso_code in selected if not self.is_aggregate(iso_code)]
+        return selected
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Downsampling of time series for plotting.
+
+A plot of ~1200 pixels wide can't show more than ~1200 points per series, so longer
+series are reduced to about that amount of points while keeping their shape:
+    "lttb"   - Largest-Triangle-Three-Buckets, per bucket the point that forms the
+               largest triangle with the point chosen before and the next bucket's mean
+    "minmax" - per bucket the lowest and the highest point, keeps every peak
+Both return the indexes of the points to keep, the first and last point are always kept.
+"""
+import numpy as np
+
+METHODS = ("lttb", "minmax")
+
+
+"""
+x as numbers, dates (datetime64 or 'YYYY-MM-DD' strings) become days.
+"""
+def _numeric(x):
+    x = np.asarray(x)
+    if x.dtype.kind in "US":
+        x = x.astype("datetime64[D]")
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype("datetime64[D]").astype(float)
+    return x.astype(float)
+
+
+"""
+Bucket edges for the points between the first and the last one.
+"""
+def _bucket_edges(n_points, n_buckets):
+    return np.linspace(1, n_points - 1, n_buckets + 1).astype(int)
+
+
+"""
+Indexes of the 'n_out' points chosen by Largest-Triangle-Three-Buckets.
+"""
+def lttb(x, y, n_out):
+    x = _numeric(x)
+    y = np.asarray(y, dtype=float)
+    n_points = len(y)
+    if n_out >= n_points or n_out < 3:
+        return np.arange(n_points)
+
+    edges = _bucket_edges(n_points, n_out - 2)
+    # Mean of every bucket, the last 'bucket' is the last point.
+    sums_x = np.add.reduceat(x[:-1], edges[:-1])
+    sums_y = np.add.reduceat(y[:-1], edges[:-1])
+    counts = np.diff(edges)
+    mean_x = np.append(sums_x / counts, x[-1])
+    mean_y = np.append(sums_y / counts, y[-1])
+
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n_points - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket+1]
+        # Twice the triangle area, for every point in the bucket at once.
+        area = np.abs((x[previous] - mean_x[bucket+1]) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (mean_y[bucket+1] - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[bucket+1] = previous
+
+    return selected
+
+
+"""
+Indexes of the lowest and highest point of 'n_out'/2 buckets, in order, plus the first and last point.
+"""
+def minmax(x, y, n_out):
+    y = np.asarray(y, dtype=float)
+    n_points = len(y)
+    n_buckets = (n_out - 2) // 2
+    if n_out >= n_points or n_buckets < 1:
+        return np.arange(n_points)
+
+    edges = _bucket_edges(n_points, n_buckets)
+    starts = edges[:-1]
+    lengths = np.diff(edges)
+
+    # Position of the min and max within every bucket, with the buckets as padded rows.
+    width = lengths.max()
+    columns = np.arange(width)
+    inside = columns[None, :] < lengths[:, None]
+    index = np.minimum(starts[:, None] + columns[None, :], n_points - 1)
+    values = y[index]
+    lowest = np.argmin(np.where(inside, values, np.inf), axis=1)
+    highest = np.argmax(np.where(inside, values, -np.inf), axis=1)
+
+    kept = np.concatenate(([0], starts + lowest, starts + highest, [n_points - 1]))
+    return np.unique(kept)
+
+
+"""
+Indexes of the points to draw of a series, at most about 'n_out'.
+"""
+def decimate(x, y, n_out, method="lttb"):
+    if method == "lttb":
+        return lttb(x, y, n_out)
+    if method == "minmax":
+        return minmax(x, y, n_out)
+    raise ValueError("Unknown decimation method {!r}, use one of {}".format(method, METHODS))
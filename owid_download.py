@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Conditional, streaming and atomic download of a data file.
+
+download() asks the server for the file only if it changed since the last download:
+the ETag and Last-Modified of that download are sent back (If-None-Match,
+If-Modified-Since), the server answers 304 Not Modified when nothing changed.
+
+The headers are only sent when the file still is what was downloaded (its size and
+sha256 match the manifest), a file that was changed or damaged since is downloaded again.
+
+A new version is streamed to a temporary file next to the target in chunks of
+CHUNK_SIZE bytes, its sha256 is calculated on the way. Only a complete download
+(as long as the Content-Length, if the server sent one) replaces the target,
+with os.replace(), so readers see either the old or the new file, never a part of one.
+
+Every download writes a small manifest next to the file, '<file>.manifest.json':
+    url, etag, last_modified, sha256, size, downloaded (UTC time)
+"""
+from datetime import datetime, timezone
+from hashlib import sha256
+from json import dump, load
+from os import fsync, path, remove, replace
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+MANIFEST_SUFFIX = ".manifest.json"
+
+# Defaults, can be changed by the scripts using this module.
+CHUNK_SIZE = 1 << 20    # bytes
+TIMEOUT = 60            # seconds without data before giving up
+
+
+"""
+File the manifest of 'filename' is stored in.
+"""
+def manifest_file(filename):
+    return path.abspath(filename) + MANIFEST_SUFFIX
+
+
+"""
+The manifest of the last download of 'filename', an empty dict if there is none.
+"""
+def read_manifest(filename):
+    try:
+        with open(manifest_file(filename)) as manifest_handle:
+            return load(manifest_handle)
+    except Exception:
+        return {}
+
+
+"""
+Writes the manifest of 'filename', via a temporary file like the data itself.
+"""
+def _write_manifest(filename, manifest):
+    target = manifest_file(filename)
+    with open(target + ".tmp", "w") as manifest_handle:
+        dump(manifest, manifest_handle, indent=1)
+    replace(target + ".tmp", target)
+
+
+"""
+sha256 of a file, read in chunks.
+"""
+def file_sha256(filename, chunk_size=None):
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    checksum = sha256()
+    with open(filename, "rb") as data_file:
+        for chunk in iter(lambda: data_file.read(chunk_size), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+"""
+True if 'filename' is still the file the manifest was written for.
+"""
+def is_intact(filename, manifest):
+    if not path.isfile(filename) or path.getsize(filename) != manifest.get("size"):
+        return False
+    return file_sha256(filename) == manifest.get("sha256")
+
+
+"""
+Downloads 'url' to 'filename' if it changed since the last download, see the module docstring.
+Returns True if a new version was downloaded, False if the file was up to date.
+Errors (network, HTTP, an incomplete download) are raised, the old file stays as it is then.
+"""
+def download(url, filename, chunk_size=None, timeout=None):
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    if timeout is None:
+        timeout = TIMEOUT
+
+    # The manifest only counts for the file it was written for.
+    manifest = read_manifest(filename)
+    headers = {}
+    if manifest.get("url") == url and is_intact(filename, manifest):
+        if manifest.get("etag"):
+            headers["If-None-Match"] = manifest["etag"]
+        if manifest.get("last_modified"):
+            headers["If-Modified-Since"] = manifest["last_modified"]
+
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=timeout)
+    except HTTPError as error:
+        if error.code == 304:
+            return False
+        raise
+
+    temp_filename = path.abspath(filename) + ".part"
+    checksum = sha256()
+    size = 0
+    try:
+        with response, open(temp_filename, "wb") as temp_file:
+            if response.status == 304:
+                return False
+            expected = response.headers.get("Content-Length")
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                temp_file.write(chunk)
+                checksum.update(chunk)
+                size += len(chunk)
+            if expected is not None and size != int(expected):
+                raise IOError("Incomplete download of {}: {} of {} bytes".format(url, size, expected))
+            temp_file.flush()
+            fsync(temp_file.fileno())
+
+        replace(temp_filename, filename)
+    finally:
+        if path.exists(temp_filename):
+            remove(temp_filename)
+
+    _write_manifest(filename, {"url": url,
+                               "etag": response.headers.get("ETag"),
+                               "last_modified": response.headers.get("Last-Modified"),
+                               "sha256": checksum.hexdigest(),
+                               "size": size,
+                               "downloaded": datetime.now(timezone.utc).isoformat(timespec="seconds")})
+    return True
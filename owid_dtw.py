@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Dynamic time warping (DTW) distances between the curves of all countries.
+
+The warping path is limited to a Sakoe-Chiba band of 'window' days around the
+diagonal. DTW is computed for many pairs of curves at once: the dynamic
+programming runs over the days of the band, every step is one numpy operation
+over a chunk of pairs. The chunks are spread over a process pool.
+
+LB_Keogh, a lower bound of DTW that only needs the envelope of a curve, is used
+to skip the pairs that are certainly not near each other (prune=True):
+    1. DTW for the 'neighbours' pairs with the lowest lower bound of every curve
+    2. DTW for every other pair whose lower bound is below the distance of the
+       'neighbours'-th nearest curve found in 1.
+The nearest 'neighbours' curves of every curve get their exact distance, the
+pairs that are skipped get their lower bound (which is larger than that).
+So a pruned matrix is only right for nearest-neighbour lookups (nearest_neighbours()),
+a linkage of it would average the lower bounds into its merges. For a linkage
+use prune=False, all pairs get their exact DTW distance then.
+
+The distance matrices are cached on disk (CACHE_DIR), keyed on the curves and the
+settings, exact and pruned matrices in differently named files.
+"""
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+from os import cpu_count, mkdir, path
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Defaults, can be changed by the scripts using this module.
+WORKERS = None      # None = one process per cpu, 1 = everything in this process
+CHUNK_SIZE = 2000   # Pairs per job
+NEIGHBOURS = 10
+CACHE_DIR = path.join(path.dirname(path.abspath(__file__)), "dtw-cache")
+
+
+"""
+DTW distance of every pair of rows (a[p], b[p]), all rows have the same length.
+"""
+def dtw_pairs(a, b, window):
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    n_pairs, length = a.shape
+    window = max(int(window), 0)
+
+    previous = np.full((n_pairs, length), np.inf)
+    current = np.full((n_pairs, length), np.inf)
+    for i in range(length):
+        first = max(0, i - window)
+        last = min(length - 1, i + window)
+        cost = (a[:, i, None] - b[:, first:last+1])**2
+
+        current.fill(np.inf)
+        for offset, j in enumerate(range(first, last + 1)):
+            if i == 0 and j == 0:
+                best = 0.0
+            else:
+                best = previous[:, j]
+                if j > 0:
+                    best = np.minimum(best, np.minimum(previous[:, j-1], current[:, j-1]))
+            current[:, j] = cost[:, offset] + best
+        previous, current = current, previous
+
+    return np.sqrt(previous[:, length-1])
+
+
+"""
+Upper and lower envelope of every row, the max and min within 'window' days.
+"""
+def envelopes(curves, window):
+    padded = np.pad(curves, ((0, 0), (window, window)), mode="edge")
+    windows = sliding_window_view(padded, 2*window + 1, axis=1)
+    return windows.max(axis=2), windows.min(axis=2)
+
+
+"""
+LB_Keogh lower bound of the DTW distance of every pair of rows, symmetric (n x n).
+"""
+def lb_keogh_matrix(curves, window, chunk_size=64):
+    curves = np.asarray(curves, dtype=float)
+    upper, lower = envelopes(curves, window)
+    bounds = np.empty((len(curves), len(curves)))
+    for start in range(0, len(curves), chunk_size):
+        chunk = curves[start:start+chunk_size, None, :]
+        above = np.maximum(chunk - upper[None, :, :], 0.0)
+        below = np.maximum(lower[None, :, :] - chunk, 0.0)
+        bounds[start:start+chunk_size] = np.sqrt((above**2 + below**2).sum(axis=2))
+    # Both directions are lower bounds, the larger one is the tighter one.
+    return np.maximum(bounds, bounds.T)
+
+
+"""
+Unpacks one chunk of pairs for the process pool.
+"""
+def _dtw_job(job):
+    return dtw_pairs(*job)
+
+
+"""
+Exact DTW distance of the (row, column) pairs, in chunks over the process pool.
+"""
+def _dtw_many(curves, rows, columns, window, workers):
+    jobs = [(curves[rows[start:start+CHUNK_SIZE]], curves[columns[start:start+CHUNK_SIZE]], window)
+            for start in range(0, len(rows), CHUNK_SIZE)]
+    if workers <= 1 or len(jobs) <= 1:
+        distances = [_dtw_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            distances = list(executor.map(_dtw_job, jobs))
+    return np.concatenate(distances) if distances else np.empty(0)
+
+
+"""
+File in CACHE_DIR of a distance matrix.
+"""
+def _cache_file(curves, window, prune, neighbours):
+    key = sha1(np.ascontiguousarray(curves, dtype=float).tobytes())
+    # 'neighbours' only changes a pruned matrix.
+    key.update(repr((curves.shape, window, neighbours if prune else None)).encode())
+    return path.join(CACHE_DIR, "{}.{}.npy".format(key.hexdigest(), "pruned" if prune else "exact"))
+
+
+"""
+DTW distance matrix (n x n) of the rows of 'curves', see the module docstring.
+Returns the matrix and the amount of pairs that got their exact distance (None if it came from the cache).
+"""
+def dtw_matrix(curves, window, prune=True, neighbours=None, workers=None, cache=True):
+    curves = np.asarray(curves, dtype=float)
+    if neighbours is None:
+        neighbours = NEIGHBOURS
+    if workers is None:
+        workers = WORKERS if WORKERS is not None else cpu_count() or 1
+    n = len(curves)
+
+    filename = _cache_file(curves, window, prune, neighbours)
+    if cache and path.exists(filename):
+        distances = np.load(filename)
+        return distances, None
+
+    upper_rows, upper_columns = np.triu_indices(n, 1)
+    if prune and n - 1 > neighbours:
+        bounds = lb_keogh_matrix(curves, window)
+        distances = bounds.copy()
+        exact = np.zeros((n, n), dtype=bool)
+        np.fill_diagonal(exact, True)
+
+        # 1. The pairs with the lowest lower bounds of every curve.
+        np.fill_diagonal(bounds, np.inf)
+        nearest = np.argsort(bounds, axis=1)[:, :neighbours]
+        candidates = np.zeros((n, n), dtype=bool)
+        candidates[np.repeat(np.arange(n), neighbours), nearest.ravel()] = True
+        _fill(distances, exact, candidates | candidates.T, curves, window, workers)
+
+        # 2. Pairs that could still be nearer than the 'neighbours'-th nearest curve.
+        known = np.where(exact, distances, np.inf)
+        np.fill_diagonal(known, np.inf)
+        threshold = np.sort(known, axis=1)[:, neighbours-1]
+        candidates = (bounds < threshold[:, None]) | (bounds < threshold[None, :])
+        _fill(distances, exact, candidates & ~exact, curves, window, workers)
+        n_exact = int(exact[upper_rows, upper_columns].sum())
+    else:
+        distances = np.zeros((n, n))
+        values = _dtw_many(curves, upper_rows, upper_columns, window, workers)
+        distances[upper_rows, upper_columns] = values
+        distances[upper_columns, upper_rows] = values
+        n_exact = len(upper_rows)
+
+    np.fill_diagonal(distances, 0.0)
+    if cache:
+        try:
+            mkdir(CACHE_DIR)
+        except Exception:
+            pass
+        np.save(filename, distances)
+    return distances, n_exact
+
+
+"""
+The 'neighbours' nearest curves of every curve and their DTW distances (both n x neighbours,
+nearest first), from the pruned matrix: all of these are exact distances.
+"""
+def nearest_neighbours(curves, window, neighbours=None, workers=None, cache=True):
+    if neighbours is None:
+        neighbours = NEIGHBOURS
+    neighbours = min(neighbours, len(curves) - 1)
+    distances, n_exact = dtw_matrix(curves, window, True, neighbours, workers, cache)
+
+    others = distances.copy()
+    np.fill_diagonal(others, np.inf)
+    nearest = np.argsort(others, axis=1, kind="stable")[:, :neighbours]
+    return nearest, np.take_along_axis(others, nearest, axis=1)
+
+
+"""
+Computes the exact distance of the 'pairs' (a symmetric mask) into 'distances' and marks them in 'exact'.
+"""
+def _fill(distances, exact, pairs, curves, window, workers):
+    rows, columns = np.nonzero(np.triu(pairs, 1))
+    values = _dtw_many(curves, rows, columns, window, workers)
+    distances[rows, columns] = values
+    distances[columns, rows] = values
+    exact[rows, columns] = True
+    exact[columns, rows] = True
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Fetches the other OWID tables (vaccinations, testing, hospitalisations) and merges
+them into the per-country data of owid-covid-data.json.
+
+fetch_all() downloads several sources at the same time with asyncio: at most
+'connections' downloads run at once (a semaphore), every download runs in a
+thread (asyncio.to_thread with urllib). Failed downloads are retried up to
+'retries' times with an increasing delay, client errors (4xx) are not retried.
+'progress' is called with a line of text for every finished, retried or failed download.
+
+Every source has a parser that turns the downloaded bytes into
+{iso_code: {date: {field: value}}}. merge() adds those fields to the records of
+the same date of the same country, in the structure get_data() returns:
+    {iso_code: {"location": ..., ..., "data": [{"date": ..., field: value}, ...]}}
+Dates without a record are left out, unless add_dates=True (the tables often start
+before the first case, new records would move the first 'max_days' records of a
+country). Countries that aren't in the data are left out, they have no metadata
+(the OWID tables also contain regions and sub-national entities).
+
+update_owid_json.check_data() merges the tables into the data of the columnar
+cache (see owid_cache), so the assignments get the extra metrics from there.
+"""
+import asyncio
+
+from csv import DictReader
+from io import StringIO
+from json import loads
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+# Defaults, can be changed by the scripts using this module.
+CONNECTIONS = 4     # Downloads at the same time
+RETRIES = 3         # Extra attempts after a failed download
+BACKOFF = 1.0       # Seconds before the first retry, doubles every retry
+TIMEOUT = 60        # seconds without data before giving up
+
+SOURCE_BASE = "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/"
+
+# Column names of the testing table -> fields of owid-covid-data.json.
+TESTING_FIELDS = {"Cumulative total": "total_tests",
+                  "Daily change in cumulative total": "new_tests",
+                  "Cumulative total per thousand": "total_tests_per_thousand",
+                  "Daily change in cumulative total per thousand": "new_tests_per_thousand",
+                  "7-day smoothed daily change": "new_tests_smoothed",
+                  "7-day smoothed daily change per thousand": "new_tests_smoothed_per_thousand",
+                  "Short-term positive rate": "positive_rate",
+                  "Short-term tests per case": "tests_per_case"}
+
+# Indicators of the hospitalisation table -> fields of owid-covid-data.json.
+HOSPITAL_FIELDS = {"Daily ICU occupancy": "icu_patients",
+                   "Daily ICU occupancy per million": "icu_patients_per_million",
+                   "Daily hospital occupancy": "hosp_patients",
+                   "Daily hospital occupancy per million": "hosp_patients_per_million",
+                   "Weekly new ICU admissions": "weekly_icu_admissions",
+                   "Weekly new ICU admissions per million": "weekly_icu_admissions_per_million",
+                   "Weekly new hospital admissions": "weekly_hosp_admissions",
+                   "Weekly new hospital admissions per million": "weekly_hosp_admissions_per_million"}
+
+
+"""
+A number from a table cell, None for an empty or non-numeric one.
+"""
+def _number(text):
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+"""
+A field name for an indicator that isn't in the mapping: lower case with underscores.
+"""
+def _field_name(name):
+    return "_".join(name.lower().replace("-", " ").split())
+
+
+"""
+vaccinations.json: a list of countries with their records, like owid-covid-data.json.
+"""
+def parse_vaccinations(content):
+    table = {}
+    for country in loads(content):
+        dates = table.setdefault(country["iso_code"], {})
+        for record in country.get("data", []):
+            dates.setdefault(record["date"], {}).update(
+                {key: value for key, value in record.items() if key != "date" and value is not None})
+    return table
+
+
+"""
+covid-testing-all-observations.csv: a row per entity and date. Some countries have more than
+one entity (tests performed, people tested), the first one of a country is used.
+"""
+def parse_testing(content):
+    table = {}
+    entities = {}
+    for row in DictReader(StringIO(content.decode("utf-8"))):
+        iso_code = row.get("ISO code")
+        if not iso_code or entities.setdefault(iso_code, row["Entity"]) != row["Entity"]:
+            continue
+        fields = {field: _number(row.get(column)) for column, field in TESTING_FIELDS.items()}
+        table.setdefault(iso_code, {})[row["Date"]] = {field: value for field, value in fields.items() if value is not None}
+    return table
+
+
+"""
+covid-hospitalizations.csv: a row per country, date and indicator.
+"""
+def parse_hospitalisations(content):
+    table = {}
+    for row in DictReader(StringIO(content.decode("utf-8"))):
+        value = _number(row.get("value"))
+        if not row.get("iso_code") or value is None:
+            continue
+        field = HOSPITAL_FIELDS.get(row["indicator"]) or _field_name(row["indicator"])
+        table.setdefault(row["iso_code"], {}).setdefault(row["date"], {})[field] = value
+    return table
+
+
+# Name -> (url, parser)
+SOURCES = {"vaccinations": (SOURCE_BASE + "vaccinations/vaccinations.json", parse_vaccinations),
+           "testing": (SOURCE_BASE + "testing/covid-testing-all-observations.csv", parse_testing),
+           "hospitalisations": (SOURCE_BASE + "hospitalizations/covid-hospitalizations.csv", parse_hospitalisations)}
+
+
+"""
+Downloads 'url' in one go (runs in a thread).
+"""
+def _get(url, timeout):
+    with urlopen(url, timeout=timeout) as response:
+        return response.read()
+
+
+"""
+Downloads one source with retries, at most 'connections' at the same time (the semaphore).
+"""
+async def _fetch(name, url, semaphore, retries, timeout, progress):
+    async with semaphore:
+        for attempt in range(retries + 1):
+            start = perf_counter()
+            try:
+                content = await asyncio.to_thread(_get, url, timeout)
+                progress("{}: {:.1f} MB in {:.2f} s".format(name, len(content) / (1 << 20), perf_counter() - start))
+                return content
+            except Exception as error:
+                # A client error doesn't get better by asking again.
+                if attempt == retries or (isinstance(error, HTTPError) and 400 <= error.code < 500):
+                    progress("{}: failed, {}".format(name, error))
+                    raise
+                delay = BACKOFF * 2**attempt
+                progress("{}: {}, retrying in {:.1f} s".format(name, error, delay))
+                await asyncio.sleep(delay)
+
+
+"""
+Downloads and parses the 'sources' (name -> (url, parser), SOURCES if None) at the same time.
+Returns name -> {iso_code: {date: {field: value}}}. With strict=False a source that
+can't be downloaded is left out instead of raising the error.
+"""
+async def fetch_all(sources=None, connections=None, retries=None, timeout=None, progress=print, strict=True):
+    if sources is None:
+        sources = SOURCES
+    connections = CONNECTIONS if connections is None else connections
+    retries = RETRIES if retries is None else retries
+    timeout = TIMEOUT if timeout is None else timeout
+
+    semaphore = asyncio.Semaphore(connections)
+    names = list(sources)
+    start = perf_counter()
+    downloads = await asyncio.gather(*[_fetch(name, sources[name][0], semaphore, retries, timeout, progress)
+                                       for name in names], return_exceptions=True)
+
+    tables = {}
+    for name, content in zip(names, downloads):
+        if isinstance(content, BaseException):
+            if strict:
+                raise content
+            continue
+        tables[name] = sources[name][1](content)
+    progress("Fetched {} of {} sources in {:.2f} s".format(len(tables), len(names), perf_counter() - start))
+    return tables
+
+
+"""
+Adds the fields of the 'tables' (see fetch_all()) to 'covid_data', on (iso_code, date).
+With add_dates=True dates without a record get a new one, otherwise they are left out.
+'covid_data' is changed in place and returned.
+"""
+def merge(covid_data, tables, add_dates=False):
+    for table in tables.values():
+        for iso_code, dates in table.items():
+            country = covid_data.get(iso_code)
+            if country is None:
+                continue
+            records = country.setdefault("data", [])
+            by_date = {record["date"]: record for record in records}
+            added = False
+            for date, fields in dates.items():
+                record = by_date.get(date)
+                if record is None:
+                    if not add_dates:
+                        continue
+                    record = by_date[date] = {"date": date}
+                    records.append(record)
+                    added = True
+                record.update(fields)
+            if added:
+                records.sort(key=lambda record: record["date"])
+    return covid_data
+
+
+"""
+fetch_all() for code that doesn't use asyncio itself.
+"""
+def fetch_tables(sources=None, **options):
+    return asyncio.run(fetch_all(sources, **options))
+
+
+"""
+Fetches the 'sources' (SOURCES if None) and merges them into 'covid_data', see fetch_all() and merge().
+"""
+def fetch_and_merge(covid_data, sources=None, add_dates=False, **options):
+    return merge(covid_data, fetch_tables(sources, **options), add_dates)
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+Batch curve fitting for many countries at once.
+
+fit_many() fits the same model to a list of (x, y) series and returns one
+(popt, pcov, status) tuple per series, in the same order as the input.
+The fits are spread over a process pool, 'workers' and 'chunksize' set the
+amount of processes and the amount of series each process gets at a time.
+workers=1 fits everything in the current process.
+
+status is "ok" for a successful fit, otherwise the error message and popt, pcov are None.
+The default starting point is owid_model.sigmoid_p0, with 'jac' and 'bounds' (see
+owid_model) the fit uses the analytic Jacobian and stays within the bounds.
+
+With a FitCache the results are also stored on disk, keyed on the series, the
+model, p0 and maxfev. Series that have been fitted before are not fitted again.
+
+fit_incremental() is for series that grow a little with every data update. It keeps
+the previous result of every named series (country and metric) in a FitHistory.
+Unchanged series are skipped, changed ones are fitted starting from the previous popt
+(warm start), new ones or ones without a usable previous fit start from p0 (cold start).
+
+Uncertainty of the fitted parameters:
+    standard_errors()  - from pcov, the square root of its diagonal
+    bootstrap_fits()   - residual bootstrap, every fit is repeated on its fitted curve plus
+                         resampled residuals. The refits are spread over the process pool
+                         in rounds (every series gets a batch per round) until all are done
+                         or the time budget is used, so all series get about as many refits.
+"""
+import numpy as np
+import sqlite3
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from hashlib import sha1
+from os import cpu_count, path
+from scipy.optimize import curve_fit
+from time import perf_counter
+
+from owid_model import sigmoid_p0
+
+# Defaults, can be changed by the scripts using this module.
+WORKERS = None      # None = one process per cpu
+CHUNKSIZE = 8
+CACHE_FILE = path.join(path.dirname(path.abspath(__file__)), "fit-cache.sqlite")
+CACHE_MAX_ENTRIES = 20000
+BOOTSTRAP_SAMPLES = 100     # Refits per series
+BOOTSTRAP_BATCH = 10        # Refits per job
+BOOTSTRAP_SECONDS = 60.0    # Time budget of bootstrap_fits() for all series together
+
+
+"""
+Fits 'model' to one series, errors are returned as the status instead of raised.
+'jac' is the analytic Jacobian of the model (None = finite differences), 'bounds'
+a function of (x, y) that returns the (lower, upper) parameter bounds (None = no bounds).
+"""
+def fit_one(model, x, y, p0=None, maxfev=None, jac=None, bounds=None):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    try:
+        if p0 is None:
+            p0 = sigmoid_p0(x, y)
+
+        options = {}
+        if jac is not None:
+            options["jac"] = jac
+        if bounds is not None:
+            lower, upper = bounds(x, y)
+            options["bounds"] = (lower, upper)
+            # The starting point has to be within the bounds, a previous fit might not be.
+            p0 = np.clip(np.asarray(p0, dtype=float), lower, upper)
+            if maxfev is not None:
+                options["max_nfev"] = maxfev
+        elif maxfev is not None:
+            options["maxfev"] = maxfev
+
+        popt, pcov = curve_fit(model, x, y, p0, **options)
+        return popt, pcov, "ok"
+    except Exception as exc:
+        return None, None, str(exc)
+
+
+"""
+Unpacks one job for the process pool.
+"""
+def _fit_job(job):
+    return fit_one(*job)
+
+
+"""
+Identifies a model by its name and its code, so a changed model doesn't reuse old fits.
+"""
+def _model_id(model):
+    if model is None:
+        return "None"
+    code = model.__code__
+    return "{}:{}:{}".format(model.__qualname__, code.co_code.hex(), repr(code.co_consts))
+
+
+"""
+Cache key of one fit.
+"""
+def fit_key(model, x, y, p0=None, maxfev=None, jac=None, bounds=None):
+    key = sha1()
+    for function in (model, jac, bounds):
+        key.update(_model_id(function).encode())
+    key.update(np.ascontiguousarray(x, dtype=float).tobytes())
+    key.update(b"|")
+    key.update(np.ascontiguousarray(y, dtype=float).tobytes())
+    p0 = None if p0 is None else [float(item) for item in p0]
+    key.update(repr((p0, maxfev)).encode())
+    return key.hexdigest()
+
+
+"""
+Disk-backed cache of fit results (a sqlite file), with a maximum amount of entries.
+When it is full the least recently used entries are removed.
+'hits' and 'misses' count the lookups since the cache was opened.
+"""
+class FitCache:
+    def __init__(self, filename=CACHE_FILE, max_entries=CACHE_MAX_ENTRIES):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS fits "
+                                "(key TEXT PRIMARY KEY, popt BLOB, pcov BLOB, status TEXT, used INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS fits_used ON fits (used)")
+        # Counter for the least recently used order.
+        self.clock = self.connection.execute("SELECT COALESCE(MAX(used), 0) FROM fits").fetchone()[0]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM fits").fetchone()[0]
+
+    """
+    Returns the stored (popt, pcov, status) or None.
+    """
+    def get(self, key):
+        row = self.connection.execute("SELECT popt, pcov, status FROM fits WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.clock += 1
+        self.connection.execute("UPDATE fits SET used = ? WHERE key = ?", (self.clock, key))
+
+        popt, pcov, status = row
+        if popt is None:
+            return None, None, status
+        n_params = int(np.sqrt(len(pcov) // 8))
+        return (np.frombuffer(popt, dtype=float).copy(),
+                np.frombuffer(pcov, dtype=float).reshape(n_params, n_params).copy(),
+                status)
+
+    def put(self, key, result):
+        popt, pcov, status = result
+        self.clock += 1
+        self.connection.execute("INSERT OR REPLACE INTO fits VALUES (?, ?, ?, ?, ?)",
+                                (key,
+                                 None if popt is None else np.asarray(popt, dtype=float).tobytes(),
+                                 None if pcov is None else np.asarray(pcov, dtype=float).tobytes(),
+                                 status, self.clock))
+
+    """
+    Removes the least recently used entries above 'max_entries' and writes everything to disk.
+    """
+    def flush(self):
+        self.connection.execute("DELETE FROM fits WHERE key IN "
+                                "(SELECT key FROM fits ORDER BY used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def summary(self):
+        return "Fit cache: {} hits, {} misses, {} entries".format(self.hits, self.misses, len(self))
+
+
+"""
+One p0 per series, 'p0' is None, one starting point or already a list of them (which can contain None).
+"""
+def _p0_list(p0, n_series):
+    if p0 is None:
+        return [None] * n_series
+    if len(p0) and (p0[0] is None or np.ndim(p0[0]) == 1):
+        return list(p0)
+    return [p0] * n_series
+
+
+"""
+Fits 'model' to every (x, y) in 'series'.
+'p0' is either one starting point for all series, a list with one per series or None for sigmoid_p0().
+If a FitCache is given, only the series that are not in it get fitted.
+Returns a list of (popt, pcov, status), in the order of 'series'.
+"""
+def fit_many(series, model, p0=None, maxfev=None, workers=None, chunksize=None, cache=None, jac=None, bounds=None):
+    if workers is None:
+        workers = WORKERS if WORKERS is not None else cpu_count() or 1
+    if chunksize is None:
+        chunksize = CHUNKSIZE
+
+    p0_list = _p0_list(p0, len(series))
+    jobs = [(model, x, y, start, maxfev, jac, bounds) for (x, y), start in zip(series, p0_list)]
+    results = [None] * len(jobs)
+
+    if cache is not None:
+        keys = [fit_key(*job) for job in jobs]
+        for i, key in enumerate(keys):
+            results[i] = cache.get(key)
+
+    todo = [i for i, result in enumerate(results) if result is None]
+    fitted = _run_jobs([jobs[i] for i in todo], workers, chunksize)
+
+    for i, result in zip(todo, fitted):
+        results[i] = result
+        if cache is not None:
+            cache.put(keys[i], result)
+
+    if cache is not None:
+        cache.flush()
+
+    return results
+
+
+"""
+Fits the jobs, in a process pool if there are enough of them.
+"""
+def _run_jobs(jobs, workers, chunksize):
+    # Not worth starting processes for.
+    if workers <= 1 or len(jobs) <= chunksize:
+        return [_fit_job(job) for job in jobs]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_fit_job, jobs, chunksize=chunksize))
+
+
+"""
+The last fit of every named series, stored in the same sqlite file as the FitCache.
+"""
+class FitHistory:
+    def __init__(self, filename=CACHE_FILE):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS history "
+                                "(name TEXT PRIMARY KEY, digest TEXT, popt BLOB, pcov BLOB, status TEXT)")
+
+    """
+    Returns the stored (digest, (popt, pcov, status)) of 'name' or None.
+    """
+    def get(self, name):
+        row = self.connection.execute("SELECT digest, popt, pcov, status FROM history WHERE name = ?",
+                                      (name,)).fetchone()
+        if row is None:
+            return None
+
+        digest, popt, pcov, status = row
+        if popt is None:
+            return digest, (None, None, status)
+        n_params = int(np.sqrt(len(pcov) // 8))
+        return digest, (np.frombuffer(popt, dtype=float).copy(),
+                        np.frombuffer(pcov, dtype=float).reshape(n_params, n_params).copy(),
+                        status)
+
+    def put(self, name, digest, result):
+        popt, pcov, status = result
+        self.connection.execute("INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?)",
+                                (name, digest,
+                                 None if popt is None else np.asarray(popt, dtype=float).tobytes(),
+                                 None if pcov is None else np.asarray(pcov, dtype=float).tobytes(),
+                                 status))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+"""
+Fits the named series, reusing what is in 'history', see the module docstring.
+A warm start that fails is retried as a cold start.
+Returns the list of (popt, pcov, status) in the order of 'series' and a dict
+with the amount of series that were 'skipped', 'warm' started and 'cold' started.
+"""
+def fit_incremental(names, series, model, history, p0=None, maxfev=None, workers=None, chunksize=None, cache=None,
+                    jac=None, bounds=None):
+    results = [None] * len(series)
+    p0_list = _p0_list(p0, len(series))
+    digests = [fit_key(model, x, y, start, maxfev, jac, bounds) for (x, y), start in zip(series, p0_list)]
+    counts = {"skipped": 0, "warm": 0, "cold": 0}
+
+    warm = []
+    cold = []
+    for i, (name, digest) in enumerate(zip(names, digests)):
+        previous = history.get(name)
+        if previous is None:
+            cold.append(i)
+        elif previous[0] == digest:
+            results[i] = previous[1]
+            counts["skipped"] += 1
+        elif previous[1][0] is not None:
+            warm.append((i, previous[1][0]))
+        else:
+            cold.append(i)
+
+    warm_results = fit_many([series[i] for i, _ in warm], model, [popt for _, popt in warm], maxfev,
+                            workers, chunksize, cache, jac, bounds)
+    for (i, _), result in zip(warm, warm_results):
+        if result[0] is None:
+            cold.append(i)
+        else:
+            results[i] = result
+            counts["warm"] += 1
+
+    cold_results = fit_many([series[i] for i in cold], model, [p0_list[i] for i in cold], maxfev,
+                            workers, chunksize, cache, jac, bounds)
+    for i, result in zip(cold, cold_results):
+        results[i] = result
+        counts["cold"] += 1
+
+    for name, digest, result in zip(names, digests, results):
+        history.put(name, digest, result)
+    history.connection.commit()
+
+    return results, counts
+
+
+"""
+Standard errors of the parameters from the covariance matrix of a fit, None without one.
+Parameters that can't be estimated have an infinite or NaN error.
+"""
+def standard_errors(pcov):
+    if pcov is None:
+        return None
+    variances = np.diag(np.asarray(pcov, dtype=float))
+    with np.errstate(invalid="ignore"):
+        return np.sqrt(np.where(variances < 0, np.nan, variances))
+
+
+"""
+Refits 'count' bootstrap samples of one series: the fitted curve plus resampled residuals.
+Returns the popt of the refits that succeeded, one per row.
+"""
+def _bootstrap_job(job):
+    model, x, y, popt, seed, count, maxfev, jac, bounds = job
+    x = np.asarray(x, dtype=float)
+    fitted = model(x, *popt)
+    residuals = np.asarray(y, dtype=float) - fitted
+
+    rng = np.random.default_rng(seed)
+    samples = []
+    for _ in range(count):
+        y_sample = fitted + rng.choice(residuals, size=len(residuals), replace=True)
+        # The original fit is a good starting point for the refits.
+        sample, _, _ = fit_one(model, x, y_sample, popt, maxfev, jac, bounds)
+        if sample is not None:
+            samples.append(sample)
+    return np.array(samples, dtype=float).reshape(-1, len(popt))
+
+
+"""
+Residual bootstrap of the fits in 'fits' (the results of fit_many() for 'series'),
+'n_samples' refits per series, stopped after 'time_budget' seconds. 'seed' makes it reproducible.
+Returns per series (errors, count): the standard deviation of every parameter over the
+'count' refits that were done, errors is None for failed fits or less than 2 refits.
+"""
+def bootstrap_fits(series, model, fits, n_samples=None, time_budget=None, seed=0, maxfev=None, workers=None,
+                   jac=None, bounds=None):
+    if n_samples is None:
+        n_samples = BOOTSTRAP_SAMPLES
+    if time_budget is None:
+        time_budget = BOOTSTRAP_SECONDS
+    if workers is None:
+        workers = WORKERS if WORKERS is not None else cpu_count() or 1
+    deadline = perf_counter() + time_budget
+
+    todo = [i for i, (popt, pcov, status) in enumerate(fits) if popt is not None]
+    n_rounds = int(np.ceil(n_samples / BOOTSTRAP_BATCH))
+    # Round by round, so a cut-off by the time budget leaves every series with about as many refits.
+    jobs = []
+    for round_number in range(n_rounds):
+        count = min(BOOTSTRAP_BATCH, n_samples - round_number*BOOTSTRAP_BATCH)
+        for i in todo:
+            x, y = series[i]
+            jobs.append((i, (model, x, y, fits[i][0], [seed, i, round_number], count, maxfev, jac, bounds)))
+
+    samples = {i: [] for i in todo}
+    if workers <= 1:
+        for i, job in jobs:
+            if perf_counter() > deadline:
+                break
+            samples[i].append(_bootstrap_job(job))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            jobs = iter(jobs)
+            while True:
+                # Keeps every worker busy, without queueing work that the budget might not allow.
+                while len(pending) < 2*workers and perf_counter() < deadline:
+                    next_job = next(jobs, None)
+                    if next_job is None:
+                        break
+                    i, job = next_job
+                    pending[executor.submit(_bootstrap_job, job)] = i
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    samples[pending.pop(future)].append(future.result())
+
+    results = [(None, 0)] * len(series)
+    for i, batches in samples.items():
+        refits = np.concatenate(batches) if batches else np.empty((0, 0))
+        if len(refits) >= 2:
+            results[i] = (refits.std(axis=0, ddof=1), len(refits))
+        else:
+            results[i] = (None, len(refits))
+    return results
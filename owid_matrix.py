@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Dense countries x days matrices of the OWID time series.
+
+All countries are put on one global date axis, from the earliest record of any
+country up to the latest one. Missing values are filled in the same way the
+assignments always did it:
+    total_*  - the value of the day before, 0.0 if there is no earlier value
+    other    - 0.0
+Days a country has no record for stay NaN and are left out by CountryMatrix.row().
+
+The dates are parsed once into a numpy.datetime64 axis, the column of a day is
+its amount of days since the start of the axis.
+"""
+import numpy as np
+
+
+"""
+The 'total_' metrics carry their last value forward, the rest gets 0.0.
+"""
+def is_cumulative(metric):
+    return metric.split("_")[0] == "total"
+
+
+"""
+Walks the records of every country once and puts all 'metrics' on the global date axis.
+Returns the iso codes, the start date, the presence mask and a dict of raw arrays (NaN = missing).
+Countries without any records get a row without any present days.
+"""
+def dense_arrays(covid_data, metrics, countries=None):
+    if countries is None:
+        countries = covid_data.keys()
+    iso_codes = list(countries)
+
+    # The dates of all countries are parsed at once, then every record gets its column on the date axis.
+    lengths = [len(covid_data[iso].get("data") or []) for iso in iso_codes]
+    all_dates = np.array([record["date"] for iso in iso_codes for record in covid_data[iso].get("data") or []],
+                         dtype="datetime64[D]")
+
+    if len(all_dates):
+        start_date = all_dates.min()
+        n_days = int((all_dates.max() - start_date).astype(int)) + 1
+    else:
+        start_date = np.datetime64("NaT", "D")
+        n_days = 0
+
+    all_columns = (all_dates - start_date).astype(int)
+    country_columns = np.split(all_columns, np.cumsum(lengths)[:-1]) if lengths else []
+
+    present = np.zeros((len(iso_codes), n_days), dtype=bool)
+    values = {metric: np.full((len(iso_codes), n_days), np.nan) for metric in metrics}
+
+    for row, iso in enumerate(iso_codes):
+        records = covid_data[iso].get("data") or []
+        columns = country_columns[row]
+        present[row, columns] = True
+        if not records or not metrics:
+            continue
+
+        # All metrics in one walk over the records, one column per metric.
+        table = np.array([[record.get(metric) for metric in metrics] for record in records], dtype=float)
+        for index, metric in enumerate(metrics):
+            values[metric][row, columns] = table[:, index]
+
+    return iso_codes, start_date, present, values
+
+
+"""
+Forward fills the NaN values of every row, the days before the first value become 0.0.
+Days that are not 'present' are set back to NaN.
+"""
+def forward_fill(values, present):
+    n_days = values.shape[1]
+    # Per day the column of the last valid value so far, -1 if there is none yet.
+    last_valid = np.where(np.isnan(values), -1, np.arange(n_days))
+    np.maximum.accumulate(last_valid, axis=1, out=last_valid)
+
+    filled = np.take_along_axis(values, np.maximum(last_valid, 0), axis=1)
+    filled[last_valid < 0] = 0.0
+    filled[~present] = np.nan
+    return filled
+
+
+"""
+Fills the missing values of one metric, see the module docstring.
+"""
+def fill_missing(values, metric, present):
+    if is_cumulative(metric):
+        return forward_fill(values, present)
+
+    filled = np.where(np.isnan(values), 0.0, values)
+    filled[~present] = np.nan
+    return filled
+
+
+"""
+The filled matrices of a set of metrics for a set of countries.
+"""
+class CountryMatrix:
+    def __init__(self, iso_codes, start_date, present, values):
+        self.iso_codes = list(iso_codes)
+        self.start_date = start_date
+        self.dates = start_date + np.arange(present.shape[1])
+        self.present = np.asarray(present)
+        self.values = values
+        self.rows = {iso: row for row, iso in enumerate(self.iso_codes)}
+        self.date_strings = None
+
+    """
+    Builds the matrix from the raw, NaN for missing, arrays.
+    """
+    @classmethod
+    def from_raw(cls, iso_codes, start_date, present, raw_values):
+        present = np.asarray(present)
+        values = {metric: fill_missing(np.asarray(raw), metric, present) for metric, raw in raw_values.items()}
+        return cls(iso_codes, start_date, present, values)
+
+    """
+    Mask of the days that are returned by row(), the first 'max_days' records if given.
+    """
+    def mask(self, iso_code, max_days=None):
+        mask = self.present[self.rows[iso_code]]
+        if max_days is not None:
+            mask = mask & (np.cumsum(mask) <= max_days)
+        return mask
+
+    """
+    The filled values of 'metric' for one country, one value per record.
+    """
+    def row(self, metric, iso_code, max_days=None):
+        return self.values[metric][self.rows[iso_code]][self.mask(iso_code, max_days)]
+
+    """
+    Days since 'start_date' (a datetime64 or datetime, default the start of the matrix) of the records of one country.
+    """
+    def row_days(self, iso_code, start_date=None, max_days=None):
+        # The columns of the matrix already are the days since its own start.
+        days = np.flatnonzero(self.mask(iso_code, max_days))
+        if start_date is not None:
+            days = days + int((self.start_date - np.datetime64(start_date, "D")).astype(int))
+        return days
+
+    """
+    The dates of the records of one country, as strings 'YYYY-MM-DD'.
+    """
+    def row_dates(self, iso_code, max_days=None):
+        # The axis is converted to strings only once.
+        if self.date_strings is None:
+            self.date_strings = np.datetime_as_string(self.dates)
+        return list(self.date_strings[self.mask(iso_code, max_days)])
+
+
+"""
+Builds the filled matrices of 'metrics' in one pass over the loaded json data.
+"""
+def build_matrix(covid_data, metrics, countries=None):
+    return CountryMatrix.from_raw(*dense_arrays(covid_data, metrics, countries))
+
+
+"""
+Builds the filled matrices from the columnar cache (owid_cache.OwidCache) instead of the json data.
+"""
+def from_cache(cache, metrics, countries=None):
+    if countries is None:
+        rows = np.arange(len(cache.iso_codes))
+        iso_codes = cache.iso_codes
+    else:
+        iso_codes = [iso for iso in countries if iso in cache.rows]
+        rows = np.array([cache.rows[iso] for iso in iso_codes], dtype=int)
+
+    present = np.asarray(cache.present)[rows]
+    raw_values = {metric: np.asarray(cache.values(metric))[rows] for metric in metrics}
+    return CountryMatrix.from_raw(iso_codes, cache.start_date, present, raw_values)
+
+
+"""
+The dates and filled values of one metric for a single country's data.
+"""
+def country_series(country_data, metric, max_days=None):
+    matrix = build_matrix({"": country_data}, [metric])
+    return matrix.row_dates("", max_days), matrix.row(metric, "", max_days)
+
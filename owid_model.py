@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+The sigmoid model used for the growth rates, shared by the assignments.
+
+    y = L / (1 + exp(-k*(x-x0))) + b        k = growth rate
+
+Besides the model itself there is the analytic Jacobian and the parameter bounds,
+both are passed to curve_fit (see owid_fit) so the fit doesn't need finite
+differences and can't run off to parameters where exp() overflows.
+"""
+import numpy as np
+
+from scipy.special import expit
+
+
+# https://stackoverflow.com/questions/55725139/fit-sigmoid-function-s-shape-curve-to-data-using-python
+# k = growth rate
+# expit(z) = 1 / (1 + exp(-z)), without overflowing for large negative z.
+def sigmoid(x, L, x0, k, b):
+    y = L * expit(k*(np.asarray(x, dtype=float)-x0)) + b
+    return (y)
+
+
+"""
+Derivatives of the sigmoid to L, x0, k and b, one column per parameter.
+"""
+def sigmoid_jacobian(x, L, x0, k, b):
+    x = np.asarray(x, dtype=float)
+    s = expit(k*(x-x0))
+    ds = s * (1-s)
+    return np.column_stack((s, -L*k*ds, L*(x-x0)*ds, np.ones_like(x)))
+
+
+"""
+Starting point of a sigmoid fit: [L, x0, k, b] = [max(y), median(x), 1, min(y)]
+"""
+def sigmoid_p0(x, y):
+    return [np.max(y), np.median(x), 1, np.min(y)]
+
+
+"""
+Bounds of [L, x0, k, b] for the data, as (lower, upper):
+    L   0 up to 100 times the highest value
+    x0  within one data length before the first and after the last x
+    k   0 or more, the data is cumulative so it can't decrease. No upper bound, a fit that
+        ended on one would report the bound instead of the rate (small countries with a
+        jump in their data get a k of 40 or more)
+    b   within the highest absolute value (plus 1) around 0
+"""
+def sigmoid_bounds(x, y):
+    x = np.asarray(x, dtype=float)
+    top = np.max(np.abs(y)) + 1.0
+    span = np.max(x) - np.min(x) + 1.0
+    lower = [0.0, np.min(x) - span, 0.0, -top]
+    upper = [100.0*top, np.max(x) + span, np.inf, top]
+    return lower, upper
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Staged pipeline with checkpoints on disk: load -> extract -> fit -> analyse -> render.
+
+Every stage stores its output in a checkpoint together with a content hash of its input.
+On the next run a stage only recomputes what its input changed for:
+    step()      - one output for the whole stage, reused when the hash of its input is the same
+    per_key()   - one output per key (a country, a plot), only the keys with a changed
+                  input hash (or without a checkpoint) are computed, in one call
+After a data update that touched a few countries, only those countries are fitted again and
+only the plots whose data changed are rendered again. summary() tells what ran and what was reused.
+
+The checkpoints are pickle files in PIPELINE_DIR/<pipeline name>/<stage>.pkl, written to a
+temporary file first and then swapped in, so a crash halfway leaves the old checkpoint intact.
+"""
+import numpy as np
+import pickle
+
+from hashlib import sha1
+from os import fsync, makedirs, path, replace
+from time import perf_counter
+
+PIPELINE_VERSION = 1
+
+# Defaults, can be changed by the scripts using this module.
+PIPELINE_DIR = path.join(path.dirname(path.abspath(__file__)), "pipeline-cache")
+
+
+"""
+Content hash of any mix of numpy arrays, pandas objects and plain values (lists, dicts, numbers, strings).
+"""
+def content_hash(*parts):
+    key = sha1()
+    for part in parts:
+        _update(key, part)
+    return key.hexdigest()
+
+
+def _update(key, part):
+    if hasattr(part, "to_numpy") and hasattr(part, "index"):
+        # pandas: the labels count as well.
+        _update(key, list(part.index))
+        if hasattr(part, "columns"):
+            _update(key, list(part.columns))
+        part = part.to_numpy()
+    if isinstance(part, np.ndarray):
+        if part.dtype == object:
+            _update(key, part.tolist())
+        else:
+            key.update(repr((part.dtype.str, part.shape)).encode())
+            key.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, dict):
+        key.update(b"{")
+        for name in sorted(part, key=repr):
+            _update(key, name)
+            _update(key, part[name])
+        key.update(b"}")
+    elif isinstance(part, (list, tuple)):
+        key.update(b"[")
+        for item in part:
+            _update(key, item)
+        key.update(b"]")
+    else:
+        key.update(repr(part).encode())
+    key.update(b"|")
+
+
+"""
+The stages of one pipeline ('name' is its folder in 'directory') and what they did this run.
+"""
+class Pipeline:
+    def __init__(self, name, directory=None):
+        if directory is None:
+            directory = PIPELINE_DIR
+        self.directory = path.join(directory, name)
+        # Per stage: (amount computed, amount reused, seconds)
+        self.stages = {}
+
+    def _checkpoint_file(self, stage):
+        return path.join(self.directory, "{}.pkl".format(stage))
+
+    def _load(self, stage):
+        try:
+            with open(self._checkpoint_file(stage), "rb") as checkpoint_handle:
+                checkpoint = pickle.load(checkpoint_handle)
+        except Exception:
+            return {}
+        if checkpoint.get("version") != PIPELINE_VERSION:
+            return {}
+        return checkpoint["entries"]
+
+    def _save(self, stage, entries):
+        try:
+            makedirs(self.directory)
+        except Exception:
+            pass
+        filename = self._checkpoint_file(stage)
+        with open(filename + ".tmp", "wb") as checkpoint_handle:
+            pickle.dump({"version": PIPELINE_VERSION, "entries": entries}, checkpoint_handle, pickle.HIGHEST_PROTOCOL)
+            checkpoint_handle.flush()
+            fsync(checkpoint_handle.fileno())
+        replace(filename + ".tmp", filename)
+
+    """
+    A stage with one output. 'input_hash' identifies its input (see content_hash()),
+    compute() is only called when it differs from the checkpoint. With None it always runs.
+    """
+    def step(self, stage, input_hash, compute):
+        start = perf_counter()
+        entries = self._load(stage) if input_hash is not None else {}
+        if input_hash is not None and entries.get("hash") == input_hash:
+            self.stages[stage] = (0, 1, perf_counter() - start)
+            return entries["output"]
+
+        output = compute()
+        if input_hash is not None:
+            self._save(stage, {"hash": input_hash, "output": output})
+        self.stages[stage] = (1, 0, perf_counter() - start)
+        return output
+
+    """
+    A stage with an output per key. 'input_hashes' is a dict of key -> hash of its input,
+    compute(keys) gets the keys that changed and returns their outputs in the same order.
+    'valid(key, output)' can reject a checkpointed output, for example a plot file that was removed.
+    Returns a dict of key -> output for all keys of 'input_hashes'. Keys that are no longer in
+    'input_hashes' are dropped from the checkpoint.
+    """
+    def per_key(self, stage, input_hashes, compute, valid=None):
+        start = perf_counter()
+        entries = self._load(stage)
+
+        outputs = {}
+        changed = []
+        for key, input_hash in input_hashes.items():
+            entry = entries.get(key)
+            if entry is not None and entry[0] == input_hash and (valid is None or valid(key, entry[1])):
+                outputs[key] = entry[1]
+            else:
+                changed.append(key)
+
+        if changed:
+            for key, output in zip(changed, compute(changed)):
+                outputs[key] = output
+        if changed or len(entries) != len(input_hashes):
+            self._save(stage, {key: (input_hashes[key], outputs[key]) for key in input_hashes})
+
+        self.stages[stage] = (len(changed), len(input_hashes) - len(changed), perf_counter() - start)
+        return {key: outputs[key] for key in input_hashes}
+
+    """
+    Records a stage that isn't checkpointed (for example loading the data) in the summary.
+    """
+    def ran(self, stage, computed, seconds, reused=0):
+        self.stages[stage] = (computed, reused, seconds)
+
+    """
+    What every stage did this run, one line per stage.
+    """
+    def summary(self):
+        lines = ["Pipeline {}:".format(path.basename(self.directory))]
+        for stage, (computed, reused, seconds) in self.stages.items():
+            lines.append("  {:<10} {:>5} computed, {:>5} reused, {:.2f} s".format(stage, computed, reused, seconds))
+        return "\n".join(lines)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Fast growth rate estimator, an alternative to fitting a sigmoid per country.
+
+For the logistic curve y = L / (1 + exp(-k*(x-x0))) the log derivative is linear in y:
+    d ln(y) / dx = k - (k/L) * y
+So a straight line through (y, d ln(y)/dx) has k as its intercept. The log derivative
+is taken over a window of 'window' days to smooth out the daily noise, and the
+least squares line of every country is calculated at once with masked sums over
+the countries x days array.
+"""
+import numpy as np
+
+
+"""
+Puts a list of 1D series in one countries x days array, left aligned, padded with NaN.
+"""
+def pad_rows(rows, length=None):
+    if length is None:
+        length = max((len(row) for row in rows), default=0)
+
+    padded = np.full((len(rows), length), np.nan)
+    for i, row in enumerate(rows):
+        row = np.asarray(row, dtype=float)[:length]
+        padded[i, :len(row)] = row
+    return padded
+
+
+"""
+Growth rate k of every row of 'values' (countries x days, NaN = no data).
+Rows with less than 'min_points' usable points get NaN.
+"""
+def growth_rates(values, window=7, min_points=5):
+    values = np.asarray(values, dtype=float)
+
+    start = values[:, :-window]
+    end = values[:, window:]
+    usable = (start > 0) & (end > 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(usable, (np.log(end) - np.log(start)) / window, 0.0)
+    level = np.where(usable, (start + end) / 2, 0.0)
+
+    # Least squares of slope = k + c*level per row, with masked (centered) sums.
+    n = usable.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_level = level.sum(axis=1) / n
+        mean_slope = slope.sum(axis=1) / n
+
+        level_c = np.where(usable, level - mean_level[:, None], 0.0)
+        slope_c = np.where(usable, slope - mean_slope[:, None], 0.0)
+        c = (level_c*slope_c).sum(axis=1) / (level_c*level_c).sum(axis=1)
+        rates = mean_slope - c*mean_level
+
+    rates[(n < min_points) | ~np.isfinite(rates)] = np.nan
+    return rates
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+Headless plot rendering.
+
+Every plot is drawn with the Agg backend (no window) and its figure is closed
+right after it is saved, so making many plots doesn't keep them all in memory.
+Independent plots can be rendered in parallel worker processes with render_many(),
+which also reports the time per plot and the peak memory use (RSS).
+
+For plots with many countries draw_lines() draws all series as one collection,
+one artist instead of one per country, with the colours given as an array.
+draw_points() draws one artist per colour instead of one per country.
+The legend then goes into a separate, compact image (save_legend()) instead of
+next to the plot.
+
+Series with more points than the axes are wide in pixels are decimated first
+(decimate_series(), see owid_decimate), more points than pixels can't be seen anyway.
+
+Atlas renders one plot per country on a single figure that is reused for all of them.
+"""
+import matplotlib
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from sys import platform
+from time import perf_counter
+
+import owid_decimate
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    # Not available on Windows, the memory use is not reported there.
+    getrusage = None
+
+# Defaults, can be changed by the scripts using this module.
+WORKERS = None      # None = one process per cpu, 1 = render in this process
+FAST_MIN_SERIES = 20    # From this amount of series on the fast path is used
+DECIMATE = "lttb"       # Decimation method of long series, "lttb", "minmax" or None for never
+
+
+"""
+Switches matplotlib to the Agg backend, plots are only written to files.
+"""
+def use_agg():
+    matplotlib.use("Agg")
+
+
+"""
+Saves the figure and closes it.
+"""
+def save_figure(fig, filename, dpi=100, tight=True):
+    import matplotlib.pyplot as plt
+
+    if tight:
+        fig.savefig(filename, bbox_inches="tight", dpi=dpi)
+    else:
+        fig.savefig(filename, dpi=dpi)
+    plt.close(fig)
+
+
+"""
+One colour per series from a colormap, spread evenly like the assignments always did.
+"""
+def series_colors(n_series, colormap="tab20"):
+    import matplotlib.pyplot as plt
+
+    cm = plt.get_cmap(colormap)
+    return np.array([cm(1.*i/n_series) for i in range(n_series)])
+
+
+"""
+Width of the axes in pixels when the figure is saved with 'dpi'.
+"""
+def pixel_width(ax, dpi=100):
+    return int(ax.figure.get_figwidth() * dpi * ax.get_position().width)
+
+
+"""
+Only the points of a series that can be seen on the axes: when there are more points
+than the axes are wide in pixels they are decimated to that amount. 'method' is
+"lttb", "minmax" or None for DECIMATE, False never decimates.
+"""
+def decimate_series(ax, x, y, method=None, dpi=100):
+    if method is None:
+        method = DECIMATE
+    width = pixel_width(ax, dpi)
+    if not method or len(x) <= width:
+        return x, y
+
+    kept = owid_decimate.decimate(x, y, width, method)
+    return np.asarray(x)[kept], np.asarray(y)[kept]
+
+
+"""
+Draws all (x, y) series as one LineCollection. x can be numbers or numpy datetime64.
+"""
+def draw_lines(ax, series, colors, rasterized=False, linewidth=1.5):
+    from matplotlib.collections import LineCollection
+
+    segments = [np.column_stack((_numeric(x), np.asarray(y, dtype=float))) for x, y in series]
+    collection = LineCollection(segments, colors=colors, linewidths=linewidth, rasterized=rasterized)
+    ax.add_collection(collection)
+    _autoscale(ax, series)
+    return collection
+
+
+"""
+Draws the points of all (x, y) series, every point gets the colour of its series.
+The points are grouped per colour and every group is drawn as one marker-only line,
+so there are as many artists as there are colours (20 for tab20), not series.
+Markers of one artist are drawn as one stamped marker, much faster than a scatter.
+"""
+def draw_points(ax, series, colors, marker=".", size=4, rasterized=False):
+    colors = np.asarray(colors)
+    artists = []
+    if not series:
+        return artists
+
+    unique_colors, group = np.unique(colors, axis=0, return_inverse=True)
+    for color_index, color in enumerate(unique_colors):
+        members = [i for i in np.flatnonzero(group.ravel() == color_index)]
+        x = np.concatenate([_numeric(series[i][0]) for i in members])
+        y = np.concatenate([np.asarray(series[i][1], dtype=float) for i in members])
+        line, = ax.plot(x, y, linestyle="", marker=marker, markersize=size, color=color, rasterized=rasterized)
+        artists.append(line)
+
+    _autoscale(ax, series)
+    return artists
+
+
+"""
+Collections don't update the axis limits by themselves. Dates also get a date axis.
+"""
+def _autoscale(ax, series):
+    if series and np.asarray(series[0][0]).dtype.kind in "USM":
+        ax.xaxis_date()
+    ax.autoscale_view()
+
+
+"""
+Dates (numpy datetime64 or 'YYYY-MM-DD' strings) to matplotlib date numbers, numbers stay as they are.
+"""
+def _numeric(x):
+    from matplotlib.dates import date2num
+
+    x = np.asarray(x)
+    if x.dtype.kind in "US":
+        x = x.astype("datetime64[D]")
+    if np.issubdtype(x.dtype, np.datetime64):
+        return date2num(x)
+    return x.astype(float)
+
+
+"""
+Saves only a legend, as a separate image. The entries are laid out in a grid by hand:
+the colours as one scatter and every column of labels as one multi-line text, which
+is much faster than matplotlib's legend for hundreds of entries.
+'marker' is the marker of the colour swatches, "s" (squares) by default.
+"""
+def save_legend(labels, colors, filename, columns=None, marker="s", dpi=100):
+    import matplotlib.pyplot as plt
+    from matplotlib.font_manager import FontProperties
+
+    if columns is None:
+        columns = max(1, int(np.ceil(len(labels) / 30)))
+    rows = max(1, int(np.ceil(len(labels) / columns)))
+    row_height = 0.2    # inches
+    font = FontProperties(size=8)
+
+    fig = plt.figure(figsize=(1.5*columns, row_height*(rows + 1)), dpi=dpi)
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.set_axis_off()
+    ax.set_xlim(0, columns)
+    ax.set_ylim(rows + 0.5, -0.5)
+
+    index = np.arange(len(labels))
+    ax.scatter(index // rows + 0.1, index % rows, s=20, c=np.asarray(colors), marker=marker)
+
+    # The line spacing that makes one line of text exactly one row high,
+    # measured as the difference between a text of two lines and one of one line.
+    renderer = fig.canvas.get_renderer()
+    one_line = ax.text(0, 0, "lp", fontproperties=font, linespacing=1.0)
+    two_lines = ax.text(0, 0, "lp\nlp", fontproperties=font, linespacing=1.0)
+    line_step = two_lines.get_window_extent(renderer).height - one_line.get_window_extent(renderer).height
+    one_line.remove()
+    two_lines.remove()
+    linespacing = row_height*dpi / line_step
+
+    for column in range(columns):
+        text = "\n".join(labels[column*rows:(column+1)*rows])
+        ax.text(column + 0.2, -0.5, text, va="top", fontproperties=font, linespacing=linespacing)
+
+    save_figure(fig, filename, dpi=dpi, tight=False)
+
+
+"""
+Many plots of the same kind, one per country, on one figure that is set up once.
+Every plot() only replaces the data of the line, the title and the axis limits
+before saving, so there is no new figure, layout or folder per plot.
+The plots go to one PNG each, or with 'pdf_filename' all into one multi-page PDF.
+
+    with Atlas("Dates", "Amount of total cases") as atlas:
+        for ...:
+            atlas.plot(dates, values, title, filename)
+    print(atlas.summary())
+"""
+class Atlas:
+    def __init__(self, xlabel, ylabel, f_x=6, f_y=4, pdf_filename=None, dpi=100):
+        import matplotlib.pyplot as plt
+
+        self.dpi = dpi
+        self.fig, self.ax = plt.subplots(figsize=(f_x,f_y))
+        self.line, = self.ax.plot([], [])
+        self.ax.set_xlabel(xlabel)
+        self.ax.set_ylabel(ylabel)
+        self.ax.tick_params(axis="x", labelrotation=90)
+        # Fixed margins instead of a tight bounding box per plot, with room for the dates.
+        self.fig.subplots_adjust(left=0.15, right=0.95, top=0.9, bottom=0.3)
+
+        self.pdf = None
+        if pdf_filename is not None:
+            from matplotlib.backends.backend_pdf import PdfPages
+            self.pdf = PdfPages(pdf_filename)
+
+        self.count = 0
+        self.seconds = 0.0
+        self.has_dates = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    """
+    Draws one series and saves it, to 'filename' or as the next page of the PDF.
+    x can be numbers or dates (numpy datetime64 or 'YYYY-MM-DD' strings).
+    """
+    def plot(self, x, y, title, filename=None):
+        start = perf_counter()
+
+        x, y = decimate_series(self.ax, x, y, dpi=self.dpi)
+        if not self.has_dates and np.asarray(x).dtype.kind in "USM":
+            self.ax.xaxis_date()
+            self.has_dates = True
+        self.line.set_data(_numeric(x), np.asarray(y, dtype=float))
+        self.ax.set_title(title)
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+        if self.pdf is not None:
+            self.pdf.savefig(self.fig)
+        else:
+            self.fig.savefig(filename, dpi=self.dpi)
+
+        self.count += 1
+        self.seconds += perf_counter() - start
+
+    """
+    Closes the PDF (if any) and the figure.
+    """
+    def close(self):
+        import matplotlib.pyplot as plt
+
+        if self.pdf is not None:
+            self.pdf.close()
+            self.pdf = None
+        plt.close(self.fig)
+
+    def summary(self):
+        rate = self.count / self.seconds if self.seconds > 0 else 0.0
+        return "Atlas: {} plots in {:.2f} s ({:.1f} plots/s)".format(self.count, self.seconds, rate)
+
+
+"""
+Peak RSS of this process in MB, None if unknown.
+"""
+def peak_rss():
+    if getrusage is None:
+        return None
+    max_rss = getrusage(RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere.
+    if platform == "darwin":
+        return max_rss / (1 << 20)
+    return max_rss / 1024
+
+
+"""
+Runs one plot function in a worker, returns its result, the time it took and the peak RSS of the worker.
+"""
+def _render_job(job):
+    import matplotlib.pyplot as plt
+
+    function, arguments = job
+    # With one worker this runs in the caller's process, its own figures stay open.
+    before = set(plt.get_fignums())
+    start = perf_counter()
+    result = function(*arguments)
+    seconds = perf_counter() - start
+
+    # Figures that the function didn't close itself.
+    for number in set(plt.get_fignums()) - before:
+        plt.close(number)
+    return result, seconds, peak_rss()
+
+
+"""
+Calls 'function' once for every tuple of arguments in 'jobs', in parallel worker processes.
+'labels' names the plots in the report. Returns the results of the calls, in the order of 'jobs'.
+"""
+def render_many(function, jobs, labels=None, workers=None):
+    if workers is None:
+        workers = WORKERS if WORKERS is not None else cpu_count() or 1
+    if labels is None:
+        labels = [str(arguments[0]) if arguments else function.__name__ for arguments in jobs]
+
+    start = perf_counter()
+    jobs = [(function, tuple(arguments)) for arguments in jobs]
+
+    if workers <= 1 or len(jobs) <= 1:
+        use_agg()
+        rendered = [_render_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=use_agg) as executor:
+            rendered = list(executor.map(_render_job, jobs))
+
+    report(labels, rendered, perf_counter() - start)
+    return [result for result, seconds, rss in rendered]
+
+
+"""
+Prints the render time per plot and the peak memory use.
+"""
+def report(labels, rendered, total_seconds):
+    print("Rendered {} plots in {:.2f} s".format(len(rendered), total_seconds))
+    for label, (result, seconds, rss) in zip(labels, rendered):
+        print("  {:.2f} s  {}".format(seconds, label))
+
+    worker_rss = [rss for result, seconds, rss in rendered if rss is not None]
+    if worker_rss:
+        print("Peak RSS: {:.0f} MB (this process), {:.0f} MB (largest renderer)".format(peak_rss(), max(worker_rss)))
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling growth rates: the growth rate of every country on every day.
+
+The growth rate of a day is the slope of ln(value) over the last 'window' days
+(least squares, days with a value of 0 or less are left out), so for exponential
+growth y = a*exp(k*x) it is k. The sums of the regression come from cumulative
+sums over the days, every day costs the same regardless of the window.
+
+The rates are stored next to the columnar cache (see owid_cache) in
+'<json name>.rolling', per metric and window:
+    index.json                   - start date, per metric and window the days and the iso codes
+    <metric>.w<window>.npy       - float64, days x countries (a day is one row, so a new day
+                                   is written at the end), NaN where there are too few points.
+                                   Room for more days and countries is reserved, doubling when full.
+    <metric>.w<window>.state.npz - per country the state at the last day: the filled values of
+                                   the last window - 1 days, the last value (for filling
+                                   missing values) and the raw values of the last 'window' days
+
+update_rolling() (called by update_owid_json.check_data after a download) only
+reads the last 'window' days and the new days from the cache and only calculates
+the new days, the work per update grows with the countries and the new days, not
+with all the days. A country whose raw values in the last 'window' days changed
+(OWID revises recent numbers) or that is new is calculated completely.
+Revisions further back than that aren't noticed, full=True calculates everything again.
+Countries that are no longer in the data keep their rates, without the new days.
+"""
+import numpy as np
+
+from json import dump, load
+from numpy.lib.format import open_memmap
+from os import mkdir, path, replace
+
+import owid_cache
+import owid_matrix
+
+ROLLING_SUFFIX = ".rolling"
+ROLLING_VERSION = 2
+
+# Defaults, can be changed by the scripts using this module.
+WINDOW = 14
+METRICS = ["total_cases", "total_deaths"]
+
+
+"""
+Folder the rolling growth rates of 'filename' are stored in.
+"""
+def rolling_dir(filename):
+    base, _ = path.splitext(path.abspath(filename))
+    return base + ROLLING_SUFFIX
+
+
+"""
+Rolling growth rates of the days 'first_day' up to the last day of every row of 'values'
+(countries x days, NaN = missing). Returns a countries x (days - first_day) array.
+A day needs at least half a window of usable days, otherwise it's NaN.
+"""
+def rolling_growth_rates(values, window=WINDOW, first_day=0):
+    values = np.asarray(values, dtype=float)
+    n_days = values.shape[1]
+    # Only the window before the first day is needed.
+    offset = max(0, first_day - window + 1)
+    values = values[:, offset:]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        usable = np.isfinite(values) & (values > 0)
+        log_values = np.where(usable, np.log(np.where(usable, values, 1.0)), 0.0)
+    x = np.arange(values.shape[1], dtype=float)
+
+    # Cumulative sums with a leading 0, the sums of a window are the difference of two of them.
+    def cumulative(terms):
+        return np.pad(np.cumsum(terms, axis=1), ((0, 0), (1, 0)))
+
+    sum_n = cumulative(usable.astype(float))
+    sum_x = cumulative(usable * x)
+    sum_xx = cumulative(usable * x*x)
+    sum_y = cumulative(log_values)
+    sum_xy = cumulative(log_values * x)
+
+    ends = np.arange(first_day, n_days) - offset + 1
+    starts = np.maximum(ends - window, 0)
+
+    def window_sums(sums):
+        return sums[:, ends] - sums[:, starts]
+
+    n = window_sums(sum_n)
+    sx, sxx, sy, sxy = (window_sums(sums) for sums in (sum_x, sum_xx, sum_y, sum_xy))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rates = (n*sxy - sx*sy) / (n*sxx - sx*sx)
+    rates[(n < max(2, window // 2)) | ~np.isfinite(rates)] = np.nan
+    return rates
+
+
+def _rates_file(directory, metric, window):
+    return path.join(directory, "{}.w{}.npy".format(metric, window))
+
+
+def _state_file(directory, metric, window):
+    return path.join(directory, "{}.w{}.state.npz".format(metric, window))
+
+
+"""
+The rates file of a metric with room for at least 'n_days' x 'n_rows', memory-mapped for writing.
+'shape' is the (days, countries) that are in use, those are kept when the file has to grow.
+"""
+def _open_rates(directory, metric, window, n_days, n_rows, shape=None):
+    filename = _rates_file(directory, metric, window)
+    if shape is not None and path.isfile(filename):
+        rates = open_memmap(filename, mode="r+")
+        if rates.shape[0] >= n_days and rates.shape[1] >= n_rows:
+            return rates
+        capacity = (max(n_days, 2*rates.shape[0]), max(n_rows, 2*rates.shape[1]))
+    else:
+        capacity = (max(n_days, 1), max(n_rows, 1))
+
+    grown = open_memmap(filename + ".tmp", mode="w+", dtype=float, shape=capacity)
+    grown[:] = np.nan
+    if shape is not None and path.isfile(filename):
+        grown[:shape[0], :shape[1]] = rates[:shape[0], :shape[1]]
+        del rates
+    grown.flush()
+    del grown
+    replace(filename + ".tmp", filename)
+    return open_memmap(filename, mode="r+")
+
+
+"""
+Fills the raw 'values' (rows x days, NaN = missing) like owid_matrix does, continuing from
+'carry', the last known value of every row before these days (NaN if there is none).
+Returns the filled values and the new carry.
+"""
+def _fill(values, present, metric, carry):
+    values = np.column_stack((carry, values))
+    present = np.column_stack((np.ones(len(carry), dtype=bool), present))
+    filled = owid_matrix.fill_missing(values, metric, present)[:, 1:]
+
+    # The last value that isn't missing, per row.
+    known = ~np.isnan(values)
+    last = values.shape[1] - 1 - np.argmax(known[:, ::-1], axis=1)
+    carry = np.where(known.any(axis=1), values[np.arange(len(values)), last], np.nan)
+    return filled, carry
+
+
+"""
+The last 'days' columns of 'values', padded with 'fill' on the left when there are less.
+"""
+def _tail(values, days, fill):
+    if values.shape[1] >= days:
+        return values[:, values.shape[1]-days:]
+    padding = np.full((len(values), days - values.shape[1]), fill, dtype=values.dtype)
+    return np.concatenate((padding, values), axis=1)
+
+
+"""
+Brings the rolling growth rates of 'filename' up to date with its cache (see the module docstring).
+Returns per metric the amount of rows that only got the new days calculated and the
+amount of rows that were calculated completely.
+"""
+def update_rolling(filename, metrics=None, window=WINDOW, full=False):
+    if metrics is None:
+        metrics = METRICS
+    cache = owid_cache.load_cache(filename, rebuild=False)
+    metrics = [metric for metric in metrics if metric in cache.metrics]
+    n_days = len(cache.dates)
+
+    directory = rolling_dir(filename)
+    index_file = path.join(directory, "index.json")
+    index = {}
+    if path.isfile(index_file):
+        with open(index_file) as index_handle:
+            index = load(index_handle)
+    # A different start of the date axis moves every column, nothing can be reused then.
+    if full or index.get("version") != ROLLING_VERSION or index.get("start_date") != str(cache.start_date):
+        index = {}
+    stored = index.get("series", {})
+
+    try:
+        mkdir(directory)
+    except Exception:
+        pass
+
+    counts = {}
+    for metric in metrics:
+        key = "{}.w{}".format(metric, window)
+        previous = stored.get(key)
+        state = None
+        if previous is not None and previous["n_days"] <= n_days and path.isfile(_state_file(directory, metric, window)):
+            state = dict(np.load(_state_file(directory, metric, window)))
+            # The state is written before the index, after a crash in between they don't match.
+            if int(state["n_days"]) != previous["n_days"]:
+                state = None
+        if state is None:
+            previous = {"n_days": 0, "iso_codes": []}
+            state = {"carry": np.empty(0), "filled": np.empty((0, window - 1)),
+                     "raw": np.empty((0, window)), "present": np.empty((0, window), dtype=bool)}
+
+        # Rows of the rates file: the known countries in their old order, new ones after them.
+        old_days = previous["n_days"]
+        iso_codes = list(previous["iso_codes"])
+        known = set(iso_codes)
+        iso_codes += [iso for iso in cache.iso_codes if iso not in known]
+        n_old = len(previous["iso_codes"])
+        cache_rows = np.array([cache.rows.get(iso, -1) for iso in iso_codes], dtype=int)
+        in_cache = cache_rows >= 0
+
+        raw_values = cache.values(metric)
+        tail_start = max(0, old_days - window)
+        reusable = np.zeros(len(iso_codes), dtype=bool)
+        if n_old:
+            # Only the last 'window' old days are read to see if a country changed.
+            rows = np.flatnonzero(in_cache[:n_old])
+            checked = old_days - tail_start
+            raw_now = np.asarray(raw_values[:, tail_start:old_days])[cache_rows[rows]]
+            present_now = np.asarray(cache.present[:, tail_start:old_days])[cache_rows[rows]]
+            raw_before = state["raw"][rows, window-checked:]
+            same_raw = (raw_now == raw_before) | (np.isnan(raw_now) & np.isnan(raw_before))
+            same_present = present_now == state["present"][rows, window-checked:]
+            reusable[rows[(same_raw & same_present).all(axis=1)]] = True
+
+        # The state of every row, countries that are no longer in the data keep theirs.
+        carry = np.full(len(iso_codes), np.nan)
+        filled_tail = np.full((len(iso_codes), window - 1), np.nan)
+        raw_tail = np.full((len(iso_codes), window), np.nan)
+        present_tail = np.zeros((len(iso_codes), window), dtype=bool)
+        carry[:n_old] = state["carry"]
+        filled_tail[:n_old] = state["filled"]
+        raw_tail[:n_old] = state["raw"]
+        present_tail[:n_old] = state["present"]
+
+        rates = _open_rates(directory, metric, window, n_days, len(iso_codes), (old_days, n_old) if n_old else None)
+
+        # Only the new days of the unchanged rows, from their state.
+        rows = np.flatnonzero(reusable)
+        if len(rows) and old_days < n_days:
+            new_raw = np.asarray(raw_values[:, old_days:])[cache_rows[rows]]
+            new_present = np.asarray(cache.present[:, old_days:])[cache_rows[rows]]
+            new_filled, carry[rows] = _fill(new_raw, new_present, metric, carry[rows])
+            series = np.concatenate((filled_tail[rows], new_filled), axis=1)
+            rates[old_days:n_days, rows] = rolling_growth_rates(series, window, window - 1).T
+            filled_tail[rows] = _tail(series, window - 1, np.nan)
+            raw_tail[rows] = _tail(np.concatenate((raw_tail[rows], new_raw), axis=1), window, np.nan)
+            present_tail[rows] = _tail(np.concatenate((present_tail[rows], new_present), axis=1), window, False)
+
+        # Everything of the changed and new rows.
+        rows = np.flatnonzero(in_cache & ~reusable)
+        if len(rows):
+            all_raw = np.asarray(raw_values)[cache_rows[rows]]
+            all_present = np.asarray(cache.present)[cache_rows[rows]]
+            all_filled, carry[rows] = _fill(all_raw, all_present, metric, np.full(len(rows), np.nan))
+            rates[:n_days, rows] = rolling_growth_rates(all_filled, window).T
+            filled_tail[rows] = _tail(all_filled, window - 1, np.nan)
+            raw_tail[rows] = _tail(all_raw, window, np.nan)
+            present_tail[rows] = _tail(all_present, window, False)
+
+        rates.flush()
+        del rates
+        state_file = _state_file(directory, metric, window)
+        with open(state_file + ".tmp", "wb") as state_handle:
+            np.savez(state_handle, n_days=n_days, carry=carry, filled=filled_tail, raw=raw_tail, present=present_tail)
+        replace(state_file + ".tmp", state_file)
+
+        stored[key] = {"n_days": n_days, "iso_codes": iso_codes}
+        counts[metric] = (int(reusable.sum()), int((in_cache & ~reusable).sum()))
+
+    with open(index_file + ".tmp", "w") as index_handle:
+        dump({"version": ROLLING_VERSION, "start_date": str(cache.start_date), "series": stored}, index_handle)
+    replace(index_file + ".tmp", index_file)
+
+    return counts
+
+
+"""
+The stored rolling growth rates of a metric: iso codes, the dates and the countries x days array (memory-mapped).
+"""
+def load_rolling(filename, metric, window=WINDOW):
+    directory = rolling_dir(filename)
+    with open(path.join(directory, "index.json")) as index_handle:
+        index = load(index_handle)
+
+    series = index["series"]["{}.w{}".format(metric, window)]
+    dates = np.datetime64(index["start_date"], "D") + np.arange(series["n_days"])
+    rates = np.load(_rates_file(directory, metric, window), mmap_mode="r")
+    return series["iso_codes"], dates, rates[:series["n_days"], :len(series["iso_codes"])].T
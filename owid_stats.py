@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Linear regressions and correlations of every pair of columns at once.
+
+regressions() gives the same numbers as scipy.stats.linregress(df[x], df[y]) for
+every (x, y) pair of columns, but calculates them for all pairs together from a
+few matrix products instead of one linregress call (and one dropna) per pair.
+
+Missing values are handled per pair: a row is used for a pair when both of its
+values are known (pairwise=True). With pairwise=False every row with a missing
+value in any of the columns is left out first, like df.dropna() does.
+
+The p-value of linregress assumes normally distributed data, which the skewed
+growth rates are not. resample() adds resampling based significance to the table:
+    p_permutation  - share of permutations of y with an |r| at least as large
+    r_low, r_high  - percentile bootstrap confidence interval of r
+The resamples are drawn in batches, every batch is one matrix operation. The
+results only depend on the seed and the pair itself, not on the other pairs
+that are resampled in the same call or the amount of worker processes.
+"""
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha1
+from os import cpu_count
+from pandas import DataFrame
+from scipy.stats import t as t_distribution
+
+RESULT_COLUMNS = ["x", "y", "n", "slope", "intercept", "r", "p_value", "stderr", "intercept_stderr"]
+
+# Defaults, can be changed by the scripts using this module.
+RESAMPLES = 9999
+BATCH_SIZE = 1000   # Resamples per matrix operation
+WORKERS = 1         # None = one process per cpu, 1 = everything in this process
+
+
+"""
+Per pair of columns (i, j) the sums over the rows where both are known:
+n, sum of i, sum of j, sum of i*i, sum of j*j and sum of i*j, each as a matrix.
+"""
+def _pair_sums(values):
+    known = ~np.isnan(values)
+    # Centering on the column means first keeps the sums of squares accurate.
+    centered = np.where(known, values - np.nanmean(values, axis=0), 0.0)
+    weights = known.astype(float)
+
+    n = weights.T @ weights
+    sum_x = centered.T @ weights
+    sum_xx = (centered**2).T @ weights
+    sum_xy = centered.T @ centered
+    return n, sum_x, sum_x.T, sum_xx, sum_xx.T, sum_xy
+
+
+"""
+Regression of y on x for every pair of 'columns' (all columns of 'df' if None), in one go.
+Returns a table with a row per (x, y) pair, see RESULT_COLUMNS, with the same
+meaning as the results of scipy.stats.linregress. Pairs with less than 3 rows get NaN.
+"""
+def regressions(df, columns=None, pairwise=True):
+    if columns is None:
+        columns = list(df.columns)
+    values = df[columns].to_numpy(dtype=float)
+    if not pairwise:
+        values = values[~np.isnan(values).any(axis=1)]
+
+    n, sum_x, sum_y, sum_xx, sum_yy, sum_xy = _pair_sums(values)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ss_x = sum_xx - sum_x**2 / n
+        ss_y = sum_yy - sum_y**2 / n
+        ss_xy = sum_xy - sum_x * sum_y / n
+
+        r = np.clip(ss_xy / np.sqrt(ss_x * ss_y), -1.0, 1.0)
+        slope = ss_xy / ss_x
+        # The sums are of centered values, the intercept is of the original ones.
+        means = np.nanmean(values, axis=0) if len(values) else np.full(len(columns), np.nan)
+        mean_x = sum_x / n + means[:, None]
+        mean_y = sum_y / n + means[None, :]
+        intercept = mean_y - slope * mean_x
+
+        dof = n - 2
+        t = r * np.sqrt(dof / ((1.0 - r) * (1.0 + r)))
+        p_value = 2 * t_distribution.sf(np.abs(t), dof)
+        stderr = np.sqrt((1.0 - r**2) * ss_y / ss_x / dof)
+        intercept_stderr = stderr * np.sqrt(ss_x / n + mean_x**2)
+
+    too_few = n < 3
+    results = {"slope": slope, "intercept": intercept, "r": r, "p_value": p_value,
+               "stderr": stderr, "intercept_stderr": intercept_stderr}
+    for name in results:
+        results[name] = np.where(too_few, np.nan, results[name])
+
+    x_index, y_index = np.meshgrid(np.arange(len(columns)), np.arange(len(columns)), indexing="ij")
+    table = DataFrame({
+        "x": np.asarray(columns, dtype=object)[x_index.ravel()],
+        "y": np.asarray(columns, dtype=object)[y_index.ravel()],
+        "n": n.ravel().astype(int),
+        **{name: result.ravel() for name, result in results.items()}
+    })
+    return table[RESULT_COLUMNS]
+
+
+"""
+The row of the (x, y) pair in a table of regressions().
+"""
+def pair(results, x, y):
+    return results[(results["x"] == x) & (results["y"] == y)].iloc[0]
+
+
+"""
+Pearson r of every row of x with the same row of y.
+"""
+def _row_correlations(x, y):
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (x*y).sum(axis=1) / np.sqrt((x*x).sum(axis=1) * (y*y).sum(axis=1))
+
+
+"""
+Permutation p-value and bootstrap interval of the correlation of one pair, see resample().
+"""
+def _resample_job(job):
+    x, y, n_resamples, confidence, seed = job
+    n = len(x)
+    if n < 3:
+        return np.nan, np.nan, np.nan
+
+    observed = abs(_row_correlations(x[None, :], y[None, :])[0])
+    rng = np.random.default_rng(seed)
+    at_least = 0
+    bootstrap = []
+    for start in range(0, n_resamples, BATCH_SIZE):
+        batch = min(BATCH_SIZE, n_resamples - start)
+
+        # Every row a permutation of y against the unchanged x.
+        permuted = rng.permuted(np.broadcast_to(y, (batch, n)), axis=1)
+        at_least += int(np.sum(np.abs(_row_correlations(np.broadcast_to(x, (batch, n)), permuted)) >= observed - 1e-12))
+
+        # Every row a bootstrap sample of the (x, y) pairs.
+        index = rng.integers(0, n, size=(batch, n))
+        bootstrap.append(_row_correlations(x[index], y[index]))
+
+    bootstrap = np.concatenate(bootstrap)
+    tail = (1.0 - confidence) / 2 * 100
+    r_low, r_high = np.nanpercentile(bootstrap, [tail, 100 - tail])
+    return (at_least + 1) / (n_resamples + 1), r_low, r_high
+
+
+"""
+Seed of the random numbers of one pair: 'seed' and a stable hash of the (sorted) column names.
+"""
+def _pair_seed(seed, x, y):
+    digest = sha1("\0".join(sorted((str(x), str(y)))).encode()).digest()
+    return [seed, int.from_bytes(digest[:8], "little")]
+
+
+"""
+Adds the permutation p-value and the bootstrap confidence interval of r (see the module
+docstring) to a table of regressions(), for the (x, y) 'pairs' (all pairs if None).
+'seed' makes the results reproducible, 'workers' spreads the pairs over processes.
+"""
+def resample(results, df, pairs=None, n_resamples=None, confidence=0.95, seed=0, workers=None):
+    if n_resamples is None:
+        n_resamples = RESAMPLES
+    if workers is None:
+        workers = WORKERS if WORKERS is not None else cpu_count() or 1
+    if pairs is None:
+        pairs = list(zip(results["x"], results["y"]))
+
+    # r is symmetric, (x, y) and (y, x) are resampled once.
+    unique = []
+    for x, y in pairs:
+        key = tuple(sorted((x, y)))
+        if x != y and key not in unique:
+            unique.append(key)
+
+    jobs = []
+    for x, y in unique:
+        both = df[[x, y]].dropna().to_numpy(dtype=float)
+        jobs.append((both[:, 0], both[:, 1], n_resamples, confidence, _pair_seed(seed, x, y)))
+
+    if workers <= 1 or len(jobs) <= 1:
+        resampled = [_resample_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            resampled = list(executor.map(_resample_job, jobs))
+    by_pair = dict(zip(unique, resampled))
+
+    results = results.copy()
+    columns = {"p_permutation": [], "r_low": [], "r_high": []}
+    for x, y in zip(results["x"], results["y"]):
+        values = by_pair.get(tuple(sorted((x, y))), (np.nan, np.nan, np.nan))
+        for name, value in zip(columns, values):
+            columns[name].append(value)
+    for name, values in columns.items():
+        results[name] = values
+    return results
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming loader for owid-covid-data.json.
+
+Walks the top-level object one country at a time, only the requested countries
+get decoded, the others are skipped without building any Python objects.
+Peak memory scales with the selection instead of with the whole file.
+
+get_data() is a drop-in replacement for the 'get_data(filename)' functions in
+the assignments:
+    get_data(filename)                                  # everything, like json.load
+    get_data(filename, countries=["NLD", "FRA"])        # only these countries
+    get_data(filename, fields=["location", "total_cases"])  # only these fields
+"""
+import re
+
+from json import JSONDecoder, JSONDecodeError
+
+CHUNK_SIZE = 1 << 20
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# A complete or (at the end of the buffer) incomplete string, or a bracket.
+# The closing quote is a group: a string cut off right after an escaped quote (\") ends in " as well.
+_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*(")?|[{}\[\]]')
+
+
+"""
+Buffer over a file object, the part that has been consumed gets dropped
+so only the current country is kept in memory.
+"""
+class _Reader:
+    def __init__(self, handle, chunk_size):
+        self.handle = handle
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        if self.eof:
+            raise ValueError("Unexpected end of file")
+        chunk = self.handle.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            raise ValueError("Unexpected end of file")
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def skip_whitespace(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return
+            self.read_more()
+
+    def expect(self, characters):
+        self.skip_whitespace()
+        char = self.buffer[self.pos]
+        if char not in characters:
+            raise ValueError("Expected one of {!r} at offset {}, got {!r}".format(characters, self.pos, char))
+        self.pos += 1
+        return char
+
+    """
+    Decodes one JSON value, reads more of the file until the value is complete.
+    """
+    def decode(self, decoder):
+        self.skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except JSONDecodeError:
+                self.read_more()
+                continue
+            # A number at the end of the buffer could still continue in the next chunk.
+            if end == len(self.buffer) and not self.eof:
+                try:
+                    self.read_more()
+                    continue
+                except ValueError:
+                    pass
+            self.pos = end
+            return value
+
+    """
+    Skips one JSON value without decoding it, only brackets outside of strings are counted.
+    """
+    def skip(self):
+        self.skip_whitespace()
+        if self.buffer[self.pos] not in "{[":
+            # Scalar, cheap enough to just decode.
+            self.decode(JSONDecoder())
+            return
+
+        depth = 0
+        while True:
+            match = _TOKEN.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                self.read_more()
+                continue
+
+            token = match.group()
+            if token[0] == '"':
+                if match.group(1) is None:
+                    # String continues in the next chunk, rescan it from its start.
+                    self.pos = match.start()
+                    self.read_more()
+                    continue
+            elif token in "{[":
+                depth += 1
+            else:
+                depth -= 1
+
+            self.pos = match.end()
+            if depth == 0:
+                return
+
+
+"""
+Keeps only the requested fields of a country and its records. 'date' is always
+kept in the records, 'data' is always kept in the country.
+"""
+def _filter_fields(country, fields):
+    filtered = {key: value for key, value in country.items() if key in fields}
+    filtered["data"] = [{key: value for key, value in record.items() if key == "date" or key in fields}
+                        for record in country.get("data", [])]
+    return filtered
+
+
+"""
+Yields (iso_code, country_data) pairs from the file, in file order.
+'countries' and 'fields' are optional selections, None means everything.
+"""
+def iter_countries(filename, countries=None, fields=None, chunk_size=CHUNK_SIZE):
+    wanted = set(countries) if countries is not None else None
+    fields = set(fields) if fields is not None else None
+    decoder = JSONDecoder()
+
+    with open(filename) as handle:
+        reader = _Reader(handle, chunk_size)
+        reader.expect("{")
+
+        reader.skip_whitespace()
+        if reader.buffer[reader.pos] == "}":
+            return
+
+        while True:
+            iso_code = reader.decode(decoder)
+            reader.expect(":")
+
+            if wanted is None or iso_code in wanted:
+                country = reader.decode(decoder)
+                if fields is not None:
+                    country = _filter_fields(country, fields)
+                yield iso_code, country
+
+                if wanted is not None:
+                    wanted.discard(iso_code)
+                    if not wanted:
+                        # Everything requested has been found.
+                        return
+            else:
+                reader.skip()
+
+            if reader.expect(",}") == "}":
+                return
+
+
+"""
+Loads the data from the json file, optionally only the selected countries and fields.
+"""
+def get_data(filename, countries=None, fields=None):
+    return dict(iter_countries(filename, countries, fields))
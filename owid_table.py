@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Time series and static fields of all countries in one go.
+
+extract() walks the countries once: the time series go into a CountryMatrix
+(see owid_matrix) and the static fields of every country (population_density,
+median_age, ...) into a DataFrame with one row per iso code. Missing static
+fields are NaN, so the table can be used for calculations right away. Text
+fields (continent, tests_units, ...) stay text, missing ones are NaN as well.
+With an OwidDataset on the cache (owid_cache.load_dataset) the matrix comes from
+the memory-mapped arrays instead.
+"""
+import numpy as np
+
+from pandas import DataFrame
+
+import owid_matrix
+from owid_dataset import OwidDataset
+
+
+"""
+The static 'fields' of the countries as a DataFrame, indexed by iso code, with the
+location name as the first column.
+"""
+def static_table(covid_data, fields, countries=None):
+    if countries is None:
+        countries = covid_data.keys()
+    iso_codes = list(countries)
+
+    locations = [covid_data[iso].get("location") for iso in iso_codes]
+    columns = {"location": locations}
+    for field in fields:
+        values = [covid_data[iso].get(field) for iso in iso_codes]
+        columns[field] = _column(values)
+
+    table = DataFrame(columns, index=iso_codes)
+    table.index.name = "iso_code"
+    return table
+
+
+"""
+A column of the table: float (NaN = missing) when all the values are numbers, otherwise the values as they are.
+"""
+def _column(values):
+    if all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=float)
+    return np.array(values, dtype=object)
+
+
+"""
+The time series 'metrics' and the static 'fields' of the countries (iso codes, all of them if None).
+'covid_data' is the loaded json data or an OwidDataset.
+Returns the CountryMatrix of the metrics and the DataFrame of the fields, see static_table().
+"""
+def extract(covid_data, metrics, fields, countries=None):
+    if isinstance(covid_data, OwidDataset):
+        matrix = covid_data.matrix(metrics, countries)
+        return matrix, static_table(covid_data.data, fields, matrix.iso_codes)
+    if countries is None:
+        countries = list(covid_data.keys())
+
+    matrix = owid_matrix.build_matrix(covid_data, metrics, countries)
+    table = static_table(covid_data, fields, matrix.iso_codes)
+    return matrix, table
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Multiple waves per country: finding them and fitting a sigmoid per wave.
+
+detect_waves() works on the countries x days matrix of new_cases at once:
+    1. every row is smoothed with a moving average of 'smooth' days and scaled to a maximum of 1
+    2. peaks are the days that are the highest within 'min_distance' days on both sides
+       and at least 'min_height' high (vectorized over the whole matrix)
+    3. between two peaks the lowest day is the boundary of the waves, unless the curve
+       doesn't drop at least 'min_drop' (as a fraction of the lower peak) in between,
+       then the lower of the two peaks is dropped
+Only step 3 loops, over the few peaks of every country.
+
+fit_waves() fits one sigmoid to the cumulative data of every wave (between two boundaries),
+all waves of all countries in one owid_fit.fit_many() call. k of a wave is its growth rate.
+"""
+import numpy as np
+
+from scipy.ndimage import maximum_filter1d
+
+import owid_fit
+from owid_model import sigmoid, sigmoid_jacobian, sigmoid_bounds
+
+# Defaults, can be changed by the scripts using this module.
+SMOOTH_DAYS = 14
+MIN_DISTANCE = 28   # days
+MIN_HEIGHT = 0.1    # of the highest peak
+MIN_DROP = 0.3      # of the lower peak
+MIN_WAVE_DAYS = 14
+
+
+"""
+Moving average of 'days' days of every row, NaN counts as 0. The rows keep their length.
+"""
+def smooth_rows(values, days):
+    values = np.nan_to_num(np.asarray(values, dtype=float))
+    if days <= 1:
+        return values
+    # Centered window from cumulative sums, shorter at the edges.
+    sums = np.cumsum(np.pad(values, ((0, 0), (1, 0))), axis=1)
+    n_days = values.shape[1]
+    starts = np.clip(np.arange(n_days) - days//2, 0, n_days)
+    ends = np.clip(np.arange(n_days) - days//2 + days, 0, n_days)
+    return (sums[:, ends] - sums[:, starts]) / (ends - starts)
+
+
+"""
+The boundaries of the waves of every row of 'new_cases' (countries x days), see the module docstring.
+Returns per row the sorted list of days on which a new wave starts (empty for one wave).
+"""
+def detect_waves(new_cases, smooth=None, min_distance=None, min_height=None, min_drop=None):
+    smooth = SMOOTH_DAYS if smooth is None else smooth
+    min_distance = MIN_DISTANCE if min_distance is None else min_distance
+    min_height = MIN_HEIGHT if min_height is None else min_height
+    min_drop = MIN_DROP if min_drop is None else min_drop
+
+    curves = smooth_rows(new_cases, smooth)
+    peaks = curves.max(axis=1, keepdims=True)
+    curves = curves / np.where(peaks > 0, peaks, 1.0)
+
+    # The highest day within 'min_distance' on both sides, for all rows at once.
+    highest = maximum_filter1d(curves, size=2*min_distance + 1, axis=1, mode="constant", cval=-np.inf)
+    is_peak = (curves == highest) & (curves >= min_height)
+    # A flat top is one peak, its first day.
+    is_peak[:, 1:] &= ~(is_peak[:, :-1] & (curves[:, 1:] == curves[:, :-1]))
+
+    boundaries = []
+    for row, days in enumerate(_row_indexes(is_peak)):
+        curve = curves[row]
+        kept = []
+        for day in days:
+            # Merges with the previous peak if the curve doesn't drop enough in between.
+            while kept:
+                previous = kept[-1]
+                trough = curve[previous:day+1].min()
+                if trough <= (1 - min_drop) * min(curve[previous], curve[day]):
+                    break
+                if curve[previous] >= curve[day]:
+                    day = None
+                    break
+                kept.pop()
+            if day is not None:
+                kept.append(day)
+
+        boundaries.append([int(start + np.argmin(curve[start:end+1])) for start, end in zip(kept[:-1], kept[1:])])
+    return boundaries
+
+
+"""
+Per row the indexes of the True values.
+"""
+def _row_indexes(mask):
+    rows, columns = np.nonzero(mask)
+    return np.split(columns, np.searchsorted(rows, np.arange(1, len(mask))))
+
+
+"""
+The (start, end) days of the waves of a series of 'n_days' days with these boundaries.
+Waves shorter than MIN_WAVE_DAYS are added to the wave before them.
+"""
+def wave_ranges(boundaries, n_days):
+    edges = [0]
+    for boundary in boundaries:
+        if boundary - edges[-1] >= MIN_WAVE_DAYS and n_days - boundary >= MIN_WAVE_DAYS:
+            edges.append(boundary)
+    edges.append(n_days)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+"""
+Fits a sigmoid to every wave of every series. 'series' are (days, cumulative values)
+and 'boundaries' the boundaries of every series as positions in it (see detect_waves).
+Returns per series a list of waves (start, end, popt, status), start and end as positions.
+"""
+def fit_waves(series, boundaries, maxfev=None, workers=None, cache=None):
+    segments = []
+    owners = []
+    for number, ((days, values), wave_boundaries) in enumerate(zip(series, boundaries)):
+        for start, end in wave_ranges(wave_boundaries, len(values)):
+            segments.append((np.asarray(days)[start:end], np.asarray(values)[start:end]))
+            owners.append((number, start, end))
+
+    fits = owid_fit.fit_many(segments, sigmoid, maxfev=maxfev, workers=workers, cache=cache,
+                             jac=sigmoid_jacobian, bounds=sigmoid_bounds)
+
+    waves = [[] for _ in series]
+    for (number, start, end), (popt, pcov, status) in zip(owners, fits):
+        waves[number].append((start, end, popt, status))
+    return waves
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: the shared modules on the path and a small owid-covid-data.json.
+"""
+import json
+import sys
+from os import path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, path.abspath(path.join(path.dirname(__file__), "..")))
+
+
+"""
+A small dataset in the format of owid-covid-data.json: three countries with
+sigmoid-shaped totals starting on different days, gaps and a text field.
+"""
+def make_covid_data(n_days=60):
+    start = np.datetime64("2020-03-01")
+    covid_data = {}
+    for number, (iso_code, first_day, k) in enumerate([("AAA", 0, 0.2), ("BBB", 5, 0.15), ("CCC", 10, 0.3)]):
+        records = []
+        for day in range(first_day, n_days):
+            total = 1000.0 / (1.0 + np.exp(-k * (day - 30)))
+            record = {"date": str(start + day), "total_cases": round(total, 1), "total_deaths": round(total / 50, 1)}
+            if day % 7 == 3:
+                del record["total_deaths"]
+            records.append(record)
+        covid_data[iso_code] = {"continent": "Europe", "location": "Country {}".format(number),
+                                "population": 1e6 * (number + 1), "median_age": 30.0 + number,
+                                "tests_units": "tests performed", "data": records}
+    return covid_data
+
+
+@pytest.fixture
+def covid_data():
+    return make_covid_data()
+
+
+@pytest.fixture
+def covid_json(tmp_path, covid_data):
+    filename = tmp_path / "owid-covid-data.json"
+    with open(filename, "w") as json_file:
+        json.dump(covid_data, json_file)
+    return str(filename)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import owid_cache
+import owid_table
+from owid_dataset import OwidDataset
+
+
+def test_load_dataset_uses_the_cache(covid_json):
+    dataset = owid_cache.load_dataset(covid_json)
+
+    assert dataset.cache is not None
+    assert "data" not in dataset["AAA"]
+    assert not owid_cache.is_stale(covid_json)
+
+
+def test_cache_matches_json(covid_json, covid_data):
+    cached = owid_cache.load_dataset(covid_json)
+    parsed = OwidDataset(covid_data)
+    metrics = ["total_cases", "total_deaths"]
+
+    cached_matrix, cached_table = owid_table.extract(cached, metrics, ["population", "median_age"])
+    parsed_matrix, parsed_table = owid_table.extract(parsed, metrics, ["population", "median_age"])
+
+    assert cached_matrix.iso_codes == parsed_matrix.iso_codes
+    for metric in metrics:
+        np.testing.assert_array_equal(cached_matrix.values[metric], parsed_matrix.values[metric])
+    assert cached_table.equals(parsed_table)
+    assert cached.start_date() == parsed.start_date()
+
+
+def test_load_dataset_falls_back_to_json(covid_json, monkeypatch):
+    def unwritable(filename, rebuild=True):
+        raise PermissionError("read-only")
+    monkeypatch.setattr(owid_cache, "load_cache", unwritable)
+
+    dataset = owid_cache.load_dataset(covid_json)
+
+    assert dataset.cache is None
+    assert len(dataset["AAA"]["data"]) == 60
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+from http.client import IncompleteRead
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import owid_download
+
+LAST_MODIFIED = "Mon, 12 Oct 2020 08:00:00 GMT"
+
+
+"""
+Stand-in for the GitHub server: serves 'body' with an ETag and a Last-Modified, answers
+304 to matching conditional requests and can cut the body short.
+"""
+class StandIn:
+    def __init__(self):
+        self.body = b'{"NLD": {"data": []}}'
+        self.etag = '"v1"'
+        self.truncate = False
+        self.requests = []
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stand_in.requests.append(dict(self.headers))
+                if self.headers.get("If-None-Match") == stand_in.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = stand_in.body
+                self.send_response(200)
+                self.send_header("ETag", stand_in.etag)
+                self.send_header("Last-Modified", LAST_MODIFIED)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body)//2] if stand_in.truncate else body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/owid-covid-data.json".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+@pytest.fixture
+def server():
+    stand_in = StandIn()
+    yield stand_in
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
+
+
+@pytest.fixture
+def filename(tmp_path):
+    return str(tmp_path / "owid-covid-data.json")
+
+
+def test_download_writes_file_and_manifest(server, filename):
+    assert owid_download.download(server.url, filename, chunk_size=4)
+
+    with open(filename, "rb") as data_file:
+        assert data_file.read() == server.body
+    manifest = owid_download.read_manifest(filename)
+    assert manifest["etag"] == '"v1"'
+    assert manifest["last_modified"] == LAST_MODIFIED
+    assert manifest["size"] == len(server.body)
+    assert manifest["sha256"] == owid_download.file_sha256(filename)
+    assert "If-None-Match" not in server.requests[0]
+
+
+def test_unchanged_file_is_not_downloaded(server, filename):
+    owid_download.download(server.url, filename)
+    before = os.stat(filename)
+
+    assert not owid_download.download(server.url, filename)
+
+    assert server.requests[-1]["If-None-Match"] == '"v1"'
+    assert server.requests[-1]["If-Modified-Since"] == LAST_MODIFIED
+    after = os.stat(filename)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+
+def test_short_body_keeps_the_old_file(server, filename):
+    owid_download.download(server.url, filename)
+    old_body = server.body
+    server.body = b'{"NLD": {"data": [{"date": "2020-10-12"}]}}'
+    server.etag = '"v2"'
+    server.truncate = True
+
+    with pytest.raises((OSError, IncompleteRead)):
+        owid_download.download(server.url, filename)
+
+    with open(filename, "rb") as data_file:
+        assert data_file.read() == old_body
+    assert owid_download.read_manifest(filename)["etag"] == '"v1"'
+    assert sorted(os.listdir(os.path.dirname(filename))) == ["owid-covid-data.json", "owid-covid-data.json.manifest.json"]
+
+
+def test_changed_file_is_swapped_in(server, filename):
+    owid_download.download(server.url, filename)
+    before = os.stat(filename).st_ino
+    server.body = b'{"NLD": {"data": [{"date": "2020-10-12"}]}}'
+    server.etag = '"v2"'
+
+    assert owid_download.download(server.url, filename)
+
+    with open(filename, "rb") as data_file:
+        assert data_file.read() == server.body
+    # A new file that replaced the old one, not the old one written over.
+    assert os.stat(filename).st_ino != before
+    assert owid_download.read_manifest(filename)["etag"] == '"v2"'
+
+
+def test_damaged_file_is_downloaded_again(server, filename):
+    owid_download.download(server.url, filename)
+    with open(filename, "wb") as data_file:
+        # Same size, so only the sha256 tells it apart.
+        data_file.write(b'{"NLD": {"data": [}}}')
+
+    assert owid_download.download(server.url, filename)
+
+    assert "If-None-Match" not in server.requests[-1]
+    with open(filename, "rb") as data_file:
+        assert json.loads(data_file.read()) == {"NLD": {"data": []}}
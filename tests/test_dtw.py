@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+import owid_dtw
+
+
+"""
+Textbook DTW with a Sakoe-Chiba band, one pair at a time.
+"""
+def naive_dtw(a, b, window):
+    n = len(a)
+    cost = np.full((n + 1, n + 1), np.inf)
+    cost[0, 0] = 0.0
+    for i in range(1, n + 1):
+        for j in range(max(1, i - window), min(n, i + window) + 1):
+            cost[i, j] = (a[i-1] - b[j-1])**2 + min(cost[i-1, j], cost[i, j-1], cost[i-1, j-1])
+    return np.sqrt(cost[n, n])
+
+
+@pytest.fixture
+def curves():
+    rng = np.random.default_rng(1)
+    return np.cumsum(rng.normal(size=(15, 30)), axis=1)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(owid_dtw, "CACHE_DIR", str(tmp_path / "dtw-cache"))
+
+
+def test_dtw_pairs_matches_naive(curves):
+    rows, columns = np.triu_indices(len(curves), 1)
+    distances = owid_dtw.dtw_pairs(curves[rows], curves[columns], 3)
+    expected = [naive_dtw(curves[row], curves[column], 3) for row, column in zip(rows, columns)]
+    np.testing.assert_allclose(distances, expected)
+
+
+def test_exact_matrix_has_every_pair(curves):
+    distances, n_exact = owid_dtw.dtw_matrix(curves, 3, prune=False, workers=1)
+
+    assert n_exact == len(curves) * (len(curves) - 1) // 2
+    for row in range(len(curves)):
+        for column in range(len(curves)):
+            assert distances[row, column] == pytest.approx(naive_dtw(curves[row], curves[column], 3))
+
+
+def test_nearest_neighbours_are_exact(curves):
+    exact, _ = owid_dtw.dtw_matrix(curves, 3, prune=False, workers=1, cache=False)
+    np.fill_diagonal(exact, np.inf)
+
+    nearest, distances = owid_dtw.nearest_neighbours(curves, 3, neighbours=4, workers=1, cache=False)
+
+    np.testing.assert_array_equal(nearest, np.argsort(exact, axis=1, kind="stable")[:, :4])
+    np.testing.assert_allclose(distances, np.sort(exact, axis=1)[:, :4])
+
+
+def test_exact_and_pruned_are_cached_apart(curves):
+    assert owid_dtw._cache_file(curves, 3, True, 4) != owid_dtw._cache_file(curves, 3, False, 4)
+    # 'neighbours' doesn't change an exact matrix.
+    assert owid_dtw._cache_file(curves, 3, False, 4) == owid_dtw._cache_file(curves, 3, False, 10)
+
+    pruned, _ = owid_dtw.dtw_matrix(curves, 3, prune=True, neighbours=2, workers=1)
+    exact, n_exact = owid_dtw.dtw_matrix(curves, 3, prune=False, workers=1)
+
+    assert n_exact is not None
+    assert (pruned <= exact + 1e-12).all()
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+
+import numpy as np
+import pytest
+
+import owid_cache
+import owid_fetch
+import update_owid_json
+from conftest import make_covid_data
+
+VACCINATIONS = json.dumps([{"country": "Country 0", "iso_code": "AAA",
+                            "data": [{"date": "2020-03-02", "total_vaccinations": 10, "people_vaccinated": None},
+                                     {"date": "2020-03-03", "total_vaccinations": 25}]},
+                           {"country": "World", "iso_code": "OWID_WRL",
+                            "data": [{"date": "2020-03-02", "total_vaccinations": 99}]}]).encode()
+
+TESTING = ("Entity,ISO code,Date,Cumulative total,Daily change in cumulative total,Short-term positive rate\n"
+           "Country 1 - tests performed,BBB,2020-03-07,100,,0.1\n"
+           "Country 1 - tests performed,BBB,2020-03-08,130,30,0.2\n"
+           "Country 1 - people tested,BBB,2020-03-08,90,20,\n").encode()
+
+HOSPITALISATIONS = ("entity,iso_code,date,indicator,value\n"
+                    "Country 0,AAA,2020-03-02,Daily ICU occupancy,4\n"
+                    "Country 0,AAA,2020-02-01,Daily ICU occupancy,1\n"
+                    "Country 2,CCC,2020-03-12,Weekly new hospital admissions,7\n").encode()
+
+
+"""
+Stand-in for the OWID servers: serves 'files' (path -> bytes) after 'delay' seconds, answers
+the codes in 'failures' (path -> list) before the file, answers 304 to a matching
+ETag and counts the downloads running at once.
+"""
+class StandIn:
+    def __init__(self, files, delay=0.0):
+        self.files = files
+        self.delay = delay
+        self.failures = {}
+        self.requests = []
+        self.active = 0
+        self.peak = 0
+        lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with lock:
+                    stand_in.requests.append(self.path)
+                    stand_in.active += 1
+                    stand_in.peak = max(stand_in.peak, stand_in.active)
+                try:
+                    time.sleep(stand_in.delay)
+                    failures = stand_in.failures.get(self.path)
+                    if failures:
+                        self.send_error(failures.pop(0))
+                        return
+                    body = stand_in.files.get(self.path)
+                    if body is None:
+                        self.send_error(404)
+                        return
+                    if self.headers.get("If-None-Match") == '"v1"':
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    self.send_response(200)
+                    self.send_header("ETag", '"v1"')
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with lock:
+                        stand_in.active -= 1
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = "http://127.0.0.1:{}".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, name):
+        return self.base + name
+
+    def sources(self):
+        return {"vaccinations": (self.url("/vaccinations.json"), owid_fetch.parse_vaccinations),
+                "testing": (self.url("/testing.csv"), owid_fetch.parse_testing),
+                "hospitalisations": (self.url("/hospitalisations.csv"), owid_fetch.parse_hospitalisations)}
+
+
+def _start(files, delay=0.0):
+    return StandIn(dict({"/vaccinations.json": VACCINATIONS, "/testing.csv": TESTING,
+                         "/hospitalisations.csv": HOSPITALISATIONS}, **files), delay)
+
+
+@pytest.fixture
+def server():
+    stand_in = _start({})
+    yield stand_in
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
+
+
+@pytest.fixture
+def slow_server():
+    stand_in = _start({}, delay=0.2)
+    yield stand_in
+    stand_in.server.shutdown()
+    stand_in.server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def short_backoff(monkeypatch):
+    monkeypatch.setattr(owid_fetch, "BACKOFF", 0.01)
+
+
+def test_downloads_run_concurrently_within_the_limit(slow_server):
+    lines = []
+    tables = owid_fetch.fetch_tables(slow_server.sources(), connections=2, progress=lines.append)
+
+    assert set(tables) == {"vaccinations", "testing", "hospitalisations"}
+    # Two downloads overlapped, never three.
+    assert slow_server.peak == 2
+    assert len(lines) == 4 and lines[-1].startswith("Fetched 3 of 3 sources")
+
+
+def test_server_errors_are_retried(server):
+    server.failures["/testing.csv"] = [503, 502]
+    lines = []
+    tables = owid_fetch.fetch_tables(server.sources(), progress=lines.append)
+
+    assert server.requests.count("/testing.csv") == 3
+    assert tables["testing"]["BBB"]["2020-03-08"]["total_tests"] == 130
+    assert sum("testing:" in line and "retrying" in line for line in lines) == 2
+
+
+def test_server_errors_give_up_after_the_retries(server):
+    server.failures["/testing.csv"] = [503] * 5
+    lines = []
+    with pytest.raises(HTTPError):
+        owid_fetch.fetch_tables(server.sources(), retries=2, progress=lines.append)
+    assert server.requests.count("/testing.csv") == 3
+    assert any(line.startswith("testing: failed") for line in lines)
+
+
+def test_client_errors_fail_straight_away(server):
+    sources = server.sources()
+    sources["testing"] = (server.url("/missing.csv"), owid_fetch.parse_testing)
+    lines = []
+    with pytest.raises(HTTPError) as error:
+        owid_fetch.fetch_tables(sources, progress=lines.append)
+    assert error.value.code == 404
+    assert server.requests.count("/missing.csv") == 1
+    assert not any("retrying" in line for line in lines)
+
+    tables = owid_fetch.fetch_tables(sources, progress=lines.append, strict=False)
+    assert set(tables) == {"vaccinations", "hospitalisations"}
+    assert lines[-1].startswith("Fetched 2 of 3 sources")
+
+
+def test_merge_on_iso_code_and_date(server):
+    covid_data = make_covid_data()
+    owid_fetch.fetch_and_merge(covid_data, server.sources(), progress=lambda line: None)
+    aaa = {record["date"]: record for record in covid_data["AAA"]["data"]}
+    bbb = {record["date"]: record for record in covid_data["BBB"]["data"]}
+
+    assert aaa["2020-03-02"]["total_vaccinations"] == 10
+    assert aaa["2020-03-02"]["icu_patients"] == 4
+    assert "people_vaccinated" not in aaa["2020-03-02"]
+    assert aaa["2020-03-03"]["total_vaccinations"] == 25
+    assert "total_vaccinations" not in aaa["2020-03-04"]
+    # The first entity of a country, fields of the other one don't leak in.
+    assert bbb["2020-03-08"]["total_tests"] == 130 and bbb["2020-03-08"]["positive_rate"] == 0.2
+    # Dates before the first record and unknown countries are left out.
+    assert "2020-02-01" not in aaa and "OWID_WRL" not in covid_data
+    assert len(covid_data["AAA"]["data"]) == 60
+
+    covid_data = make_covid_data()
+    owid_fetch.fetch_and_merge(covid_data, server.sources(), add_dates=True, progress=lambda line: None)
+    dates = [record["date"] for record in covid_data["AAA"]["data"]]
+    assert dates[0] == "2020-02-01" and dates == sorted(dates)
+    assert covid_data["AAA"]["data"][0] == {"date": "2020-02-01", "icu_patients": 1.0}
+
+
+def test_check_data_stores_the_merged_tables_in_the_cache(tmp_path, monkeypatch):
+    stand_in = _start({"/owid-covid-data.json": json.dumps(make_covid_data()).encode()})
+    try:
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(owid_fetch, "fetch_all", _quiet(owid_fetch.fetch_all))
+        filename = "owid-covid-data.json"
+        assert update_owid_json.check_data(filename, stand_in.url("/owid-covid-data.json"), stand_in.sources())
+        with open(filename) as json_file:
+            assert "total_vaccinations" not in json_file.read()
+
+        dataset = owid_cache.load_dataset(filename)
+        assert set(dataset.cache.extras) == {"vaccinations", "testing", "hospitalisations"}
+        dates, values = dataset.cache.row("total_vaccinations", "AAA")
+        assert list(values[~np.isnan(values)]) == [10, 25]
+
+        # Nothing changed: no new download and no new fetch of the tables.
+        requests = len(stand_in.requests)
+        assert not update_owid_json.check_data(filename, stand_in.url("/owid-covid-data.json"), stand_in.sources())
+        assert len(stand_in.requests) == requests + 1
+    finally:
+        stand_in.server.shutdown()
+        stand_in.server.server_close()
+
+
+def _quiet(fetch_all):
+    async def quiet(sources=None, **options):
+        options["progress"] = lambda line: None
+        return await fetch_all(sources, **options)
+    return quiet
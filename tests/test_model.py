@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import owid_fit
+from owid_model import sigmoid, sigmoid_jacobian, sigmoid_bounds
+
+
+def test_steep_sigmoid_is_not_clipped():
+    # A k far above the old upper bound of 10, sampled finely enough to be resolved.
+    x = np.arange(0.0, 5.0, 0.05)
+    y = sigmoid(x, 500.0, 2.5, 25.0, 3.0)
+
+    popt, pcov, status = owid_fit.fit_one(sigmoid, x, y, jac=sigmoid_jacobian, bounds=sigmoid_bounds)
+
+    assert status == "ok"
+    np.testing.assert_allclose(popt, [500.0, 2.5, 25.0, 3.0], rtol=1e-4)
+
+
+def test_growth_rate_stays_positive():
+    lower, upper = sigmoid_bounds(np.arange(10), np.arange(10))
+    assert lower[2] == 0.0
+    assert upper[2] == np.inf
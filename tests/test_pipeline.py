@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pytest
+
+import owid_pipeline
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    return owid_pipeline.Pipeline("test", str(tmp_path))
+
+
+def test_per_key_recomputes_only_changed_keys(pipeline):
+    inputs = {"AAA": np.arange(5.0), "BBB": np.ones(5), "CCC": np.zeros(5)}
+    calls = []
+
+    def compute(keys):
+        calls.append(list(keys))
+        return [float(inputs[key].sum()) for key in keys]
+
+    hashes = {key: owid_pipeline.content_hash(values) for key, values in inputs.items()}
+    first = pipeline.per_key("fit", hashes, compute)
+    checkpoint = pipeline._checkpoint_file("fit")
+    before = os.stat(checkpoint).st_ino
+
+    inputs["BBB"] = np.full(5, 2.0)
+    hashes = {key: owid_pipeline.content_hash(values) for key, values in inputs.items()}
+    second = owid_pipeline.Pipeline("test", os.path.dirname(pipeline.directory)).per_key("fit", hashes, compute)
+
+    assert calls == [["AAA", "BBB", "CCC"], ["BBB"]]
+    assert first == {"AAA": 10.0, "BBB": 5.0, "CCC": 0.0}
+    assert second == {"AAA": 10.0, "BBB": 10.0, "CCC": 0.0}
+    # Written to a new file and swapped in, nothing left behind.
+    assert os.stat(checkpoint).st_ino != before
+    assert os.listdir(pipeline.directory) == ["fit.pkl"]
+
+
+def test_failed_stage_keeps_the_old_checkpoint(pipeline):
+    pipeline.per_key("fit", {"AAA": "1", "BBB": "1"}, lambda keys: [key.lower() for key in keys])
+
+    def fail(keys):
+        raise RuntimeError("fit crashed")
+    with pytest.raises(RuntimeError):
+        pipeline.per_key("fit", {"AAA": "1", "BBB": "2"}, fail)
+
+    calls = []
+    outputs = pipeline.per_key("fit", {"AAA": "1", "BBB": "1"}, lambda keys: calls.append(keys) or [])
+    assert calls == []
+    assert outputs == {"AAA": "aaa", "BBB": "bbb"}
+
+
+def test_removed_output_is_recomputed(pipeline):
+    pipeline.per_key("render", {"plot": "1"}, lambda keys: ["missing.png"])
+    outputs = pipeline.per_key("render", {"plot": "1"}, lambda keys: ["again.png"], lambda key, output: False)
+    assert outputs == {"plot": "again.png"}
+
+
+def test_step_and_summary(pipeline):
+    assert pipeline.step("analyse", "a", lambda: 1) == 1
+    assert pipeline.step("analyse", "a", lambda: 2) == 1
+    assert pipeline.step("analyse", "b", lambda: 3) == 3
+    assert pipeline.step("extract", None, lambda: 4) == 4
+    assert pipeline.stages["analyse"][:2] == (1, 0)
+    assert "analyse" in pipeline.summary()
+    assert not os.path.exists(pipeline._checkpoint_file("extract"))
+
+
+def test_content_hash():
+    assert owid_pipeline.content_hash(np.arange(3.0)) == owid_pipeline.content_hash(np.arange(3.0))
+    assert owid_pipeline.content_hash(np.arange(3.0)) != owid_pipeline.content_hash(np.arange(3))
+    assert owid_pipeline.content_hash({"a": 1, "b": 2}) == owid_pipeline.content_hash({"b": 2, "a": 1})
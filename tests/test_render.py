@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+import owid_render
+
+
+def _open_figure(number):
+    plt.figure()
+    return number
+
+
+def test_render_in_this_process_keeps_the_callers_figures(capsys):
+    own = plt.figure()
+    try:
+        results = owid_render.render_many(_open_figure, [(1,), (2,)], workers=1)
+        assert results == [1, 2]
+        assert plt.get_fignums() == [own.number]
+    finally:
+        plt.close(own)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import json
+
+import numpy as np
+import pytest
+
+import owid_cache
+import owid_matrix
+import owid_rolling
+
+
+def write(covid_data, filename):
+    with open(filename, "w") as json_file:
+        json.dump(covid_data, json_file)
+    owid_cache.build_cache(filename)
+
+
+"""
+The rates of a full calculation on the current cache, per iso code.
+"""
+def full_rates(filename, metric, window):
+    cache = owid_cache.load_cache(filename, rebuild=False)
+    matrix = owid_matrix.from_cache(cache, [metric])
+    rates = owid_rolling.rolling_growth_rates(matrix.values[metric], window)
+    return dict(zip(matrix.iso_codes, rates))
+
+
+def stored_rates(filename, metric, window):
+    iso_codes, dates, rates = owid_rolling.load_rolling(filename, metric, window)
+    return dict(zip(iso_codes, np.asarray(rates)))
+
+
+def test_rolling_rate_matches_polyfit():
+    rng = np.random.default_rng(0)
+    values = np.exp(0.1 * np.arange(40) + rng.normal(0, 0.05, size=(3, 40)))
+    values[1, 10:13] = np.nan
+    values[2, 20] = 0.0
+
+    rates = owid_rolling.rolling_growth_rates(values, 7)
+
+    for row in range(3):
+        for day in range(6, 40):
+            x = np.arange(day - 6, day + 1)
+            y = values[row, day-6:day+1]
+            usable = np.isfinite(y) & (y > 0)
+            expected = np.polyfit(x[usable], np.log(y[usable]), 1)[0]
+            assert rates[row, day] == pytest.approx(expected, rel=1e-9, abs=1e-12)
+
+
+def test_rates_from_a_later_day_are_a_slice():
+    values = np.exp(0.2 * np.arange(30))[None, :] * np.array([[1.0], [2.0]])
+
+    full = owid_rolling.rolling_growth_rates(values, 5)
+    part = owid_rolling.rolling_growth_rates(values, 5, 12)
+
+    np.testing.assert_allclose(part, full[:, 12:])
+
+
+def test_incremental_update_matches_full(tmp_path, covid_data):
+    filename = str(tmp_path / "owid-covid-data.json")
+    later = json.loads(json.dumps(covid_data))
+    for country in covid_data.values():
+        country["data"] = [record for record in country["data"] if record["date"] < "2020-04-15"]
+    write(covid_data, filename)
+    counts = owid_rolling.update_rolling(filename, window=7)
+    assert counts["total_cases"] == (0, 3)
+
+    # More days for all, a revised recent value for one and a new country.
+    later["BBB"]["data"][-20]["total_cases"] += 5.0
+    later["DDD"] = dict(later["AAA"], location="Country 3")
+    write(later, filename)
+    counts = owid_rolling.update_rolling(filename, window=7)
+
+    assert counts["total_cases"] == (2, 2)
+    assert counts["total_deaths"] == (3, 1)
+    for metric in ("total_cases", "total_deaths"):
+        stored = stored_rates(filename, metric, 7)
+        for iso_code, rates in full_rates(filename, metric, 7).items():
+            np.testing.assert_allclose(stored[iso_code], rates, rtol=1e-9, atol=1e-9)
+
+
+def test_update_without_new_days_reuses_everything(covid_json):
+    owid_cache.ensure_cache(covid_json)
+    owid_rolling.update_rolling(covid_json, window=7)
+    counts = owid_rolling.update_rolling(covid_json, window=7)
+
+    assert counts["total_cases"] == (3, 0)
+    stored = stored_rates(covid_json, "total_cases", 7)
+    for iso_code, rates in full_rates(covid_json, "total_cases", 7).items():
+        np.testing.assert_allclose(stored[iso_code], rates, rtol=1e-9, atol=1e-9)
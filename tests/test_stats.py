@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+import owid_stats
+
+
+def _frame():
+    rng = np.random.default_rng(1)
+    a = rng.normal(size=40)
+    return pd.DataFrame({"a": a, "b": a + rng.normal(size=40), "c": rng.normal(size=40), "d": rng.normal(size=40)})
+
+
+def test_resampling_of_a_pair_does_not_depend_on_the_other_pairs():
+    df = _frame()
+    results = owid_stats.regressions(df)
+    columns = ["p_permutation", "r_low", "r_high"]
+
+    alone = owid_stats.resample(results, df, [("b", "a")], n_resamples=199, seed=3, workers=1)
+    together = owid_stats.resample(results, df, [("c", "d"), ("a", "b"), ("a", "c")], n_resamples=199, seed=3, workers=1)
+    assert owid_stats.pair(alone, "a", "b")[columns].tolist() == owid_stats.pair(together, "a", "b")[columns].tolist()
+
+    other_seed = owid_stats.resample(results, df, [("a", "b")], n_resamples=199, seed=4, workers=1)
+    assert owid_stats.pair(other_seed, "a", "b")[columns].tolist() != owid_stats.pair(alone, "a", "b")[columns].tolist()
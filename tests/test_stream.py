@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import owid_stream
+from conftest import make_covid_data
+
+CHUNK_SIZES = list(range(1, 40)) + [64, 127, 1024]
+
+
+"""
+The test data with strings full of escapes: quotes, backslashes, unicode and brackets.
+"""
+@pytest.fixture
+def escaped_json(tmp_path):
+    covid_data = make_covid_data(n_days=12)
+    covid_data["AAA"]["location"] = 'The \\"Quoted\\" {Land} [x]'
+    covid_data["AAA"]["note"] = 'ends in a quote"'
+    covid_data["BBB"]["location"] = "Back\\slash \\ and é中 \"}\""
+    covid_data["BBB"]["data"][0]["tests_units"] = '"[{'
+    covid_data["CCC"]["data"][1]["note"] = "\\\\\"\\"
+    filename = tmp_path / "escaped.json"
+    with open(filename, "w") as json_file:
+        json.dump(covid_data, json_file)
+    return str(filename)
+
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_iter_countries_matches_json_load(escaped_json, chunk_size):
+    with open(escaped_json) as json_file:
+        expected = json.load(json_file)
+
+    assert dict(owid_stream.iter_countries(escaped_json, chunk_size=chunk_size)) == expected
+    for countries in (["BBB"], ["CCC"], ["CCC", "AAA"], ["AAA"]):
+        selected = dict(owid_stream.iter_countries(escaped_json, countries, chunk_size=chunk_size))
+        assert selected == {iso: expected[iso] for iso in countries}
+
+
+def test_get_data_selects_countries_and_fields(escaped_json):
+    with open(escaped_json) as json_file:
+        expected = json.load(json_file)
+
+    assert owid_stream.get_data(escaped_json) == expected
+    assert owid_stream.get_data(escaped_json, countries=["BBB", "XXX"]) == {"BBB": expected["BBB"]}
+
+    selected = owid_stream.get_data(escaped_json, countries=["CCC"], fields=["location", "total_cases"])
+    assert selected["CCC"]["location"] == expected["CCC"]["location"]
+    assert "population" not in selected["CCC"]
+    assert selected["CCC"]["data"] == [{"date": record["date"], "total_cases": record["total_cases"]}
+                                       for record in expected["CCC"]["data"]]
+
+
+def test_empty_and_truncated_files(tmp_path):
+    filename = tmp_path / "empty.json"
+    filename.write_text(" { } ")
+    assert owid_stream.get_data(str(filename)) == {}
+
+    filename.write_text(json.dumps(make_covid_data(n_days=12))[:-40])
+    with pytest.raises(ValueError):
+        owid_stream.get_data(str(filename), countries=["XXX"])
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+import owid_table
+
+
+def test_numeric_and_text_fields(covid_data):
+    del covid_data["BBB"]["median_age"]
+    del covid_data["CCC"]["tests_units"]
+
+    table = owid_table.static_table(covid_data, ["median_age", "continent", "tests_units"])
+
+    assert list(table.columns) == ["location", "median_age", "continent", "tests_units"]
+    assert table["median_age"].dtype == float
+    assert np.isnan(table.loc["BBB", "median_age"])
+    assert table.loc["CCC", "median_age"] == 32.0
+    assert list(table["continent"]) == ["Europe"] * 3
+    assert table.loc["AAA", "tests_units"] == "tests performed"
+    assert table["tests_units"].isna().tolist() == [False, False, True]
+
+
+def test_missing_field_is_nan(covid_data):
+    table = owid_table.static_table(covid_data, ["gdp_per_capita"], ["CCC", "AAA"])
+
+    assert list(table.index) == ["CCC", "AAA"]
+    assert table["gdp_per_capita"].isna().all()
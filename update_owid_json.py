@@ -4,25 +4,52 @@ Created on Thu Oct  1 17:04:29 2020
 
 @author: Thijs Weenink
 
-Checks the current owid-covid-data.json file with the one on GitHub.
-Downloads a new version if available or if the file doesn't exist.
+Downloads owid-covid-data.json from GitHub if it changed since the last download
+or doesn't exist yet (see owid_download.py, the file is replaced atomically).
+Afterwards the columnar cache (see owid_cache.py) is rebuilt if the file changed,
+with the vaccination, testing and hospitalisation tables (see owid_fetch.py) merged
+into it, and the rolling growth rates (see owid_rolling.py) are brought up to date.
+The downloaded JSON file itself stays as it is, so its manifest stays valid; the
+merged fields only live in the cache. A cache rebuilt elsewhere (for example by
+owid_cache.load_dataset) has no merged tables, the next check_data() merges them again.
 """
-from update_check import checkForUpdates
+from json import load
+from os import path
 
-def check_data():
-    filename = "owid-covid-data.json"
-    github_source = "https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.json"
+import owid_fetch
 
-    try:
-        downloaded_new = checkForUpdates(filename, github_source)
-    except FileNotFoundError:
-        with open("owid-covid-data.json", "w") as new_file:
-            new_file.close()
-        downloaded_new = checkForUpdates(filename, github_source)
+from owid_download import download
+from owid_cache import build_cache, is_stale, load_cache
+from owid_rolling import update_rolling
+
+def check_data(filename="owid-covid-data.json",
+               github_source="https://raw.githubusercontent.com/owid/covid-19-data/master/public/data/owid-covid-data.json",
+               sources=None):
+    if sources is None:
+        sources = owid_fetch.SOURCES
+
+    downloaded_new = download(github_source, filename)
 
     if downloaded_new == False:
         print("File up to date.")
 
+    if path.isfile(filename):
+        # Only rebuilds when the json file is newer than the cache or a table is missing from it.
+        stale = is_stale(filename)
+        merged = [] if stale else load_cache(filename, rebuild=False).extras
+        if stale or set(merged) != set(sources):
+            with open(filename) as json_file:
+                covid_data = load(json_file)
+            # A table that can't be downloaded now is left out, the next run tries again.
+            tables = owid_fetch.fetch_tables(sources, strict=False)
+            owid_fetch.merge(covid_data, tables)
+            build_cache(filename, covid_data, list(tables))
+            print("Cache rebuilt, merged: {}.".format(", ".join(tables) or "nothing"))
+
+        # Only the new days, unless earlier data of a country changed.
+        for metric, (incremental, full) in update_rolling(filename).items():
+            print("Rolling growth rates of {}: {} countries updated, {} calculated completely.".format(metric, incremental, full))
+
     return downloaded_new
 
 